@@ -0,0 +1,112 @@
+"""Compare handler latency with queries run on the event loop vs. the DB thread pool
+
+Simulates a burst of concurrent updates: most of them are cheap (like /help),
+some run the /me statistics query. With blocking queries on the event loop the
+cheap updates have to wait for every query in front of them.
+
+    python -m benchmarks.db_latency --users 50000 --updates 2000
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+# Use a throwaway database, must be set before config is imported
+_db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{_db_path}"
+
+from db.database import init_db, run_db, session_factory, close_db  # noqa: E402
+from db.models import User  # noqa: E402
+from services.referral import _get_referral_stats  # noqa: E402
+
+
+def seed(users):
+    session = session_factory()
+    session.bulk_insert_mappings(User, [
+        {"id": i, "referral_code": f"c{i}", "ticket_count": random.randint(0, 20)}
+        for i in range(1, users + 1)
+    ])
+    session.commit()
+    session.close()
+
+
+def run_inline(func, *args):
+    """Run a query the old way - directly on the event loop"""
+    session = session_factory()
+    try:
+        return func(session, *args)
+    finally:
+        session.close()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def simulate(mode, users, updates, heavy_share):
+    light, heavy = [], []
+    lag = []
+    done = asyncio.Event()
+
+    async def ticker():
+        # Measures how late the event loop wakes up a sleeping task
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.005)
+            lag.append(time.perf_counter() - start - 0.005)
+
+    async def update(i):
+        # Updates arrive spread over a short window, like a real burst
+        await asyncio.sleep(random.random() * 0.5)
+        start = time.perf_counter()
+        if random.random() < heavy_share:
+            user_id = random.randint(1, users)
+            if mode == "inline":
+                run_inline(_get_referral_stats, user_id)
+            else:
+                await run_db(_get_referral_stats, user_id)
+            heavy.append(time.perf_counter() - start)
+        else:
+            await asyncio.sleep(0)
+            light.append(time.perf_counter() - start)
+
+    ticker_task = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    await asyncio.gather(*(update(i) for i in range(updates)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await ticker_task
+
+    def fmt(values):
+        if not values:
+            return "-"
+        return f"p50={percentile(values, 50) * 1000:8.2f}ms p99={percentile(values, 99) * 1000:8.2f}ms"
+
+    print(f"[{mode:8}] total {elapsed:6.2f}s")
+    print(f"  light updates ({len(light):5}): {fmt(light)}")
+    print(f"  /me updates   ({len(heavy):5}): {fmt(heavy)}")
+    print(f"  event loop lag: max={max(lag) * 1000:.2f}ms p99={percentile(lag, 99) * 1000:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--heavy-share", type=float, default=0.1, help="Share of updates running /me")
+    args = parser.parse_args()
+
+    init_db()
+    seed(args.users)
+
+    for mode in ("inline", "executor"):
+        asyncio.run(simulate(mode, args.users, args.updates, args.heavy_share))
+
+    close_db()
+
+
+if __name__ == "__main__":
+    main()
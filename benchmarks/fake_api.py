@@ -0,0 +1,267 @@
+"""Local stand-in for the Telegram Bot API server
+
+    python -m benchmarks.fake_api --port 8081 --latency 0.05 --flood-limit 30
+    TELEGRAM_API_URL=http://127.0.0.1:8081 python bot.py
+
+Answers the methods the bot uses (getMe, getUpdates, deleteWebhook,
+setMyCommands, sendMessage, editMessageText, answerCallbackQuery,
+getChatMember, getChat, exportChatInviteLink, createChatInviteLink) with
+canned results, every other method with true. Updates to deliver through
+getUpdates are queued with push(), or over HTTP by posting a JSON list of
+updates to /_fake/updates. /_fake/stats returns the counters.
+
+Every request waits --latency seconds. Requests fail with 429 Too Many
+Requests at random (--error-rate), and sendMessage also fails when more than
+--flood-limit messages were sent in the last second, the way Telegram limits
+bots. getUpdates and the startup methods are never failed.
+
+Replies are matched to updates for the replay driver: a message sent to a
+chat answers the oldest update of that chat the bot has fetched and not
+answered yet.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter, defaultdict, deque
+
+from aiohttp import web
+
+from benchmarks.fake_bot import is_member
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bot", "username": "fake_bot"}
+PRIMARY_LINK = "https://t.me/+primary"
+
+# Failing these would only stop the bot from starting or polling
+NEVER_FAILED = {"getUpdates", "getMe", "deleteWebhook", "setMyCommands"}
+REPLY_METHODS = {"sendMessage", "editMessageText"}
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+class FakeBotAPI:
+    def __init__(self, latency=0.0, error_rate=0.0, flood_limit=0, retry_after=1, member_share=0.9, seed=1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.flood_limit = flood_limit
+        self.retry_after = retry_after
+        self.member_share = member_share
+        self.calls = Counter()
+        self.errors = Counter()
+        self.polling = asyncio.Event()  # Set by the first getUpdates
+        self._rng = random.Random(seed)
+        self._updates = deque()  # Queued and not yet confirmed by a getUpdates offset
+        self._new_updates = asyncio.Event()
+        self._update_id = 0
+        self._message_id = 0
+        self._sent = deque()  # Times of recent sendMessage calls, for the flood limit
+        self._unanswered = defaultdict(deque)  # chat id -> fetched updates waiting for a reply
+        # update id -> times it was queued, fetched by the bot and answered
+        self.queued_at = {}
+        self.fetched_at = {}
+        self.answered_at = {}
+        self.unmatched_replies = 0
+        self._runner = None
+
+    def push(self, update):
+        """Queue an update for getUpdates, returns its update_id"""
+        self._update_id += 1
+        update = dict(update, update_id=self._update_id)
+        self._updates.append(update)
+        self.queued_at[self._update_id] = time.perf_counter()
+        self._new_updates.set()
+        return self._update_id
+
+    def backlog(self):
+        """Updates queued but not fetched by the bot yet"""
+        return sum(1 for update in self._updates if update["update_id"] not in self.fetched_at)
+
+    def stats(self):
+        return {
+            "calls": dict(self.calls),
+            "errors_429": dict(self.errors),
+            "queued": len(self.queued_at),
+            "fetched": len(self.fetched_at),
+            "answered": len(self.answered_at),
+            "backlog": self.backlog(),
+            "unmatched_replies": self.unmatched_replies
+        }
+
+    # Method implementations, params are the decoded request fields
+
+    async def get_updates(self, params):
+        self.polling.set()
+        offset = _int(params.get("offset")) or 0
+        # Updates below the offset were handled, Telegram forgets them
+        while self._updates and self._updates[0]["update_id"] < offset:
+            self._updates.popleft()
+        if not self._updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), _int(params.get("timeout")) or 0)
+            except asyncio.TimeoutError:
+                return []
+        now = time.perf_counter()
+        updates = list(self._updates)[:_int(params.get("limit")) or 100]
+        for update in updates:
+            if update["update_id"] not in self.fetched_at:
+                self.fetched_at[update["update_id"]] = now
+                chat_id = self._chat_id(update)
+                if chat_id is not None:
+                    self._unanswered[chat_id].append(update["update_id"])
+        return updates
+
+    def _chat_id(self, update):
+        for key in ("message", "callback_query"):
+            if key in update:
+                return update[key]["from"]["id"]
+        return None
+
+    def _reply(self, params):
+        chat_id = _int(params.get("chat_id"))
+        waiting = self._unanswered.get(chat_id)
+        if waiting:
+            self.answered_at[waiting.popleft()] = time.perf_counter()
+        else:
+            self.unmatched_replies += 1
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if isinstance(chat_id, int) and chat_id > 0 else "channel"},
+            "from": BOT_USER,
+            "text": params.get("text", "")
+        }
+
+    def _respond(self, method, params):
+        if method == "getMe":
+            return BOT_USER
+        if method in REPLY_METHODS:
+            return self._reply(params)
+        if method == "getChatMember":
+            user_id = _int(params.get("user_id"))
+            status = "member" if is_member(user_id, self.member_share) else "left"
+            return {"status": status, "user": {"id": user_id, "is_bot": False, "first_name": "User"}}
+        if method == "getChat":
+            return {
+                "id": _int(params.get("chat_id")), "type": "channel", "accent_color_id": 0, "max_reaction_count": 0,
+                "accepted_gift_types": {"unlimited_gifts": False, "limited_gifts": False,
+                                        "unique_gifts": False, "premium_subscription": False, "gifts_from_channels": False},
+                "invite_link": PRIMARY_LINK
+            }
+        if method == "exportChatInviteLink":
+            return PRIMARY_LINK
+        if method == "createChatInviteLink":
+            name = params.get("name", "")
+            return {"invite_link": f"https://t.me/+{name}", "creator": BOT_USER, "name": name,
+                    "creates_join_request": False, "is_primary": False, "is_revoked": False}
+        # setMyCommands, answerCallbackQuery, deleteWebhook and the like
+        return True
+
+    def _rate_limited(self, method):
+        if method in NEVER_FAILED:
+            return False
+        if self.error_rate and self._rng.random() < self.error_rate:
+            return True
+        if self.flood_limit and method == "sendMessage":
+            now = time.perf_counter()
+            while self._sent and self._sent[0] < now - 1:
+                self._sent.popleft()
+            if len(self._sent) >= self.flood_limit:
+                return True
+            self._sent.append(now)
+        return False
+
+    # HTTP
+
+    async def _params(self, request):
+        if request.content_type == "application/json":
+            return await request.json()
+        return {key: value for key, value in (await request.post()).items()}
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = await self._params(request)
+        self.calls[method] += 1
+
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self.get_updates(params)})
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self._rate_limited(method):
+            self.errors[method] += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after}
+            }, status=429)
+        return web.json_response({"ok": True, "result": self._respond(method, params)})
+
+    async def handle_push(self, request):
+        ids = [self.push(update) for update in await request.json()]
+        return web.json_response({"ok": True, "result": ids})
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats())
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Start serving, returns the base URL to use as TELEGRAM_API_URL"""
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_post("/_fake/updates", self.handle_push)
+        app.router.add_get("/_fake/stats", self.handle_stats)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        # Port 0 picks a free one
+        host, port = self._runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def serve(args):
+    api = FakeBotAPI(args.latency, args.error_rate, args.flood_limit, args.retry_after, args.member_share)
+    url = await api.start(args.host, args.port)
+    print(f"Fake Bot API on {url}, set TELEGRAM_API_URL={url}")
+    try:
+        while True:
+            await asyncio.sleep(60)
+            print(json.dumps(api.stats()))
+    finally:
+        await api.stop()
+
+
+def add_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds every request takes")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests failed with 429")
+    parser.add_argument("--flood-limit", type=int, default=0, help="sendMessage calls per second before 429, 0 for none")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after of the 429 responses")
+    parser.add_argument("--member-share", type=float, default=0.9, help="Share of users getChatMember reports as members")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    add_arguments(parser)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Bot API session that answers from canned responses instead of Telegram
+
+    from benchmarks.fake_bot import FakeSession
+    bot.session = FakeSession(latency=0.05, member_share=0.9)
+
+Every request waits `latency` seconds, like a round trip to Telegram, and
+is counted per method. getChatMember answers "member" for a fixed share of
+user IDs, so the same user always gets the same answer.
+"""
+import asyncio
+from collections import Counter
+from datetime import datetime
+
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import (
+    CreateChatInviteLink,
+    EditMessageText,
+    ExportChatInviteLink,
+    GetChat,
+    GetChatMember,
+    SendMessage,
+)
+from aiogram.types import ChatFullInfo, ChatInviteLink, ChatMemberLeft, ChatMemberMember, Message, User
+
+BOT_USER = User(id=1, is_bot=True, first_name="Bot")
+
+
+def is_member(user_id, member_share):
+    """Deterministic membership, spread evenly over user IDs"""
+    return (user_id * 2654435761) % 1000 < member_share * 1000
+
+
+class FakeSession(BaseSession):
+    def __init__(self, latency=0.0, member_share=0.9):
+        super().__init__()
+        self.latency = latency
+        self.member_share = member_share
+        self.calls = Counter()
+        self._message_id = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[method.__api_method__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._respond(method)
+
+    def _respond(self, method):
+        if isinstance(method, GetChatMember):
+            user = User(id=method.user_id, is_bot=False, first_name="User")
+            if is_member(method.user_id, self.member_share):
+                return ChatMemberMember(user=user)
+            return ChatMemberLeft(user=user)
+        if isinstance(method, (SendMessage, EditMessageText)):
+            self._message_id += 1
+            return Message.model_validate({
+                "message_id": self._message_id,
+                "date": datetime.now(),
+                "chat": {"id": method.chat_id or 0, "type": "private"},
+                "from": BOT_USER,
+                "text": method.text
+            })
+        if isinstance(method, GetChat):
+            return ChatFullInfo.model_validate({
+                "id": method.chat_id, "type": "channel", "accent_color_id": 0, "max_reaction_count": 0,
+                "accepted_gift_types": {"unlimited_gifts": False, "limited_gifts": False,
+                                        "unique_gifts": False, "premium_subscription": False, "gifts_from_channels": False},
+                "invite_link": "https://t.me/+primary"
+            })
+        if isinstance(method, ExportChatInviteLink):
+            return "https://t.me/+primary"
+        if isinstance(method, CreateChatInviteLink):
+            return ChatInviteLink(invite_link=f"https://t.me/+{method.name}", creator=BOT_USER, name=method.name,
+                                  creates_join_request=False, is_primary=False, is_revoked=False)
+        # setMyCommands, answerCallbackQuery, deleteWebhook and the like
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        raise NotImplementedError("Downloads are not faked")
+        yield b""  # pragma: no cover
+
+    async def close(self):
+        pass
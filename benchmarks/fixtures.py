@@ -0,0 +1,115 @@
+"""Seeded synthetic databases for benchmarks
+
+Users join one after another. Most of them were invited by an earlier
+user, and the inviter is picked by preferential attachment: people who
+already brought friends tend to bring more. This gives the long-tailed
+referral graph of a real giveaway, with a few users holding thousands of
+tickets and most holding none. The same seed always gives the same
+database.
+
+    python -m benchmarks.fixtures --users 1000000 --out /tmp/giveaway-1m.db
+"""
+import argparse
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+CHUNK = 50000
+
+
+def _referral_graph(users, rng, referral_share, attachment):
+    """referred_by[i] of every user (None if they came on their own) and tickets per user"""
+    referred_by = [None] * (users + 1)
+    tickets = [0] * (users + 1)
+    # One entry per referral, picking from it favours users with many referrals
+    referrers = []
+    for user_id in range(2, users + 1):
+        if rng.random() >= referral_share:
+            continue
+        if referrers and rng.random() < attachment:
+            referrer_id = rng.choice(referrers)
+        else:
+            referrer_id = rng.randint(1, user_id - 1)
+        referred_by[user_id] = referrer_id
+        tickets[referrer_id] += 1
+        referrers.append(referrer_id)
+    return referred_by, tickets
+
+
+def generate(engine, users, seed=1, referral_share=0.6, attachment=0.7, member_share=0.9, blocked_share=0.02):
+    """Fill an empty database created by init_db() with users, referrals and the aggregates
+
+    Needs the referral code secret of the database, see load_referral_code_secret()
+    """
+    from db.models import User, Referral, Counter
+    from services.referral_codes import referral_codes
+
+    rng = random.Random(seed)
+    referred_by, tickets = _referral_graph(users, rng, referral_share, attachment)
+
+    start = datetime.utcnow() - timedelta(days=30)
+    step = timedelta(days=30) / users
+    checked_at = datetime.utcnow()
+
+    with engine.begin() as conn:
+        for first in range(1, users + 1, CHUNK):
+            ids = range(first, min(first + CHUNK, users + 1))
+            conn.execute(User.__table__.insert(), [{
+                "id": user_id,
+                "username": f"user{user_id}" if rng.random() < 0.8 else None,
+                "first_name": f"User {user_id}",
+                "referral_code": referral_codes.encode(user_id),
+                "joined_at": start + step * user_id,
+                "referred_by_id": referred_by[user_id],
+                "ticket_count": tickets[user_id],
+                "referral_count": tickets[user_id],
+                "is_blocked": rng.random() < blocked_share,
+                # Stored results of an earlier membership check, reused by draws while fresh
+                "is_member": rng.random() < member_share,
+                "member_checked_at": checked_at
+            } for user_id in ids])
+
+            referrals = [
+                {"referrer_id": referred_by[user_id], "referred_id": user_id, "timestamp": start + step * user_id}
+                for user_id in ids if referred_by[user_id]
+            ]
+            if referrals:
+                conn.execute(Referral.__table__.insert(), referrals)
+
+        # The migrations already created the counter for the empty database
+        conn.execute(Counter.__table__.delete().where(Counter.name == "ticket_total"))
+        conn.execute(Counter.__table__.insert(), [{"name": "ticket_total", "value": sum(tickets)}])
+
+    return {
+        "users": users,
+        "referrals": sum(1 for r in referred_by if r),
+        "ticket_holders": sum(1 for t in tickets if t),
+        "max_tickets": max(tickets)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", required=True, help="SQLite file to create")
+    args = parser.parse_args()
+
+    if os.path.exists(args.out):
+        raise SystemExit(f"{args.out} already exists")
+    # Must be set before config is imported
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.abspath(args.out)}"
+    from db.database import engine, init_db, close_db
+    from services.referral_codes import load_referral_code_secret
+
+    started = time.perf_counter()
+    init_db()
+    load_referral_code_secret()
+    summary = generate(engine, args.users, args.seed)
+    close_db()
+    print(f"{summary} in {time.perf_counter() - started:.1f}s -> {args.out}")
+
+
+if __name__ == "__main__":
+    main()
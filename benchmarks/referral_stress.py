@@ -0,0 +1,172 @@
+"""Fire thousands of simultaneous referrals and check the ticket invariants
+
+Every (referrer, invited user) pair is submitted several times at once, like
+a user tapping /start repeatedly during a spike, while some invited users
+leave and come back. Afterwards the stored counts must match the referrals:
+
+- each pair is recorded once and credited exactly once
+- ticket_count and referral_count of every referrer match their referrals
+- the ticket total counter is the sum of ticket_count
+- the per-draw totals of the open draw match its ledger and the referrals,
+  and its total counter is their sum
+
+    python -m benchmarks.referral_stress --referrals 5000 --duplicates 3
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Use a throwaway database, must be set before config is imported
+_db_path = os.path.join(tempfile.mkdtemp(), "stress.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{_db_path}"
+
+from sqlalchemy import func  # noqa: E402
+
+from config import REFERRAL_TICKETS  # noqa: E402
+from db.database import init_db, session_factory, close_db  # noqa: E402
+from db.models import User, Referral, Counter, Draw, DrawTickets, TicketLedger  # noqa: E402
+from services.aggregates import TICKET_TOTAL, get_counter  # noqa: E402
+from services.ledger import draw_total_counter  # noqa: E402
+from services.referral import process_referral, revoke_referrals  # noqa: E402
+
+
+def seed(users):
+    session = session_factory()
+    session.bulk_insert_mappings(User, [
+        {"id": i, "referral_code": f"c{i}", "ticket_count": 0, "referral_count": 0}
+        for i in range(1, users + 1)
+    ])
+    session.add(Draw(name="Stress", status="active"))
+    session.commit()
+    draw_id = session.query(Draw.id).scalar()
+    session.close()
+    return draw_id
+
+
+def check_invariants(session, draw_id, expected_pairs):
+    """Return a list of violated invariants, empty if everything adds up"""
+    errors = []
+
+    active = session.query(Referral.referrer_id, func.count()).filter(
+        Referral.revoked_at.is_(None)
+    ).group_by(Referral.referrer_id).all()
+    active = dict(active)
+
+    pairs = session.query(func.count(Referral.id)).scalar()
+    distinct = session.query(Referral.referrer_id, Referral.referred_id).distinct().count()
+    if pairs != distinct:
+        errors.append(f"{pairs - distinct} duplicate referral rows")
+    if pairs != expected_pairs:
+        errors.append(f"{pairs} referral rows, expected {expected_pairs}")
+
+    for user_id, tickets, referrals in session.query(User.id, User.ticket_count, User.referral_count):
+        expected = active.get(user_id, 0)
+        if tickets != expected * REFERRAL_TICKETS:
+            errors.append(f"user {user_id}: {tickets} tickets for {expected} referrals")
+        if referrals != expected:
+            errors.append(f"user {user_id}: referral_count {referrals}, expected {expected}")
+
+    ticket_sum = session.query(func.coalesce(func.sum(User.ticket_count), 0)).scalar()
+    total = session.query(Counter.value).filter(Counter.name == TICKET_TOTAL).scalar() or 0
+    if total != ticket_sum:
+        errors.append(f"ticket total counter {total}, sum of tickets {ticket_sum}")
+
+    ledger = dict(session.query(TicketLedger.user_id, func.sum(TicketLedger.delta)).filter(
+        TicketLedger.draw_id == draw_id
+    ).group_by(TicketLedger.user_id).all())
+    draw_tickets = dict(session.query(DrawTickets.user_id, DrawTickets.tickets).filter(
+        DrawTickets.draw_id == draw_id
+    ).all())
+    for user_id in set(ledger) | set(draw_tickets) | set(active):
+        expected = active.get(user_id, 0) * REFERRAL_TICKETS
+        if ledger.get(user_id, 0) != expected or draw_tickets.get(user_id, 0) != expected:
+            errors.append(f"user {user_id}: draw ledger {ledger.get(user_id, 0)}, "
+                          f"draw total {draw_tickets.get(user_id, 0)}, expected {expected}")
+
+    draw_total = get_counter(session, draw_total_counter(draw_id))
+    if draw_total != sum(draw_tickets.values()):
+        errors.append(f"draw total counter {draw_total}, sum of draw tickets {sum(draw_tickets.values())}")
+
+    return errors
+
+
+async def stress(users, referrals, duplicates, churn):
+    # Invited users are distinct, referrers are skewed like a real viral spike
+    referrers = list(range(1, users // 10 + 1))
+    weights = [1 / rank for rank in range(1, len(referrers) + 1)]
+    invited = random.sample(range(users // 10 + 1, users + 1), referrals)
+    pairs = [(random.choices(referrers, weights)[0], referred_id) for referred_id in invited]
+
+    calls = [pair for pair in pairs for _ in range(duplicates)]
+    random.shuffle(calls)
+    leavers = random.sample(invited, int(len(invited) * churn))
+
+    async def leave_and_return(referred_id, referrer_id):
+        await revoke_referrals(referred_id)
+        await process_referral(referrer_id, referred_id)
+
+    referrer_of = {referred_id: referrer_id for referrer_id, referred_id in pairs}
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(process_referral(referrer_id, referred_id) for referrer_id, referred_id in calls),
+        return_exceptions=True
+    )
+    credit_elapsed = time.perf_counter() - started
+
+    # Leaving and coming back mixed with more duplicate credits
+    churn_results = await asyncio.gather(
+        *(leave_and_return(referred_id, referrer_of[referred_id]) for referred_id in leavers),
+        *(process_referral(referrer_of[referred_id], referred_id) for referred_id in leavers),
+        return_exceptions=True
+    )
+    elapsed = time.perf_counter() - started
+
+    errors = [r for r in results + churn_results if isinstance(r, Exception)]
+    credited = sum(1 for r in results if r is True)
+    print(f"{len(calls)} referral calls for {len(pairs)} pairs in {credit_elapsed:.2f}s "
+          f"({len(calls) / credit_elapsed:.0f}/s), {credited} credited")
+    print(f"{len(leavers)} users left and came back, {elapsed:.2f}s in total")
+    if errors:
+        print(f"{len(errors)} calls failed, first: {errors[0]!r}")
+
+    problems = []
+    if errors:
+        problems.append(f"{len(errors)} calls raised")
+    if credited != len(pairs):
+        problems.append(f"{credited} referrals credited, expected {len(pairs)}")
+    return pairs, problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--referrals", type=int, default=5000, help="Distinct invited users")
+    parser.add_argument("--duplicates", type=int, default=3, help="Times every referral is submitted at once")
+    parser.add_argument("--churn", type=float, default=0.1, help="Share of invited users who leave and come back")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    init_db()
+    draw_id = seed(args.users)
+
+    pairs, problems = asyncio.run(stress(args.users, args.referrals, args.duplicates, args.churn))
+
+    session = session_factory()
+    problems += check_invariants(session, draw_id, len(pairs))
+    session.close()
+    close_db()
+
+    if problems:
+        for problem in problems[:20]:
+            print(f"  FAIL {problem}")
+        sys.exit(f"{len(problems)} invariant violations")
+    print("All invariants hold")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""Replay an update stream into the bot through a local fake Bot API server
+
+    python -m benchmarks.replay --starts 5000 --rate 2000             # viral spike, real speed
+    python -m benchmarks.replay --starts 5000 --rate 2000 --speed 4   # four times faster
+    python -m benchmarks.replay --record spike.jsonl --starts 5000    # save the generated stream
+    python -m benchmarks.replay --stream spike.jsonl --latency 0.05 --flood-limit 30
+
+bot.py runs in its own process against benchmarks.fake_api, on a database
+generated by benchmarks.fixtures (or --db). The generated stream is a spike
+of new users opening /start deep links of existing users, --rate a second,
+each sending /me and /top a little later. A stream file has one
+{"at": seconds, "update": {...}} per line and is replayed --speed times
+faster than recorded.
+
+Reported:
+- update to reply latency, from queueing an update to the first message
+  sent back to its chat, per command
+- how far the bot falls behind: the backlog of queued updates it has not
+  fetched yet, reply latency over the course of the replay and the time it
+  needed to answer everything after the last update was queued
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from benchmarks.fake_api import FakeBotAPI, add_arguments
+from benchmarks.suite import percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def message_update(user_id, text):
+    return {
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+            "text": text
+        }
+    }
+
+
+def generate_stream(starts, rate, existing_users, follow_up, encode, seed=1):
+    """[(seconds, update)] of new users arriving through links of existing ones, encode(user_id) gives their codes"""
+    rng = random.Random(seed)
+    stream = []
+    for k in range(starts):
+        user_id = existing_users + 1 + k
+        at = k / rate
+        stream.append((at, message_update(user_id, f"/start {encode(rng.randint(1, existing_users))}")))
+        stream.append((at + follow_up, message_update(user_id, "/me")))
+        stream.append((at + 2 * follow_up, message_update(user_id, "/top")))
+    stream.sort(key=lambda event: event[0])
+    return stream
+
+
+def load_stream(path):
+    with open(path) as f:
+        return [(event["at"], event["update"]) for event in map(json.loads, f) if event]
+
+
+def save_stream(stream, path):
+    with open(path, "w") as f:
+        for at, update in stream:
+            f.write(json.dumps({"at": round(at, 6), "update": update}) + "\n")
+
+
+def _command(update):
+    text = update.get("message", {}).get("text") or ""
+    return text.split()[0] if text.startswith("/") else next(iter(update), "other")
+
+
+def prepare_database(args):
+    """Path of the database the bot will use, its referral code secret is loaded for the generated stream"""
+    path = os.path.abspath(args.db) if args.db else os.path.join(tempfile.mkdtemp(), "replay.db")
+    # Must be set before config is imported
+    os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+    from db.database import engine, init_db, close_db
+    from benchmarks.fixtures import generate
+    from services.referral_codes import load_referral_code_secret
+
+    init_db()
+    load_referral_code_secret()
+    if not args.db:
+        print(f"Generated {generate(engine, args.users, args.seed)}")
+    close_db()
+    return path
+
+
+async def replay(api, stream, speed, drain, bot_process):
+    """Queue the updates on schedule, then wait for the answers. Returns the backlog samples"""
+    backlog = []
+    started = time.perf_counter()
+    for at, update in stream:
+        delay = started + at / speed - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        api.push(update)
+        backlog.append((time.perf_counter() - started, api.backlog()))
+
+    last_queued = time.perf_counter()
+    # Wait until every update got an answer, or for --drain seconds without progress
+    answered, idle_since = -1, time.perf_counter()
+    while len(api.answered_at) < len(api.queued_at) and bot_process.returncode is None:
+        if len(api.answered_at) != answered:
+            answered, idle_since = len(api.answered_at), time.perf_counter()
+        elif time.perf_counter() - idle_since > drain:
+            break
+        await asyncio.sleep(0.1)
+        backlog.append((time.perf_counter() - started, api.backlog()))
+    return started, last_queued, backlog
+
+
+def report(api, stream, started, last_queued, backlog, speed):
+    updates = {update_id: _command(update) for update_id, (_, update) in enumerate(stream, 1)}
+    latencies = defaultdict(list)
+    for update_id, answered_at in api.answered_at.items():
+        latencies[updates[update_id]].append(answered_at - api.queued_at[update_id])
+    all_latencies = [latency for values in latencies.values() for latency in values]
+
+    planned = stream[-1][0] / speed if stream else 0
+    print(f"\nQueued {len(api.queued_at)} updates in {last_queued - started:.1f}s (planned {planned:.1f}s), "
+          f"{len(api.answered_at)} answered, {len(api.queued_at) - len(api.answered_at)} unanswered, "
+          f"{api.unmatched_replies} replies without an update")
+
+    print("\nUpdate to reply latency:")
+    for command, values in sorted(latencies.items()) + [("all", all_latencies)]:
+        if values:
+            print(f"  {command:10} n={len(values):6}  p50={percentile(values, 50) * 1000:9.1f}ms  "
+                  f"p90={percentile(values, 90) * 1000:9.1f}ms  p99={percentile(values, 99) * 1000:9.1f}ms  "
+                  f"max={max(values) * 1000:9.1f}ms")
+
+    fetch_lags = [api.fetched_at[i] - api.queued_at[i] for i in api.fetched_at]
+    if fetch_lags:
+        print(f"\nFetched by getUpdates after p50={percentile(fetch_lags, 50) * 1000:.1f}ms "
+              f"p99={percentile(fetch_lags, 99) * 1000:.1f}ms max={max(fetch_lags) * 1000:.1f}ms, "
+              f"largest backlog {max(size for _, size in backlog)} updates")
+
+    # Latency by when the update was queued shows whether the bot keeps up or falls further behind
+    if all_latencies:
+        end = max(api.queued_at.values()) - started
+        windows = 10
+        buckets = defaultdict(list)
+        for update_id, answered_at in api.answered_at.items():
+            queued = api.queued_at[update_id] - started
+            buckets[min(windows - 1, int(queued / end * windows)) if end else 0].append(answered_at - api.queued_at[update_id])
+        print("\nLatency by time queued:")
+        for window in range(windows):
+            values = buckets.get(window)
+            if values:
+                print(f"  {end * window / windows:7.1f}s+  n={len(values):6}  p50={percentile(values, 50) * 1000:9.1f}ms  "
+                      f"max={max(values) * 1000:9.1f}ms")
+
+    if api.answered_at:
+        print(f"\nLast answer {max(api.answered_at.values()) - last_queued:.1f}s after the last update was queued")
+    print(f"Bot API calls: {api.calls}")
+    if api.errors:
+        print(f"429 responses: {dict(api.errors)}")
+
+    return {
+        "queued": len(api.queued_at),
+        "answered": len(api.answered_at),
+        "latency_ms": {
+            command: {"p50": round(percentile(values, 50) * 1000, 1), "p99": round(percentile(values, 99) * 1000, 1),
+                      "max": round(max(values) * 1000, 1)}
+            for command, values in list(latencies.items()) + [("all", all_latencies)] if values
+        },
+        "max_backlog": max((size for _, size in backlog), default=0),
+        "calls": dict(api.calls),
+        "errors_429": dict(api.errors)
+    }
+
+
+async def run(args, stream, database):
+    api = FakeBotAPI(args.latency, args.error_rate, args.flood_limit, args.retry_after, args.member_share, args.seed)
+    url = await api.start()
+
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{database}", TELEGRAM_API_URL=url,
+               BOT_MODE="polling", WORKER_PROCESSES="1", METRICS_PORT="0")
+    log = open(args.bot_log, "w")
+    bot_process = await asyncio.create_subprocess_exec(sys.executable, os.path.join(ROOT, "bot.py"), cwd=ROOT,
+                                                       env=env, stdout=log, stderr=subprocess.STDOUT)
+    print(f"Bot started, its log is in {args.bot_log}")
+    try:
+        await asyncio.wait_for(api.polling.wait(), 60)
+        started, last_queued, backlog = await replay(api, stream, args.speed, args.drain, bot_process)
+    finally:
+        if bot_process.returncode is None:
+            bot_process.send_signal(signal.SIGTERM)
+            try:
+                await asyncio.wait_for(bot_process.wait(), 30)
+            except asyncio.TimeoutError:
+                bot_process.kill()
+        log.close()
+        await api.stop()
+    return report(api, stream, started, last_queued, backlog, args.speed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000, help="Existing users in the generated database, or in --db")
+    parser.add_argument("--db", help="Use a database made by benchmarks.fixtures, the replay changes it")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--stream", help="Replay this stream file instead of generating one")
+    parser.add_argument("--record", help="Save the generated stream to this file")
+    parser.add_argument("--starts", type=int, default=2000, help="New users in the generated stream")
+    parser.add_argument("--rate", type=float, default=1000, help="New users a second in the generated stream")
+    parser.add_argument("--follow-up", type=float, default=2.0, help="Seconds from /start to /me and from /me to /top")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay this many times faster than the stream")
+    parser.add_argument("--drain", type=float, default=30.0, help="Seconds to wait for answers that stopped coming")
+    parser.add_argument("--bot-log", default=os.path.join(tempfile.gettempdir(), "replay-bot.log"))
+    parser.add_argument("--save", help="Write the summary to this JSON file")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    database = prepare_database(args)
+    if args.stream:
+        stream = load_stream(args.stream)
+    else:
+        from services.referral_codes import referral_codes
+        stream = generate_stream(args.starts, args.rate, args.users, args.follow_up, referral_codes.encode, args.seed)
+    if args.record:
+        save_stream(stream, args.record)
+        print(f"Saved {len(stream)} updates to {args.record}")
+
+    summary = asyncio.run(run(args, stream, database))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
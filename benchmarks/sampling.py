@@ -0,0 +1,56 @@
+"""Benchmark winner selection: WeightedSampler vs. random.choices
+
+    python -m benchmarks.sampling                  # 10k, 1M and 10M participants
+    python -m benchmarks.sampling --sizes 10000 --winners 100
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from services.sampling import WeightedSampler
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench(size, winners, repeat, baseline_limit):
+    rng = np.random.default_rng(size)
+    ids = np.arange(1, size + 1, dtype=np.int64)
+    weights = rng.integers(1, 50, size=size, dtype=np.int64)
+
+    sampler, build = timed(WeightedSampler, ids, weights)
+    _, single = timed(lambda: [sampler.sample(1, seed=i) for i in range(repeat)])
+    _, multi = timed(sampler.sample, winners, seed=0)
+
+    print(f"{size:>10,} participants, {sampler.total:,} tickets")
+    print(f"    build:               {build * 1000:10.2f} ms")
+    print(f"    1 winner:            {single / repeat * 1000:10.3f} ms per draw")
+    print(f"    {winners} distinct winners: {multi * 1000:10.3f} ms")
+
+    if size <= baseline_limit:
+        # What end_draw used to do: build Python lists and call random.choices
+        id_list, weight_list = ids.tolist(), weights.tolist()
+        _, choices = timed(lambda: [random.choices(id_list, weights=weight_list, k=1) for _ in range(repeat)])
+        print(f"    random.choices:      {choices / repeat * 1000:10.3f} ms per draw (1 winner, with replacement)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 1_000_000, 10_000_000])
+    parser.add_argument("--winners", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=20, help="Single-winner draws per size")
+    parser.add_argument("--baseline-limit", type=int, default=1_000_000,
+                        help="Largest size to also time random.choices on")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        bench(size, args.winners, args.repeat, args.baseline_limit)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""Drive the draw scheduler with fake time and check when it ends draws
+
+    python -m benchmarks.scheduler_check
+
+The scheduler loop runs with a fake clock and a fake sleep: time only moves
+when the check lets a sleep run out, so hours of schedule take no time and
+every step is deterministic. Checked:
+
+- a draw is ended once its deadline passes, not before
+- create_draw and cancel_draw wake the sleeping loop, which then sleeps
+  until the new earliest deadline
+- rescheduled and unscheduled draws leave outdated heap entries that are
+  dropped lazily and never fire
+- a draw postponed with retry_later() keeps its retry deadline when the
+  schedule is reloaded from the database
+"""
+import asyncio
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+# Use a throwaway database, must be set before config is imported
+_db_path = os.path.join(tempfile.mkdtemp(), "scheduler.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{_db_path}"
+
+from db.database import init_db, close_db  # noqa: E402
+from services.draw_manager import create_draw, cancel_draw  # noqa: E402
+from services.scheduler import DrawScheduler, draw_scheduler  # noqa: E402
+
+WEEK = 7 * 24 * 3600
+
+
+class FakeTime:
+    """Clock and sleep for the scheduler, a sleep only ends when elapse() is called or the loop is woken"""
+
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = []  # Timeouts the loop asked for, in order
+        self._seen = 0  # Sleeps already returned by asleep()
+        self._sleeping = None  # Future of the latest sleep, resolved by elapse()
+        self._new_sleep = asyncio.Event()
+
+    def clock(self):
+        return self.now
+
+    async def sleep(self, timeout):
+        self.sleeps.append(timeout)
+        self._sleeping = asyncio.get_running_loop().create_future()
+        self._new_sleep.set()
+        await self._sleeping
+        self.now += timedelta(seconds=timeout)
+
+    async def asleep(self):
+        """Wait until the loop starts another sleep, returns how long it wants to sleep"""
+        while len(self.sleeps) <= self._seen:
+            self._new_sleep.clear()
+            await asyncio.wait_for(self._new_sleep.wait(), 5)
+        self._seen = len(self.sleeps)
+        return self.sleeps[-1]
+
+    async def elapse(self):
+        """Let the latest sleep run out, the clock moves by its timeout"""
+        self._sleeping.set_result(None)
+        # Let the loop get past the sleep
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+
+class Check:
+    def __init__(self):
+        self.failures = []
+
+    def equal(self, name, actual, expected):
+        if actual != expected:
+            self.failures.append(f"{name}: {actual!r}, expected {expected!r}")
+
+    def close_to(self, name, actual, expected, tolerance=5):
+        if abs(actual - expected) > tolerance:
+            self.failures.append(f"{name}: {actual!r}, expected about {expected!r}")
+
+
+async def start(scheduler, fake):
+    ended = []
+
+    async def on_due(draw_ids):
+        ended.append((fake.now, draw_ids))
+
+    stop_event = asyncio.Event()
+    task = asyncio.create_task(scheduler.run(on_due, stop_event))
+    return ended, stop_event, task
+
+
+async def stop(stop_event, task):
+    stop_event.set()
+    await asyncio.wait_for(task, 5)
+
+
+async def deadline_fires(check):
+    start_time = datetime(2030, 1, 1)
+    fake = FakeTime(start_time)
+    scheduler = DrawScheduler(clock=fake.clock, max_sleep=WEEK, sleep=fake.sleep)
+    scheduler.schedule(1, start_time + timedelta(minutes=10))
+    scheduler.schedule(2, start_time + timedelta(minutes=30))
+    ended, stop_event, task = await start(scheduler, fake)
+
+    check.equal("first sleep", await fake.asleep(), 600)
+    check.equal("nothing ended early", ended, [])
+    await fake.elapse()
+    check.equal("draw 1 ended at its deadline", ended, [(start_time + timedelta(minutes=10), [1])])
+    check.equal("sleep until draw 2", await fake.asleep(), 1200)
+    await fake.elapse()
+    check.equal("draw 2 ended", [ids for _, ids in ended], [[1], [2]])
+    check.equal("idle sleep after the last draw", await fake.asleep(), WEEK)
+    await stop(stop_event, task)
+
+
+async def create_and_cancel_wake_the_loop(check):
+    # The module scheduler is the one create_draw and cancel_draw talk to
+    fake = FakeTime(datetime.utcnow())
+    draw_scheduler.clock = fake.clock
+    draw_scheduler.sleep = fake.sleep
+    draw_scheduler.max_sleep = WEEK
+    ended, stop_event, task = await start(draw_scheduler, fake)
+
+    check.equal("empty schedule sleeps the maximum", await fake.asleep(), WEEK)
+    later = await create_draw("Later", "Prize", days_duration=2)
+    check.close_to("create_draw woke the loop", await fake.asleep(), 2 * 86400)
+    sooner = await create_draw("Sooner", "Prize", days_duration=1)
+    check.close_to("an earlier draw shortens the sleep", await fake.asleep(), 86400)
+    await cancel_draw(sooner["id"])
+    check.close_to("cancel_draw goes back to the later deadline", await fake.asleep(), 2 * 86400)
+    check.equal("sleeps so far", len(fake.sleeps), 4)
+
+    await fake.elapse()
+    check.equal("only the remaining draw ended", [ids for _, ids in ended], [[later["id"]]])
+    await stop(stop_event, task)
+
+
+async def lazy_deletion(check):
+    now = datetime(2030, 1, 1)
+    scheduler = DrawScheduler(clock=lambda: now, max_sleep=WEEK)
+    scheduler.schedule(1, now + timedelta(hours=1))
+    scheduler.schedule(2, now + timedelta(hours=2))
+    scheduler.schedule(1, now + timedelta(hours=3))  # Moved, the 1 hour entry is outdated
+    scheduler.schedule(3, now + timedelta(minutes=30))
+    scheduler.unschedule(3)
+    check.equal("outdated entries stay in the heap", len(scheduler._heap), 4)
+
+    check.equal("next deadline skips outdated entries", scheduler.next_deadline(), now + timedelta(hours=2))
+    check.equal("outdated entries before it were dropped", len(scheduler._heap), 2)
+    check.equal("unscheduled and moved draws don't fire", scheduler.pop_due(now + timedelta(hours=2, minutes=30)), [2])
+    check.equal("moved draw fires at its new deadline", scheduler.pop_due(now + timedelta(hours=3)), [1])
+    check.equal("heap is empty", (scheduler._heap, scheduler._deadlines), ([], {}))
+
+
+async def postponed_draw_waits(check):
+    fake = FakeTime(datetime.utcnow())
+    scheduler = DrawScheduler(clock=fake.clock, max_sleep=WEEK, sleep=fake.sleep)
+    draw = await create_draw("Postponed", "Prize", days_duration=0, schedule=False)
+    scheduler.schedule(draw["id"], fake.now - timedelta(minutes=1))
+    check.equal("the draw is due", scheduler.pop_due(), [draw["id"]])
+
+    scheduler.retry_later(draw["id"], 600)
+    await scheduler.load()
+    check.equal("the retry deadline survives a reload", scheduler.next_deadline(), fake.now + timedelta(seconds=600))
+    check.equal("not due before the retry delay", scheduler.pop_due(), [])
+    await cancel_draw(draw["id"])
+
+
+async def main():
+    init_db()
+    check = Check()
+    for scenario in (deadline_fires, create_and_cancel_wake_the_loop, lazy_deletion, postponed_draw_waits):
+        before = len(check.failures)
+        try:
+            await scenario(check)
+        except asyncio.TimeoutError:
+            check.failures.append(f"{scenario.__name__}: the loop never slept or woke up as expected")
+        print(f"{scenario.__name__:35} {'ok' if len(check.failures) == before else 'FAIL'}")
+    close_db()
+
+    for failure in check.failures:
+        print(f"  FAIL {failure}")
+    if check.failures:
+        sys.exit(f"{len(check.failures)} checks failed")
+    print("All scheduler checks pass")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
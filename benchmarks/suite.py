@@ -0,0 +1,248 @@
+"""Benchmark the hot services and handlers on a synthetic database
+
+    python -m benchmarks.suite --users 100000
+    python -m benchmarks.suite --users 100000 --save benchmarks/baselines/100k.json
+    python -m benchmarks.suite --users 100000 --compare benchmarks/baselines/100k.json
+
+Operations:
+- referral_stats: services.referral.get_referral_stats of random users
+- cmd_top: handlers.stats.cmd_top, the leaderboard rendered and answered
+- cmd_start: /start deep links of new users fed through the dispatcher
+- end_draw: services.draw_manager.end_draw of a draw holding everybody's tickets
+
+The database comes from benchmarks.fixtures, Telegram from
+benchmarks.fake_bot with --latency seconds per request. Every operation is
+run once under tracemalloc for its peak memory and once for the timings,
+which tracemalloc would slow down. --compare exits with an error when an
+operation got slower than the baseline by more than --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Operation:
+    """prepare(i) builds the input of run i outside of the timing, run(i, prepared) is timed"""
+
+    def __init__(self, name, run, iterations, concurrency=1, prepare=None):
+        self.name = name
+        self.run = run
+        self.iterations = iterations
+        self.concurrency = concurrency
+        self.prepare = prepare
+        self._next = 0
+
+    async def _run_many(self, count):
+        latencies = []
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def one(i):
+            prepared = await self.prepare(i) if self.prepare else None
+            async with semaphore:
+                start = time.perf_counter()
+                await self.run(i, prepared)
+                latencies.append(time.perf_counter() - start)
+
+        first, self._next = self._next, self._next + count
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(first, first + count)))
+        return latencies, time.perf_counter() - started
+
+    async def measure(self):
+        tracemalloc.start()
+        await self._run_many(max(1, self.iterations // 10))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        latencies, elapsed = await self._run_many(self.iterations)
+        # Time spent preparing inputs is left out of the throughput
+        busy = min(elapsed, sum(latencies) / self.concurrency) if self.prepare else elapsed
+        return {
+            "iterations": self.iterations,
+            "throughput": round(self.iterations / busy, 2),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+            "peak_mb": round(peak / 1024 / 1024, 2)
+        }
+
+
+def build_operations(users, scale):
+    from aiogram.types import Message, Update
+
+    from bot import create_dispatcher
+    from handlers.stats import cmd_top
+    from instance import bot
+    from services.draw_manager import create_draw, end_draw
+    from services.referral import get_referral_stats
+    from services.referral_codes import referral_codes
+
+    rng = random.Random(1)
+    dp = create_dispatcher()
+
+    def message(i, user_id, text):
+        return {
+            "message_id": i + 1,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "text": text
+        }
+
+    async def referral_stats(i, prepared):
+        await get_referral_stats(rng.randint(1, users))
+
+    async def top(i, prepared):
+        user_id = rng.randint(1, users)
+        await cmd_top(Message.model_validate(message(i, user_id, "/top"), context={"bot": bot}))
+
+    async def start(i, prepared):
+        # New users arriving through the link of an existing one
+        user_id = users + 1 + i
+        code = referral_codes.encode(rng.randint(1, users))
+        update = Update.model_validate({"update_id": i + 1, "message": message(i, user_id, f"/start {code}")},
+                                       context={"bot": bot})
+        await dp.feed_update(bot, update)
+
+    async def new_draw(i):
+        draw = await create_draw(f"Benchmark {i}", "Prize", 7, carry_over=True)
+        return draw["id"]
+
+    async def finish_draw(i, draw_id):
+        await end_draw(draw_id)
+
+    return [
+        Operation("referral_stats", referral_stats, 2000 * scale, concurrency=8),
+        Operation("cmd_top", top, 2000 * scale, concurrency=8),
+        Operation("cmd_start", start, 1000 * scale, concurrency=8),
+        Operation("end_draw", finish_draw, 20 * scale, prepare=new_draw),
+    ]
+
+
+async def run_suite(users, scale, latency):
+    from db.database import run_db
+    from db.models import User
+    from instance import bot
+    from services.leaderboard import load_leaderboard
+    from benchmarks.fake_bot import FakeSession
+
+    bot.session = FakeSession(latency=latency)
+    await load_leaderboard()
+
+    def refresh_member_checks(session):
+        # Stored checks count as fresh, like right after a /verify run
+        session.query(User).filter(User.member_checked_at.isnot(None)).update(
+            {User.member_checked_at: datetime.utcnow()}, synchronize_session=False
+        )
+    await run_db(refresh_member_checks)
+
+    results = {}
+    for operation in build_operations(users, scale):
+        results[operation.name] = await operation.measure()
+        result = results[operation.name]
+        print(f"{operation.name:15} {result['throughput']:10.1f}/s  p50={result['p50_ms']:9.3f}ms  "
+              f"p99={result['p99_ms']:9.3f}ms  peak={result['peak_mb']:7.2f}MB")
+    print(f"Bot API calls: {dict(bot.session.calls)}")
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Print the change against a baseline, returns the operations that regressed"""
+    regressions = []
+    print(f"\nCompared with {baseline['meta'].get('commit')} ({baseline['meta'].get('created_at')}):")
+    for name, result in results.items():
+        before = baseline["results"].get(name)
+        if not before:
+            print(f"  {name:15} new")
+            continue
+        p50 = result["p50_ms"] / before["p50_ms"] - 1 if before["p50_ms"] else 0
+        throughput = result["throughput"] / before["throughput"] - 1 if before["throughput"] else 0
+        regressed = p50 > tolerance or throughput < -tolerance
+        print(f"  {name:15} p50 {p50:+7.1%}  throughput {throughput:+7.1%}{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000, help="Users in the generated database (10k to 5M)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db", help="Reuse a database made by benchmarks.fixtures instead of generating one")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds every fake Bot API request takes")
+    parser.add_argument("--scale", type=int, default=1, help="Multiplies the iterations of every operation")
+    parser.add_argument("--save", help="Write the results to this baseline file")
+    parser.add_argument("--compare", help="Compare with this baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="Allowed slowdown before it counts as a regression")
+    args = parser.parse_args()
+
+    # Must be set before config is imported, the database is changed by the benchmark
+    path = args.db or os.path.join(tempfile.mkdtemp(), "suite.db")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.abspath(path)}"
+    os.environ.setdefault("METRICS_PORT", "0")
+
+    from db.database import engine, init_db, close_db
+    from benchmarks.fixtures import generate
+    from services.referral_codes import load_referral_code_secret
+
+    init_db()
+    load_referral_code_secret()
+    if not args.db:
+        started = time.perf_counter()
+        summary = generate(engine, args.users, args.seed)
+        print(f"Generated {summary} in {time.perf_counter() - started:.1f}s")
+    users = engine.execute("SELECT MAX(id) FROM users").scalar() if args.db else args.users
+
+    results = asyncio.run(run_suite(users, args.scale, args.latency))
+    close_db()
+
+    report = {
+        "meta": {
+            "users": users,
+            "seed": args.seed,
+            "latency": args.latency,
+            "scale": args.scale,
+            "commit": _commit(),
+            "python": platform.python_version(),
+            "created_at": datetime.now().isoformat(timespec="seconds")
+        },
+        "results": results
+    }
+    if args.save:
+        os.makedirs(os.path.dirname(args.save) or ".", exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["meta"].get("users") != users:
+            print(f"Warning: the baseline was run with {baseline['meta'].get('users')} users")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            sys.exit(f"Slower than the baseline: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
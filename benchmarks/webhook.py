@@ -0,0 +1,128 @@
+"""Post fake Telegram updates to the webhook server and measure acknowledgement latency
+
+    python -m benchmarks.webhook                              # local server, dummy handler
+    python -m benchmarks.webhook --updates 5000 --handler-ms 20 --queue-size 50
+    python -m benchmarks.webhook --url http://127.0.0.1:8080/webhook --secret ...
+
+Without --url a WebhookServer is started on a free port with a handler that
+only sleeps, so no request reaches Telegram. It also checks that updates of
+each user were handled in the order they were posted.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import ClientSession, web
+from aiogram import Bot, Dispatcher, Router
+from aiogram.types import Message
+
+from services.webhook import SECRET_HEADER, WebhookServer
+
+
+def fake_update(update_id, user_id, text="/start"):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+            "text": text
+        }
+    }
+
+
+async def post_updates(url, secret, total, users, concurrency):
+    """Post updates, returns ack latencies and response statuses"""
+    latencies, statuses = [], Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def post(session, update_id):
+        async with semaphore:
+            start = time.perf_counter()
+            async with session.post(url, json=fake_update(update_id, update_id % users + 1),
+                                    headers={SECRET_HEADER: secret}) as response:
+                await response.read()
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status] += 1
+
+    async with ClientSession() as session:
+        await asyncio.gather(*(post(session, update_id) for update_id in range(1, total + 1)))
+        # A request with a wrong secret must be refused
+        async with session.post(url, json=fake_update(0, 1), headers={SECRET_HEADER: "wrong"}) as response:
+            statuses[f"wrong secret -> {response.status}"] += 1
+
+    return latencies, statuses
+
+
+def report(latencies, statuses, elapsed):
+    latencies = sorted(latencies)
+    print(f"posted {len(latencies)} updates in {elapsed:.2f} s ({len(latencies) / elapsed:.0f}/s)")
+    print(f"    ack p50: {statistics.median(latencies) * 1000:.2f} ms, "
+          f"p99: {latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f} ms")
+    print(f"    responses: {dict(statuses)}")
+
+
+async def run_local(args):
+    handled = defaultdict(list)
+    router = Router()
+
+    @router.message()
+    async def handler(message: Message):
+        await asyncio.sleep(args.handler_ms / 1000)
+        handled[message.from_user.id].append(message.message_id)
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    bot = Bot("42:fake-token")
+    server = WebhookServer(dp, bot, secret="local-secret", workers=args.workers, queue_size=args.queue_size,
+                           enqueue_timeout=args.enqueue_timeout)
+    server.start_workers()
+
+    runner = web.AppRunner(server.app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    port = runner.addresses[0][1]
+
+    start = time.perf_counter()
+    latencies, statuses = await post_updates(
+        f"http://127.0.0.1:{port}{server.path}", "local-secret", args.updates, args.users, args.concurrency
+    )
+    report(latencies, statuses, time.perf_counter() - start)
+
+    await runner.cleanup()
+    await server.stop()
+    print(f"    drained after {time.perf_counter() - start:.2f} s")
+    print(f"    server: {server.stats()}")
+
+    in_order = all(ids == sorted(ids) for ids in handled.values())
+    print(f"    per-user order kept: {in_order}")
+    await bot.session.close()
+
+
+async def run_remote(args):
+    start = time.perf_counter()
+    latencies, statuses = await post_updates(args.url, args.secret, args.updates, args.users, args.concurrency)
+    report(latencies, statuses, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="Webhook of a running bot, a local server is started without it")
+    parser.add_argument("--secret", default="", help="Secret token of the running bot")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50, help="Requests in flight, like Telegram's max_connections")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--queue-size", type=int, default=100)
+    parser.add_argument("--enqueue-timeout", type=float, default=1.0, help="Seconds to wait for room in a full queue")
+    parser.add_argument("--handler-ms", type=float, default=5, help="Time the dummy handler takes per update")
+    args = parser.parse_args()
+
+    asyncio.run(run_remote(args) if args.url else run_local(args))
+
+
+if __name__ == "__main__":
+    main()
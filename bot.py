@@ -2,15 +2,26 @@ import asyncio
 import logging
 import signal
 from aiogram import Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from datetime import datetime
 
-from config import BOT_TOKEN, LOG_LEVEL
-from db.database import init_db, close_db
+from config import BOT_TOKEN, BOT_MODE, CHANNEL_ID, LOG_LEVEL, SCHEDULER_RETRY_DELAY, METRICS_HOST, METRICS_PORT
+from db.database import init_db, close_db, get_pool_stats
 from instance import bot
 from middlewares.channel_join import ChannelJoinMiddleware
 from middlewares.error_handler import ErrorHandlerMiddleware
+from middlewares.metrics import HandlerMetricsMiddleware
+from middlewares.throttling import ThrottlingMiddleware
+from services.broadcast import resume_broadcasts
 from services.draw_manager import check_scheduled_draws
+from services.fsm_storage import create_storage
+from services.leaderboard import load_leaderboard
+from services.membership import membership
+from services.metrics import metrics, MetricsServer
+from services.outbox import outbox, PRIORITY_CHANNEL
+from services.referral_codes import referral_codes, load_referral_code_secret
+from services.scheduler import draw_scheduler
+from services.webhook import WebhookServer
+from services.write_buffer import write_buffer
 from utils.logger import setup_logger
 
 # Configure logging
@@ -19,64 +30,92 @@ logger = setup_logger("bot", LOG_LEVEL)
 # Global shutdown flag
 shutdown_event = asyncio.Event()
 
-# Scheduler task
-async def scheduled_tasks():
-    check_interval = 3600  # Default: check every hour
+# Called by the scheduler when draws reach their scheduled end
+async def end_due_draws(draw_ids):
+    # End the draws the scheduler found due, not every draw past its end
+    results = await check_scheduled_draws(draw_ids)
     
-    while not shutdown_event.is_set():
-        try:
-            # Check for draws that need to be ended
-            results = await check_scheduled_draws()
+    # Announce winners for completed draws
+    if results:
+        for result in results:
+            if result.get("status") in ("pending", "error"):
+                # Verification failed for some users or the draw broke, finish it later
+                logger.warning(f"Draw #{result['draw_id']} postponed: {result['message']}")
+                draw_scheduler.retry_later(result["draw_id"], SCHEDULER_RETRY_DELAY)
+                continue
+            
+            if "message" in result:
+                logger.info(f"Draw {result.get('draw_id', 'unknown')} completed: {result['message']}")
+                continue
+            
+            logger.info(f"Draw #{result['draw_id']} completed, winner: {result['winner_id']}")
+            
+            # Format winner announcement
+            win_chance_formatted = f"{result['win_chance']:.2f}%"
+            
+            # Include eligibility stats for logs
+            eligibility_info = ""
+            eligibility_log = ""
+            if "eligible_users_count" in result and "total_users_count" in result:
+                eligibility_info = f"👥 Учасників розіграшу: <b>{result['eligible_users_count']}</b> з {result['total_users_count']} (активні учасники каналу)\n"
+                eligibility_log = f"Eligible users: {result['eligible_users_count']} of {result['total_users_count']}"
+            
+            logger.info(f"Draw #{result['draw_id']} completed. {eligibility_log}")
             
-            # Announce winners for completed draws
-            if results:
-                for result in results:
-                    if "message" in result:
-                        logger.info(f"Draw {result.get('draw_id', 'unknown')} completed: {result['message']}")
-                        continue
-                    
-                    logger.info(f"Draw #{result['draw_id']} completed, winner: {result['winner_id']}")
-                    
-                    # Format winner announcement
-                    win_chance_formatted = f"{result['win_chance']:.2f}%"
-                    
-                    # Include eligibility stats for logs
-                    eligibility_info = ""
-                    eligibility_log = ""
-                    if "eligible_users_count" in result and "total_users_count" in result:
-                        eligibility_info = f"👥 Учасників розіграшу: <b>{result['eligible_users_count']}</b> з {result['total_users_count']} (активні учасники каналу)\n"
-                        eligibility_log = f"Eligible users: {result['eligible_users_count']} of {result['total_users_count']}"
-                    
-                    logger.info(f"Draw #{result['draw_id']} completed. {eligibility_log}")
-                    
-                    winner_text = (
-                        f"🎉 <b>Розіграш автоматично завершено!</b>\n\n"
-                        f"🏆 Розіграш: <b>{result['draw_name']}</b>\n"
-                        f"👑 Переможець: "
-                        f"{'@' + result['winner_username'] if result['winner_username'] else 'Учасник'}\n"
-                        f"🆔 ID: <code>{result['winner_id']}</code>\n"
-                        f"🎟 Кількість квитків: <b>{result['winner_tickets']}</b>\n"
-                        f"🎯 Шанс на перемогу: <b>{win_chance_formatted}</b>\n"
-                        f"🏆 Загальна кількість квитків: <b>{result['total_tickets']}</b>\n\n"
-                        f"🎁 Приз: <b>{result['prize']}</b>"
-                    )
-                    
-                    # Send winner announcement to channel
-                    try:
-                        from config import CHANNEL_ID
-                        await bot.send_message(CHANNEL_ID, winner_text)
-                        logger.info(f"Winner announcement sent to channel for draw #{result['draw_id']}")
-                    except Exception as e:
-                        logger.error(f"Error sending winner announcement: {e}", exc_info=True)
+            winner_text = (
+                f"🎉 <b>Розіграш автоматично завершено!</b>\n\n"
+                f"🏆 Розіграш: <b>{result['draw_name']}</b>\n"
+                f"👑 Переможець: "
+                f"{'@' + result['winner_username'] if result['winner_username'] else 'Учасник'}\n"
+                f"🆔 ID: <code>{result['winner_id']}</code>\n"
+                f"🎟 Кількість квитків: <b>{result['winner_tickets']}</b>\n"
+                f"🎯 Шанс на перемогу: <b>{win_chance_formatted}</b>\n"
+                f"🏆 Загальна кількість квитків: <b>{result['total_tickets']}</b>\n\n"
+                f"🎁 Приз: <b>{result['prize']}</b>"
+            )
             
-        except Exception as e:
-            logger.error(f"Error in scheduler: {e}", exc_info=True)
-        
-        # Wait for next check interval or until shutdown is requested
-        try:
-            await asyncio.wait_for(shutdown_event.wait(), timeout=check_interval)
-        except asyncio.TimeoutError:
-            pass  # Normal timeout, continue with the next iteration
+            # Queue winner announcement for the channel, it survives a crash once stored
+            try:
+                await outbox.enqueue(CHANNEL_ID, winner_text, PRIORITY_CHANNEL)
+                logger.info(f"Winner announcement queued for draw #{result['draw_id']}")
+            except Exception as e:
+                logger.error(f"Error queueing winner announcement: {e}", exc_info=True)
+
+# Scheduler task
+async def scheduled_tasks():
+    # Sleep until the next draw deadline, create_draw/cancel_draw wake the scheduler up
+    await draw_scheduler.load()
+    await draw_scheduler.run(end_due_draws, shutdown_event)
+
+def register_collectors():
+    """Expose counters kept by the services on /metrics"""
+    metrics.collect("membership_cache_total", "Channel membership lookups by cache result",
+                    lambda: {k: membership.stats()[k] for k in ("hits", "misses", "coalesced")},
+                    type="counter", label="result")
+    metrics.collect("referral_code_lookups_total", "Referral code resolutions by cache result",
+                    lambda: {k: referral_codes.stats()[k] for k in ("hits", "misses", "rejected")},
+                    type="counter", label="result")
+    metrics.collect("outbox_messages_total", "Queued messages by outcome", outbox.stats, type="counter", label="outcome")
+    metrics.collect("write_buffer_queued", "Writes waiting for the next batch", lambda: write_buffer.stats()["queued"])
+    metrics.collect("write_buffer_batches_total", "Batches committed by the write buffer",
+                    lambda: write_buffer.stats()["batches"], type="counter")
+    metrics.collect("db_pool_checked_out", "Database connections in use", lambda: get_pool_stats()["checked_out"])
+    metrics.collect("db_pool_timeouts_total", "Waits for a database connection that timed out",
+                    lambda: get_pool_stats()["timeouts"], type="counter")
+
+async def start_metrics_server(port=METRICS_PORT):
+    """Serve /metrics on the local address, returns None when turned off"""
+    if not port:
+        return None
+    register_collectors()
+    server = MetricsServer(host=METRICS_HOST, port=port)
+    try:
+        await server.start()
+    except OSError as e:
+        # A busy port must not keep the bot from starting
+        logger.error(f"Could not start the metrics server: {e}")
+        return None
+    return server
 
 async def shutdown(dispatcher: Dispatcher):
     """Graceful shutdown function"""
@@ -88,30 +127,56 @@ async def shutdown(dispatcher: Dispatcher):
     # Close bot session
     await bot.session.close()
     
+    # Commit buffered registrations and referrals
+    await write_buffer.close()
+    
     # Close DB connections
     close_db()
     
     logger.info("Shutdown complete")
 
-async def main():
+def create_dispatcher():
     # Initialize dispatcher with storage
-    dp = Dispatcher(storage=MemoryStorage())
+    dp = Dispatcher(storage=create_storage())
     
-    # Register middlewares
-    dp.message.middleware(ChannelJoinMiddleware())
+    # Register middlewares, throttling first so dropped updates cost no API or DB calls
+    throttling = ThrottlingMiddleware()
+    metrics.collect("throttled_updates_total", "Updates dropped by the rate limit", lambda: dict(throttling.shed),
+                    type="counter", label="command")
+    dp.message.middleware(throttling)
+    dp.callback_query.middleware(throttling)
+    
+    # Errors are caught outside the handler timing, which would record every failed handler as "ok" otherwise
     dp.message.middleware(ErrorHandlerMiddleware())
     dp.callback_query.middleware(ErrorHandlerMiddleware())
     
+    # Handler timing covers the membership check and the handler itself
+    handler_metrics = HandlerMetricsMiddleware()
+    dp.message.middleware(handler_metrics)
+    dp.callback_query.middleware(handler_metrics)
+    dp.chat_member.middleware(handler_metrics)
+    
+    dp.message.middleware(ChannelJoinMiddleware())
+    
     # Import routers here to avoid circular imports
-    from handlers import admin, common, stats
+    from handlers import admin, channel, common, stats
     
     # Register routers
+    dp.include_router(channel.router)
     dp.include_router(common.router)
     dp.include_router(stats.router)
     dp.include_router(admin.router)
     
+    return dp
+
+async def main():
+    dp = create_dispatcher()
+    
     # Initialize database
     init_db()
+    load_referral_code_secret()
+    await load_leaderboard()
+    await resume_broadcasts()
     
     # Set bot commands
     await set_commands()
@@ -119,18 +184,40 @@ async def main():
     # Setup signal handlers for graceful shutdown
     loop = asyncio.get_running_loop()
     for sig in (signal.SIGINT, signal.SIGTERM):
-        loop.add_signal_handler(sig, lambda: asyncio.create_task(shutdown(dp)))
+        loop.add_signal_handler(sig, shutdown_event.set)
+    
+    metrics_server = await start_metrics_server()
     
-    # Start the scheduler task
+    # Start the scheduler and the outgoing message sender
     scheduler_task = asyncio.create_task(scheduled_tasks())
+    outbox_task = asyncio.create_task(outbox.run(shutdown_event))
+    
+    # chat_member updates are not delivered unless requested explicitly
+    allowed_updates = dp.resolve_used_update_types()
     
     try:
-        # Start polling
-        logger.info("Starting bot")
-        await dp.start_polling(bot, skip_updates=True)
+        if BOT_MODE == "webhook":
+            logger.info("Starting bot in webhook mode")
+            server = WebhookServer(dp, bot)
+            await server.start(allowed_updates=allowed_updates)
+            try:
+                await shutdown_event.wait()
+            finally:
+                # Handle what is already queued before closing the bot session
+                await server.stop()
+                logger.info(f"Webhook stats: {server.stats()}")
+        else:
+            # Start polling
+            logger.info("Starting bot")
+            # getUpdates is refused while a webhook is set
+            await bot.delete_webhook()
+            await dp.start_polling(bot, skip_updates=True, allowed_updates=allowed_updates)
     finally:
-        # Ensure the scheduler task is cancelled if polling stops
+        # Ensure the background tasks are cancelled if polling stops, unsent messages stay queued
         scheduler_task.cancel()
+        outbox_task.cancel()
+        if metrics_server:
+            await metrics_server.stop()
         await shutdown(dp)
     
 async def set_commands():
@@ -1,3 +1,4 @@
+import hashlib
 import os
 from dotenv import load_dotenv
 import logging
@@ -22,6 +23,9 @@ if not CHANNEL_USERNAME:
 # Bot username
 BOT_USERNAME = os.getenv("BOT_USERNAME", "AirChainMiniAppBot").strip('@')
 
+# Bot API server, e.g. a self-hosted telegram-bot-api or benchmarks.fake_api, empty for api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")
+
 # Admin settings
 ADMIN_IDS = []
 admin_ids_str = os.getenv("ADMIN_IDS", "")
@@ -31,16 +35,113 @@ if admin_ids_str:
     except ValueError:
         raise ValueError("ADMIN_IDS must be comma-separated integers")
 
+# Update delivery: "polling" or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+if BOT_MODE not in ("polling", "webhook"):
+    raise ValueError("BOT_MODE must be 'polling' or 'webhook'")
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Public HTTPS base URL Telegram posts updates to
+if BOT_MODE == "webhook" and not WEBHOOK_URL:
+    raise ValueError("WEBHOOK_URL environment variable is not set")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Telegram sends it back in every request, defaults to a value derived from the token
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")  # Address the local server listens on
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))  # Tasks handling updates
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "100"))  # Queued updates per worker before refusing more
+
+# Worker processes started by launcher.py, updates are sharded between them by user
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))
+STATE_SYNC_INTERVAL = int(os.getenv("STATE_SYNC_INTERVAL", "30"))  # Seconds between reloads of state other processes change (leaderboard, draw schedule)
+
+# FSM storage: "memory", "sql" (bot database) or "redis"
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory").lower()
+if FSM_STORAGE not in ("memory", "sql", "redis"):
+    raise ValueError("FSM_STORAGE must be 'memory', 'sql' or 'redis'")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
 # Database settings
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///invite2win.db")
+DB_WORKERS = int(os.getenv("DB_WORKERS", "4"))  # Threads running blocking queries
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", str(DB_WORKERS)))  # Connections kept open
+DB_POOL_OVERFLOW = int(os.getenv("DB_POOL_OVERFLOW", "2"))  # Extra connections allowed under load
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))  # Seconds to wait for a free connection
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")  # Test connections before use
+DB_BUSY_TIMEOUT = int(os.getenv("DB_BUSY_TIMEOUT", "5000"))  # SQLite: milliseconds to wait for a locked database
+
+# Metrics in the Prometheus text format at http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")  # Keep it local, the endpoint has no authentication
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))  # 0 turns it off, launcher.py workers use METRICS_PORT + worker index
 
 # Logging settings
 LOG_LEVEL = getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper())
 
 # Draw settings
 DEFAULT_DRAW_DURATION = int(os.getenv("DEFAULT_DRAW_DURATION", "7"))  # 7 days by default
-SCHEDULER_CHECK_INTERVAL = int(os.getenv("SCHEDULER_CHECK_INTERVAL", "3600"))  # 1 hour by default
+SCHEDULER_CHECK_INTERVAL = int(os.getenv("SCHEDULER_CHECK_INTERVAL", "3600"))  # Max sleep before the draw schedule is reloaded, 1 hour by default
+SCHEDULER_RETRY_DELAY = int(os.getenv("SCHEDULER_RETRY_DELAY", "60"))  # Seconds before retrying a draw that couldn't be finished
+DRAW_FINALIZE_CONCURRENCY = int(os.getenv("DRAW_FINALIZE_CONCURRENCY", "4"))  # Due draws finished in parallel
+PENDING_REFERRAL_TTL = int(os.getenv("PENDING_REFERRAL_TTL", "604800"))  # Seconds an invited user has to join the channel, 7 days by default
 REFERRAL_TICKETS = int(os.getenv("REFERRAL_TICKETS", "1"))  # Tickets per referral
 
+# Write-behind buffer for registrations and referrals
+WRITE_BUFFER_INTERVAL = float(os.getenv("WRITE_BUFFER_INTERVAL", "0.05"))  # Seconds a write may wait for others to share its commit
+WRITE_BUFFER_MAX_BATCH = int(os.getenv("WRITE_BUFFER_MAX_BATCH", "500"))  # Writes committed in one transaction at most
+
 # Rate limiting
-RATE_LIMIT = int(os.getenv("RATE_LIMIT", "5"))  # Messages per minute
\ No newline at end of file
+RATE_LIMIT = int(os.getenv("RATE_LIMIT", "5"))  # Messages per minute
+# Stricter per-command limits on top of RATE_LIMIT, e.g. "me:3,top:3" (messages per minute)
+THROTTLE_COMMAND_LIMITS = {}
+command_limits_str = os.getenv("THROTTLE_COMMAND_LIMITS", "me:3,top:3")
+if command_limits_str:
+    try:
+        THROTTLE_COMMAND_LIMITS = {
+            command.strip().lstrip("/").lower(): int(limit)
+            for command, limit in (item.split(":") for item in command_limits_str.split(","))
+        }
+    except ValueError:
+        raise ValueError("THROTTLE_COMMAND_LIMITS must look like 'me:3,top:3'")
+
+# Referral codes and links
+# Key of the permutation that turns user IDs into codes. Changing it breaks the links of users registered since,
+# when not set a random secret is stored in the database on the first run
+REFERRAL_CODE_SECRET = os.getenv("REFERRAL_CODE_SECRET")
+REFERRAL_CODE_CACHE_SIZE = int(os.getenv("REFERRAL_CODE_CACHE_SIZE", "100000"))  # Max cached codes, known and unknown ones each
+REFERRAL_CODE_NEGATIVE_TTL = int(os.getenv("REFERRAL_CODE_NEGATIVE_TTL", "300"))  # Seconds to remember that a code belongs to nobody
+REFERRAL_LINK_CACHE_SIZE = int(os.getenv("REFERRAL_LINK_CACHE_SIZE", "10000"))  # Max cached referral links
+
+# Channel membership cache
+MEMBERSHIP_CACHE_TTL = int(os.getenv("MEMBERSHIP_CACHE_TTL", "300"))  # Seconds to trust a cached member status
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "10000"))  # Max cached users
+MEMBERSHIP_NEGATIVE_TTL = int(os.getenv("MEMBERSHIP_NEGATIVE_TTL", "30"))  # Seconds to trust a cached "not subscribed" status
+
+# Channel invite links
+INVITE_LINK_TTL = int(os.getenv("INVITE_LINK_TTL", "3600"))  # Seconds before the cached primary link is fetched again
+REFERRER_INVITE_LINKS = os.getenv("REFERRER_INVITE_LINKS", "true").lower() in ("1", "true", "yes")  # Give invited users a link named after their referrer
+
+# Bulk membership verification (draw finalization)
+BULK_VERIFY_RATE = float(os.getenv("BULK_VERIFY_RATE", "20"))  # get_chat_member calls per second
+BULK_VERIFY_WORKERS = int(os.getenv("BULK_VERIFY_WORKERS", "10"))  # Concurrent lookups
+BULK_VERIFY_MAX_RETRIES = int(os.getenv("BULK_VERIFY_MAX_RETRIES", "5"))  # Attempts before a lookup counts as failed
+BULK_VERIFY_CHECKPOINT_BATCH = int(os.getenv("BULK_VERIFY_CHECKPOINT_BATCH", "200"))  # Results saved per checkpoint
+VERIFY_RESULT_MAX_AGE = int(os.getenv("VERIFY_RESULT_MAX_AGE", "3600"))  # Seconds a stored check is reused when a draw ends
+VERIFY_PAGE_SIZE = int(os.getenv("VERIFY_PAGE_SIZE", "1000"))  # Users loaded at a time by /verify
+VERIFY_PROGRESS_INTERVAL = int(os.getenv("VERIFY_PROGRESS_INTERVAL", "5"))  # Seconds between /verify progress updates
+
+# Outgoing messages (announcements and bulk DMs)
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))  # Messages per second over all chats
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))  # Messages per second to one user
+OUTBOX_GROUP_RATE = float(os.getenv("OUTBOX_GROUP_RATE", "0.33"))  # Messages per second to one channel or group
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "5"))  # Sends in flight
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))  # Attempts before a message is given up on
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))  # Seconds between checks when idle
+
+# Broadcasts to all users (/broadcast)
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))  # Messages per second, the rest of the global limit is left to the outbox
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "10"))  # Sends in flight
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", "200"))  # Recipients read and recorded at a time
+BROADCAST_PROGRESS_INTERVAL = int(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))  # Seconds between progress updates
+
+# Leaderboard
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", "10"))  # Users shown in /top
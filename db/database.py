@@ -1,18 +1,176 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 from .models import Base
-from config import DATABASE_URL
+from .migrations import migrate
+from services.metrics import db_query_duration, db_query_errors
+from config import (
+    DATABASE_URL,
+    DB_WORKERS,
+    DB_POOL_SIZE,
+    DB_POOL_OVERFLOW,
+    DB_POOL_TIMEOUT,
+    DB_POOL_PRE_PING,
+    DB_BUSY_TIMEOUT,
+)
+
+
+class PoolMetrics:
+    """Counters describing how the connection pool is used"""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.checkins = 0
+        self.connects = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_wait(self, seconds):
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+    def stats(self):
+        pool = engine.pool
+        return {
+            "pool_size": pool.size() if hasattr(pool, "size") else None,
+            "checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+            "overflow": pool.overflow() if hasattr(pool, "overflow") else None,
+            "checkouts": self.checkouts,
+            "checkins": self.checkins,
+            "connects": self.connects,
+            "timeouts": self.timeouts,
+            "wait_avg_ms": round(self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0,
+            "wait_max_ms": round(self.wait_max * 1000, 3)
+        }
+
+
+pool_metrics = PoolMetrics()
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that measures how long callers wait for a connection"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            pool_metrics.timeouts += 1
+            raise
+        finally:
+            pool_metrics.record_wait(time.perf_counter() - start)
+
+
+def _create_engine(url):
+    options = {"pool_pre_ping": DB_POOL_PRE_PING}
+
+    if url.startswith("sqlite"):
+        if ":memory:" in url or url.rstrip("/") == "sqlite:":
+            # In-memory databases live in a single connection, keep the default pool
+            return create_engine(url)
+        # Pooled connections are handed between the DB threads
+        options["connect_args"] = {"check_same_thread": False, "timeout": DB_BUSY_TIMEOUT / 1000}
+
+    return create_engine(
+        url,
+        poolclass=MeteredQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_POOL_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        **options
+    )
 
-engine = create_engine(DATABASE_URL)
+
+engine = _create_engine(DATABASE_URL)
 session_factory = sessionmaker(bind=engine)
-Session = scoped_session(session_factory)
+
+@event.listens_for(engine, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    pool_metrics.connects += 1
+    if engine.dialect.name == "sqlite":
+        # WAL lets readers work while a write is in progress, busy_timeout makes
+        # writers wait for the lock instead of failing with "database is locked"
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT}")
+        cursor.close()
+
+@event.listens_for(engine, "before_cursor_execute")
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started_at", []).append(time.perf_counter())
+
+@event.listens_for(engine, "after_cursor_execute")
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    started_at = conn.info["query_started_at"].pop()
+    # SELECT, INSERT, UPDATE, ... keeps the number of series small
+    db_query_duration.observe(time.perf_counter() - started_at, statement.lstrip().split(None, 1)[0].upper())
+
+@event.listens_for(engine, "handle_error")
+def _on_error(context):
+    started = context.connection.info.get("query_started_at") if context.connection else None
+    if started:
+        started.pop()
+    db_query_errors.inc()
+
+@event.listens_for(engine, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_metrics.checkouts += 1
+
+@event.listens_for(engine, "checkin")
+def _on_checkin(dbapi_connection, connection_record):
+    pool_metrics.checkins += 1
+
+# Blocking queries run here instead of on the event loop
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
 
 def init_db():
     Base.metadata.create_all(engine)
+    # Bring databases created by older versions up to date
+    migrate(engine)
+
+def close_db():
+    db_executor.shutdown(wait=True)
+    engine.dispose()
+
+def get_pool_stats():
+    """Get connection pool usage, useful for sizing DB_POOL_SIZE"""
+    return pool_metrics.stats()
+
+@contextmanager
+def session_scope():
+    """Unit of work: commit on success, roll back on error, always close
 
-def get_session():
-    session = Session()
+        with session_scope() as session:
+            session.add(...)
+    """
+    session = session_factory()
     try:
-        return session
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
     finally:
-        session.close()
\ No newline at end of file
+        session.close()
+
+def _run_in_session(func, *args, **kwargs):
+    with session_scope() as session:
+        return func(session, *args, **kwargs)
+
+async def run_db(func, *args, **kwargs):
+    """Run func(session, *args, **kwargs) in the DB thread pool and commit
+
+    Every call gets its own session, which is closed before the result is
+    returned - so func should return plain values, not ORM objects.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, partial(_run_in_session, func, *args, **kwargs))
@@ -0,0 +1,196 @@
+"""Schema migrations for databases created by older versions of the bot
+
+create_all() only creates missing tables, so indexes and columns added to
+existing tables are applied here. Every migration must be safe to run on a
+fresh database as well, where create_all() has already done the work.
+
+    python -m db.migrations           # upgrade the configured database
+    python -m db.migrations --explain # show query plans of the hot queries
+"""
+import logging
+import secrets
+import sys
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+logger = logging.getLogger(__name__)
+
+
+def _create_index(conn, name, table, columns, unique=False, where=None):
+    sql = f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {table} ({columns})"
+    if where and conn.dialect.name in ("sqlite", "postgresql"):
+        sql += f" WHERE {where}"
+    conn.execute(text(sql))
+
+
+def _add_column(conn, table, column, ddl):
+    """Add a column unless the table already has it"""
+    if column not in {c["name"] for c in inspect(conn).get_columns(table)}:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def _hot_path_indexes(conn):
+    _create_index(conn, "ix_users_ticket_holders", "users", "ticket_count, id", where="ticket_count > 0")
+    _create_index(conn, "ix_draws_status_scheduled_end", "draws", "status, scheduled_end")
+
+    # Drop duplicate referrals left by the old check-then-insert, keep the first one
+    conn.execute(text(
+        "DELETE FROM referrals WHERE id NOT IN ("
+        "SELECT MIN(id) FROM referrals GROUP BY referrer_id, referred_id)"
+    ))
+    _create_index(conn, "uq_referrals_referrer_referred", "referrals", "referrer_id, referred_id", unique=True)
+
+
+def _referral_aggregates(conn):
+    _add_column(conn, "users", "referral_count", "INTEGER NOT NULL DEFAULT 0")
+
+    # Backfill the aggregates (same as services.aggregates.rebuild_aggregates)
+    conn.execute(text(
+        "UPDATE users SET referral_count = "
+        "(SELECT COUNT(*) FROM referrals WHERE referrals.referrer_id = users.id)"
+    ))
+    conn.execute(text("DELETE FROM counters WHERE name = 'ticket_total'"))
+    conn.execute(text(
+        "INSERT INTO counters (name, value) "
+        "SELECT 'ticket_total', COALESCE(SUM(ticket_count), 0) FROM users WHERE ticket_count > 0"
+    ))
+
+
+def _draw_seed(conn):
+    _add_column(conn, "draws", "seed", "BIGINT")
+
+
+def _draw_ticket_ledger(conn):
+    # The tables come from create_all(), running draws start with the lifetime tickets
+    # they were drawn from so far (same as services.ledger.carry_over_tickets)
+    conn.execute(text(
+        "INSERT INTO ticket_ledger (draw_id, user_id, delta, created_at) "
+        "SELECT draws.id, users.id, users.ticket_count, CURRENT_TIMESTAMP FROM draws, users "
+        "WHERE draws.status = 'active' AND users.ticket_count > 0"
+    ))
+    conn.execute(text(
+        "INSERT INTO draw_tickets (draw_id, user_id, tickets) "
+        "SELECT draws.id, users.id, users.ticket_count FROM draws, users "
+        "WHERE draws.status = 'active' AND users.ticket_count > 0"
+    ))
+    _create_index(conn, "ix_ticket_ledger_draw_user", "ticket_ledger", "draw_id, user_id")
+    _create_index(conn, "ix_draw_tickets_snapshot", "draw_tickets", "draw_id, user_id, tickets")
+
+
+def _user_blocked_flag(conn):
+    _add_column(conn, "users", "is_blocked", "BOOLEAN NOT NULL DEFAULT 0")
+
+
+def _user_member_status(conn):
+    _add_column(conn, "users", "is_member", "BOOLEAN")
+    _add_column(conn, "users", "member_checked_at", "DATETIME")
+
+
+def _referral_revocation(conn):
+    _add_column(conn, "referrals", "revoked_at", "DATETIME")
+
+
+def _referral_code_secret(conn):
+    # REFERRAL_CODE_SECRET takes precedence when set, it is never copied into the database
+    conn.execute(text("DELETE FROM settings WHERE name = 'referral_code_secret'"))
+    conn.execute(
+        text("INSERT INTO settings (name, value) VALUES ('referral_code_secret', :v)"),
+        {"v": secrets.token_hex(32)}
+    )
+
+
+def _draw_ticket_totals(conn):
+    # Sum of draw_tickets per running draw (same as services.ledger.draw_total_counter)
+    conn.execute(text("DELETE FROM counters WHERE name LIKE 'draw_tickets:%'"))
+    conn.execute(text(
+        "INSERT INTO counters (name, value) "
+        "SELECT 'draw_tickets:' || draw_tickets.draw_id, SUM(draw_tickets.tickets) FROM draw_tickets "
+        "JOIN draws ON draws.id = draw_tickets.draw_id WHERE draws.status = 'active' "
+        "GROUP BY draw_tickets.draw_id"
+    ))
+
+
+# (version, description, function) - append only, never renumber
+MIGRATIONS = [
+    (1, "Indexes for /top, draws and referral lookups", _hot_path_indexes),
+    (2, "Ticket total and per-user referral count aggregates", _referral_aggregates),
+    (3, "Seed of the winner selection on draws", _draw_seed),
+    (4, "Per-draw ticket ledger, opening balances of running draws", _draw_ticket_ledger),
+    (5, "Users who blocked the bot", _user_blocked_flag),
+    (6, "Last channel membership check of users", _user_member_status),
+    (7, "Referrals taken back when the invited user leaves", _referral_revocation),
+    (8, "Stored secret of the referral codes", _referral_code_secret),
+    (9, "Ticket totals of running draws", _draw_ticket_totals),
+]
+
+
+def migrate(engine):
+    """Apply migrations that haven't been applied to the database yet"""
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at DATETIME)"
+        ))
+        applied = {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+    for version, name, func in MIGRATIONS:
+        if version in applied:
+            continue
+
+        logger.info(f"Applying migration {version}: {name}")
+        # Each migration runs in its own transaction together with its bookkeeping row
+        with engine.begin() as conn:
+            func(conn)
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, name, applied_at) VALUES (:v, :n, :t)"),
+                {"v": version, "n": name, "t": datetime.utcnow()}
+            )
+
+
+def _hot_queries():
+    """Queries that run on every /top, /me, referral and scheduler tick"""
+    from sqlalchemy.orm import Query
+    from db.models import User, Referral, Draw, Counter, DrawTickets
+
+    now = datetime.utcnow()
+    return {
+        "top users": Query([User.id, User.username, User.ticket_count])
+            .filter(User.ticket_count > 0).order_by(User.ticket_count.desc()).limit(10),
+        "draw participants": Query([DrawTickets.user_id, DrawTickets.tickets])
+            .filter(DrawTickets.draw_id.in_([1, 2]), DrawTickets.tickets > 0),
+        "ticket total": Query(Counter.value).filter(Counter.name == "ticket_total"),
+        "referral exists": Query(Referral.id)
+            .filter(Referral.referrer_id == 1, Referral.referred_id == 2),
+        "due draws": Query(Draw.id).filter(Draw.status == "active", Draw.scheduled_end <= now),
+    }
+
+
+def explain_hot_queries(engine):
+    """Print the query plan of every hot query, returns names of those that scan a table"""
+    full_scans = []
+    with engine.connect() as conn:
+        for name, query in _hot_queries().items():
+            sql = str(query.statement.compile(engine, compile_kwargs={"literal_binds": True}))
+            plan = [row[-1] for row in conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+            print(f"{name}:")
+            for step in plan:
+                print(f"    {step}")
+            # "SCAN users" is a full table scan, "SCAN users USING INDEX ..." is fine
+            if any(step.startswith("SCAN") and "USING" not in step for step in plan):
+                full_scans.append(name)
+    return full_scans
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    from db.database import engine, init_db
+
+    init_db()
+    if "--explain" in sys.argv:
+        if engine.dialect.name != "sqlite":
+            sys.exit("Query plans can only be checked on SQLite")
+        scans = explain_hot_queries(engine)
+        if scans:
+            sys.exit(f"Full table scans in: {', '.join(scans)}")
+        print("All hot queries use an index")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, DateTime, BigInteger
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, Boolean, DateTime, BigInteger, UniqueConstraint, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -24,8 +24,24 @@ class User(Base):
     # Tickets earned (for faster lookup)
     ticket_count = Column(Integer, default=0)
     
+    # Number of users this user referred, kept in sync by process_referral
+    referral_count = Column(Integer, nullable=False, default=0, server_default="0")
+    
+    # The user blocked the bot, broadcasts skip them until they /start again
+    is_blocked = Column(Boolean, nullable=False, default=False, server_default="0")
+    
+    # Last known channel membership and when it was checked, reused by draws while fresh
+    is_member = Column(Boolean, nullable=True)
+    member_checked_at = Column(DateTime, nullable=True)
+    
     # Draw history
     wins = relationship("Draw", back_populates="winner")
+    
+    __table_args__ = (
+        # Ticket holders only: /top, draws and the ticket total never look at users without tickets
+        Index("ix_users_ticket_holders", "ticket_count", "id", sqlite_where=ticket_count > 0,
+              postgresql_where=ticket_count > 0),
+    )
 
 class Referral(Base):
     __tablename__ = "referrals"
@@ -34,10 +50,17 @@ class Referral(Base):
     referrer_id = Column(BigInteger, ForeignKey("users.id"), nullable=False)
     referred_id = Column(BigInteger, ForeignKey("users.id"), nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow)
+    # Set while the invited user is out of the channel, the referrer's ticket is taken back
+    revoked_at = Column(DateTime, nullable=True)
     
     # Relationships
     referrer = relationship("User", back_populates="referrals", foreign_keys=[referrer_id])
     referred = relationship("User", foreign_keys=[referred_id])
+    
+    __table_args__ = (
+        # A user can be referred by the same referrer only once
+        Index("uq_referrals_referrer_referred", "referrer_id", "referred_id", unique=True),
+    )
 
 class Draw(Base):
     __tablename__ = "draws"
@@ -53,5 +76,140 @@ class Draw(Base):
     total_tickets = Column(Integer, nullable=True)
     prize_description = Column(String, nullable=True)
     
+    # Random seed the winner was drawn with, replaying it gives the same winner
+    seed = Column(BigInteger, nullable=True)
+    
     # Relationship
-    winner = relationship("User", back_populates="wins")
\ No newline at end of file
+    winner = relationship("User", back_populates="wins")
+    
+    __table_args__ = (
+        Index("ix_draws_status_scheduled_end", "status", "scheduled_end"),
+    )
+
+class MembershipCheck(Base):
+    __tablename__ = "membership_checks"
+    
+    id = Column(Integer, primary_key=True)
+    job = Column(String, nullable=False)  # Verification run, e.g. "draw:5"
+    user_id = Column(BigInteger, nullable=False)
+    is_member = Column(Boolean, nullable=False)
+    checked_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        UniqueConstraint("job", "user_id"),
+    )
+
+
+class Counter(Base):
+    __tablename__ = "counters"
+    
+    # Aggregates maintained alongside the rows they summarize, e.g. "ticket_total"
+    name = Column(String, primary_key=True)
+    value = Column(BigInteger, nullable=False, default=0)
+
+
+class Setting(Base):
+    __tablename__ = "settings"
+    
+    # Values generated once and kept for the lifetime of the database, e.g. "referral_code_secret"
+    name = Column(String, primary_key=True)
+    value = Column(String, nullable=False)
+
+
+class TicketLedger(Base):
+    __tablename__ = "ticket_ledger"
+    
+    # Append-only history of tickets credited (or debited) in a draw
+    id = Column(Integer, primary_key=True)
+    draw_id = Column(Integer, ForeignKey("draws.id"), nullable=False)
+    user_id = Column(BigInteger, ForeignKey("users.id"), nullable=False)
+    delta = Column(Integer, nullable=False)
+    referral_id = Column(Integer, ForeignKey("referrals.id"), nullable=True)  # None for carried over tickets
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_ticket_ledger_draw_user", "draw_id", "user_id"),
+    )
+
+class DrawTickets(Base):
+    __tablename__ = "draw_tickets"
+    
+    # Per-draw ticket totals, the sum of the ledger rows for (draw_id, user_id)
+    draw_id = Column(Integer, ForeignKey("draws.id"), primary_key=True)
+    user_id = Column(BigInteger, ForeignKey("users.id"), primary_key=True)
+    tickets = Column(Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        # Covers the participant snapshot read when a draw ends
+        Index("ix_draw_tickets_snapshot", "draw_id", "user_id", "tickets"),
+    )
+
+class FsmState(Base):
+    __tablename__ = "fsm_states"
+    
+    # FSM state and data of a chat/user, shared by all bot processes
+    key = Column(String, primary_key=True)  # Built by aiogram's key builder
+    state = Column(String, nullable=True)
+    data = Column(Text, nullable=True)  # JSON
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class OutboxMessage(Base):
+    __tablename__ = "outbox"
+    
+    # Messages waiting to be sent, deleted once Telegram accepted them
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(String, nullable=False)  # User ID, channel ID or @username
+    text = Column(Text, nullable=False)
+    priority = Column(Integer, nullable=False, default=0)  # Lower is sent first
+    status = Column(String, nullable=False, default="pending")  # pending, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    not_before = Column(DateTime, nullable=False, default=datetime.utcnow)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_outbox_status_priority", "status", "priority", "id"),
+    )
+
+class Broadcast(Base):
+    __tablename__ = "broadcasts"
+    
+    id = Column(Integer, primary_key=True)
+    text = Column(Text, nullable=False)
+    status = Column(String, nullable=False, default="running")  # running, completed
+    # Keyset cursor: every user with a lower or equal ID already has a delivery row
+    last_user_id = Column(BigInteger, nullable=False, default=0)
+    total = Column(Integer, nullable=False, default=0)  # Recipients when the broadcast started
+    # Admin message with the live progress
+    progress_chat_id = Column(BigInteger, nullable=True)
+    progress_message_id = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+class BroadcastDelivery(Base):
+    __tablename__ = "broadcast_deliveries"
+    
+    broadcast_id = Column(Integer, ForeignKey("broadcasts.id"), primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)
+    status = Column(String, nullable=False)  # sent, failed, blocked
+
+class InviteLink(Base):
+    __tablename__ = "invite_links"
+    
+    # Named channel invite link of a referrer, joins through it are attributed to them
+    user_id = Column(BigInteger, ForeignKey("users.id"), primary_key=True)
+    invite_link = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class PendingReferral(Base):
+    __tablename__ = "pending_referrals"
+    
+    # Invited user who pressed /start but isn't subscribed yet, credited when they join the channel
+    referred_id = Column(BigInteger, ForeignKey("users.id"), primary_key=True)
+    referrer_id = Column(BigInteger, ForeignKey("users.id"), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+    
+    __table_args__ = (
+        Index("ix_pending_referrals_expires_at", "expires_at"),
+    )
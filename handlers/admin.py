@@ -1,3 +1,4 @@
+import asyncio
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
 from aiogram.filters import Command
@@ -5,8 +6,11 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 from datetime import datetime, timedelta
 
 from services.draw_manager import create_draw, get_active_draws, get_draw_details, end_draw, cancel_draw
-from config import ADMIN_IDS, CHANNEL_ID
-from instance import bot
+from services.verify_job import start_job, cancel_job
+from services.scheduler import draw_scheduler
+from config import ADMIN_IDS, CHANNEL_ID, VERIFY_PROGRESS_INTERVAL, SCHEDULER_RETRY_DELAY
+from services.outbox import outbox, PRIORITY_CHANNEL
+from services.broadcast import start_broadcast
 
 # Initialize router
 router = Router()
@@ -47,17 +51,15 @@ async def cmd_new_draw(message: Message):
     )
     
     # Announce in the channel
-    try:
-        await bot.send_message(
-            CHANNEL_ID,
-            f"🎉 <b>Новий розіграш розпочато!</b>\n\n"
-            f"🏆 {result['name']}\n"
-            f"🎁 Приз: <b>{result['prize']}</b>\n"
-            f"📅 Розіграш закінчиться: <b>{end_date}</b>\n\n"
-            f"Запрошуйте друзів та збільшуйте свої шанси на перемогу! /start"
-        )
-    except Exception as e:
-        await message.answer(f"Помилка при відправці оголошення в канал: {str(e)}")
+    await outbox.enqueue(
+        CHANNEL_ID,
+        f"🎉 <b>Новий розіграш розпочато!</b>\n\n"
+        f"🏆 {result['name']}\n"
+        f"🎁 Приз: <b>{result['prize']}</b>\n"
+        f"📅 Розіграш закінчиться: <b>{end_date}</b>\n\n"
+        f"Запрошуйте друзів та збільшуйте свої шанси на перемогу! /start",
+        PRIORITY_CHANNEL
+    )
 
 @router.message(Command("draws"), F.from_user.id.in_(ADMIN_IDS))
 async def cmd_list_draws(message: Message):
@@ -125,6 +127,14 @@ async def callback_end_draw(callback: CallbackQuery):
         await callback.message.answer("❌ Помилка: розіграш не знайдено або вже завершений.")
         return
     
+    if result.get("status") == "pending":
+        # Some lookups failed, the draw stays active and verification resumes on the next try
+        await callback.message.answer(
+            f"⚠️ Розіграш #{draw_id} не завершено: не вдалося перевірити "
+            f"{result['failed_count']} учасників. Спробуйте ще раз пізніше."
+        )
+        return
+    
     # Format winner announcement
     if "message" in result:
         # No eligible participants
@@ -157,11 +167,8 @@ async def callback_end_draw(callback: CallbackQuery):
     await callback.message.answer(winner_text)
     
     # Send winner announcement to channel (without eligibility info)
-    try:
-        channel_text = winner_text.replace(eligibility_info, "")  # Remove eligibility stats for channel announcement
-        await bot.send_message(CHANNEL_ID, channel_text)
-    except Exception as e:
-        await callback.message.answer(f"Помилка при відправці повідомлення в канал: {str(e)}")
+    channel_text = winner_text.replace(eligibility_info, "")  # Remove eligibility stats for channel announcement
+    await outbox.enqueue(CHANNEL_ID, channel_text, PRIORITY_CHANNEL)
 
 @router.callback_query(F.data.startswith("cancel_draw:"))
 async def callback_cancel_draw(callback: CallbackQuery):
@@ -186,16 +193,14 @@ async def callback_cancel_draw(callback: CallbackQuery):
     await callback.message.answer(f"❌ Розіграш #{draw_id} скасовано.")
     
     # Announce in the channel
-    try:
-        draw_details = await get_draw_details(draw_id)
-        if draw_details:
-            await bot.send_message(
-                CHANNEL_ID,
-                f"❌ <b>Розіграш '{draw_details['name']}' скасовано.</b>\n\n"
-                f"Наступний розіграш буде оголошено незабаром!"
-            )
-    except Exception as e:
-        await callback.message.answer(f"Помилка при відправці повідомлення в канал: {str(e)}")
+    draw_details = await get_draw_details(draw_id)
+    if draw_details:
+        await outbox.enqueue(
+            CHANNEL_ID,
+            f"❌ <b>Розіграш '{draw_details['name']}' скасовано.</b>\n\n"
+            f"Наступний розіграш буде оголошено незабаром!",
+            PRIORITY_CHANNEL
+        )
 
 @router.message(Command("draw"), F.from_user.id.in_(ADMIN_IDS))
 async def cmd_draw(message: Message):
@@ -204,11 +209,25 @@ async def cmd_draw(message: Message):
     args = message.text.split()[1:] if len(message.text.split()) > 1 else []
     prize = " ".join(args) if args else "Приз"
     
-    # Create draw and immediately end it
-    draw_result = await create_draw("Моментальний розіграш", prize, 0)
+    # Create draw with everybody's tickets and immediately end it
+    draw_result = await create_draw("Моментальний розіграш", prize, 0, carry_over=True, schedule=False)
     result = await end_draw(draw_result["id"])
     
-    if not result or "message" in result:
+    if result is None:
+        # The scheduler reloaded the draw from the database and ended it first, it announces the winner
+        await message.answer(f"Розіграш #{draw_result['id']} вже завершено автоматично.")
+        return
+    
+    if result.get("status") == "pending":
+        # Not scheduled so far, hand it over to the scheduler now
+        draw_scheduler.retry_later(draw_result["id"], SCHEDULER_RETRY_DELAY)
+        await message.answer(
+            f"⚠️ Не вдалося перевірити {result['failed_count']} учасників. "
+            f"Розіграш #{draw_result['id']} буде завершено автоматично під час наступної перевірки."
+        )
+        return
+    
+    if "message" in result:
         await message.answer("Немає учасників з квитками для проведення розіграшу.")
         return
     
@@ -229,45 +248,92 @@ async def cmd_draw(message: Message):
     await message.answer(winner_text)
     
     # Send winner announcement to channel
-    try:
-        await bot.send_message(CHANNEL_ID, winner_text)
-    except Exception as e:
-        await message.answer(f"Помилка при відправці повідомлення в канал: {str(e)}")
+    await outbox.enqueue(CHANNEL_ID, winner_text, PRIORITY_CHANNEL)
 
-@router.message(Command("verify"), F.from_user.id.in_(ADMIN_IDS))
-async def cmd_verify_members(message: Message):
-    """Handle /verify command - check channel membership of all users with tickets"""
-    # Notify admin that this might take some time
-    processing_msg = await message.answer("⏳ Перевіряємо учасників... Це може зайняти деякий час.")
-    
-    session = get_session()
+def _cancel_verify_markup():
+    builder = InlineKeyboardBuilder()
+    builder.button(text="❌ Скасувати перевірку", callback_data="cancel_verify")
+    return builder.as_markup()
+
+def _render_verify_report(job):
+    result = job.result
+    active_members = len(result.members)
+    non_members = len(result.non_members)
+    checked = active_members + non_members
+    
+    if job.cancelled:
+        header = "⛔️ <b>Перевірку скасовано.</b> Результати на момент скасування:"
+    elif job.finished:
+        header = "📊 <b>Звіт про учасників:</b>"
+    else:
+        header = f"⏳ <b>Перевіряємо учасників...</b> {job.checked} з {job.total} ({job.rate_per_second():.1f}/с)"
     
-    # Get all users with tickets
-    users_with_tickets = session.query(User).filter(User.ticket_count > 0).all()
+    report = (
+        f"{header}\n\n"
+        f"👥 Загальна кількість користувачів з квитками: <b>{job.total}</b>\n"
+        f"✅ Активні учасники каналу: <b>{active_members}</b>\n"
+        f"❌ Неактивні (вийшли з каналу): <b>{non_members}</b>\n"
+    )
+    if result.failed:
+        report += f"⚠️ Не вдалося перевірити: <b>{len(result.failed)}</b>\n"
+    if checked:
+        report += f"\n📊 Відсоток активних учасників: <b>{active_members/checked*100:.2f}%</b>"
+    return report
+
+async def _report_verify_progress(job, processing_msg):
+    # Edit the progress message until the job is done
+    while not await job.wait(VERIFY_PROGRESS_INTERVAL):
+        try:
+            await processing_msg.edit_text(_render_verify_report(job), reply_markup=_cancel_verify_markup())
+        except Exception:
+            pass  # Nothing changed since the last update
     
-    if not users_with_tickets:
+    if not job.total:
         await processing_msg.edit_text("В базі даних немає користувачів з квитками.")
         return
     
-    # Check channel membership for each user
-    total_users = len(users_with_tickets)
-    active_members = 0
-    non_members = 0
-    
-    for user in users_with_tickets:
-        is_member = await check_channel_membership(user.id)
-        if is_member:
-            active_members += 1
-        else:
-            non_members += 1
+    await processing_msg.edit_text(_render_verify_report(job))
+
+@router.message(Command("verify"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_verify_members(message: Message):
+    """Handle /verify command - check channel membership of all users with tickets"""
+    job = start_job()
+    if job is None:
+        await message.answer("⏳ Перевірка вже триває.")
+        return
     
-    # Prepare report
-    report = (
-        f"📊 <b>Звіт про учасників:</b>\n\n"
-        f"👥 Загальна кількість користувачів з квитками: <b>{total_users}</b>\n"
-        f"✅ Активні учасники каналу: <b>{active_members}</b>\n"
-        f"❌ Неактивні (вийшли з каналу): <b>{non_members}</b>\n\n"
-        f"📊 Відсоток активних учасників: <b>{active_members/total_users*100:.2f}%</b>"
+    # Notify admin that this might take some time
+    processing_msg = await message.answer(
+        "⏳ Перевіряємо учасників... Це може зайняти деякий час.",
+        reply_markup=_cancel_verify_markup()
     )
     
-    await processing_msg.edit_text(report)
\ No newline at end of file
+    # Report from the background, so the cancel button is handled meanwhile
+    job.reporter = asyncio.create_task(_report_verify_progress(job, processing_msg))
+
+@router.callback_query(F.data == "cancel_verify")
+async def callback_cancel_verify(callback: CallbackQuery):
+    """Handle callback to cancel a running /verify"""
+    # Check if user is admin
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("У вас немає прав для цієї дії.")
+        return
+    
+    if cancel_job():
+        await callback.answer("Перевірку скасовано.")
+    else:
+        await callback.answer("Немає активної перевірки.")
+
+@router.message(Command("broadcast"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_broadcast(message: Message):
+    """Handle /broadcast command - send a message to every user who hasn't blocked the bot"""
+    # Parse command arguments: /broadcast [text], formatting of the text is kept
+    parts = message.html_text.split(maxsplit=1)
+    if len(parts) < 2:
+        await message.answer("Використання: /broadcast [текст повідомлення]")
+        return
+    
+    # The progress is reported by editing this message
+    progress_msg = await message.answer("📣 Розсилку розпочато...")
+    broadcast_id = await start_broadcast(parts[1], progress_msg.chat.id, progress_msg.message_id)
+    await progress_msg.edit_text(f"📣 Розсилку #{broadcast_id} розпочато...")
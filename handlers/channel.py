@@ -0,0 +1,41 @@
+from aiogram import Router
+from aiogram.types import ChatMemberUpdated
+
+from config import CHANNEL_ID
+from services.bulk_verify import save_member_status
+from services.invite_links import invite_links, referrer_from_link
+from services.membership import membership, status_value, MEMBER_STATUSES
+from services.outbox import outbox
+from services.referral import credit_joined_user, revoke_referrals
+
+# Initialize router
+router = Router()
+
+@router.chat_member()
+async def on_chat_member(event: ChatMemberUpdated):
+    """Handle chat_member updates - keep membership and referrals in sync with the channel"""
+    if str(event.chat.id) != str(CHANNEL_ID):
+        return
+    
+    # Drop the cached status so the next check sees the change
+    user_id = event.new_chat_member.user.id
+    membership.invalidate(user_id)
+    
+    # Keep the stored result fresh for draws that reuse it
+    was_member = status_value(event.old_chat_member.status) in MEMBER_STATUSES
+    is_member = status_value(event.new_chat_member.status) in MEMBER_STATUSES
+    await save_member_status({user_id: is_member})
+    
+    if is_member and not was_member:
+        invite_links.check_join_link(event.invite_link)
+        # An invited user subscribed, their referrer gets the ticket without another /start
+        referrer_id = await credit_joined_user(user_id, referrer_from_link(event.invite_link))
+        if referrer_id:
+            await outbox.enqueue(
+                user_id,
+                f"Вітаємо! Ви приєдналися за запрошенням користувача з ID: {referrer_id}\n"
+                f"Тепер ви можете запрошувати друзів і збільшувати свої шанси на виграш!"
+            )
+    elif was_member and not is_member:
+        # Tickets count only while the invited friend stays in the channel
+        await revoke_referrals(user_id)
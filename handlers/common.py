@@ -1,13 +1,21 @@
+import logging
+
 from aiogram import Router, F
 from aiogram.types import Message
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 
-from db.database import get_session
-from db.models import User
-from services.referral import generate_referral_code, create_referral_link, process_referral, get_referral_stats
+from services.referral import (
+    register_user, find_referrer, create_referral_link, process_referral, get_referral_stats,
+    add_pending_referral
+)
 from config import CHANNEL_ID, CHANNEL_USERNAME
 from instance import bot
+from services.invite_links import invite_links
+from services.membership import membership
+from services.leaderboard import leaderboard
+
+logger = logging.getLogger(__name__)
 
 # Initialize router
 router = Router()
@@ -20,63 +28,42 @@ async def cmd_start(message: Message, state: FSMContext):
     first_name = message.from_user.first_name
     last_name = message.from_user.last_name
     
-    # Check if user exists in DB
-    session = get_session()
-    user = session.query(User).filter(User.id == user_id).first()
-    
-    # If user doesn't exist, create new user
-    if not user:
-        referral_code = generate_referral_code()
-        user = User(
-            id=user_id,
-            username=username,
-            first_name=first_name,
-            last_name=last_name,
-            referral_code=referral_code
-        )
-        session.add(user)
-        session.commit()
+    # Create the user if they don't exist yet
+    await register_user(user_id, username, first_name, last_name)
     
     # Check if start has referral code
     args = message.text.split()[1] if len(message.text.split()) > 1 else None
     if args:
         # Find user who shared the link
-        referrer = session.query(User).filter(User.referral_code == args).first()
+        referrer_id = await find_referrer(args)
         
-        if referrer and referrer.id != user_id:
+        if referrer_id and referrer_id != user_id:
             # First, check if the user has joined the channel
             try:
-                member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-                status = member.status
-                if isinstance(status, str):
-                    member_status = status
-                else:
-                    member_status = status.value
+                member_status = await membership.get_status(user_id)
                 
                 # Only process referral if user has joined the channel
                 if member_status not in ['left', 'kicked', 'restricted']:
-                    # Process the referral if it's valid
-                    user.referred_by_id = referrer.id
-                    session.commit()
-                    
-                    # Update referrer's tickets
-                    await process_referral(referrer.id, user_id)
+                    # Record the referral and update the referrer's tickets in one transaction
+                    await process_referral(referrer_id, user_id, wait=False)
                     
                     await message.answer(
-                        f"Вітаємо! Ви приєдналися за запрошенням користувача з ID: {referrer.id}\n"
+                        f"Вітаємо! Ви приєдналися за запрошенням користувача з ID: {referrer_id}\n"
                         f"Тепер ви можете запрошувати друзів і збільшувати свої шанси на виграш!"
                     )
                 else:
-                    # User hasn't joined the channel yet
-                    invite_link = await bot.export_chat_invite_link(CHANNEL_ID)
+                    # User hasn't joined the channel yet, the referral is credited when they do
+                    await add_pending_referral(referrer_id, user_id)
+                    # Their referrer's link tells who invited them
+                    invite_link = await invite_links.get_referrer_link(referrer_id)
                     await message.answer(
                         f"Щоб брати участь у розіграші, потрібно бути підписаним на канал.\n"
                         f"Підпишіться на канал: {invite_link}\n"
-                        f"Після підписки натисніть /start {args} знову."
+                        f"Запрошення буде зараховано автоматично, щойно ви підпишетесь."
                     )
                     return
             except Exception as e:
-                print(f"Error checking channel membership: {e}")
+                logger.error(f"Error checking channel membership of {user_id}: {e}", exc_info=True)
                 await message.answer("Сталася помилка при перевірці підписки на канал. Спробуйте пізніше.")
                 return
         else:
@@ -84,16 +71,11 @@ async def cmd_start(message: Message, state: FSMContext):
     else:
         # Check if user is in the channel
         try:
-            member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-            status = member.status
-            if isinstance(status, str):
-                member_status = status
-            else:
-                member_status = status.value
+            member_status = await membership.get_status(user_id)
                 
             if member_status in ['left', 'kicked', 'restricted']:
                 # User hasn't joined the channel yet
-                invite_link = await bot.export_chat_invite_link(CHANNEL_ID)
+                invite_link = await invite_links.get_link()
                 await message.answer(
                     f"Щоб брати участь у розіграші, потрібно бути підписаним на канал.\n"
                     f"Підпишіться на канал: {invite_link}\n"
@@ -101,10 +83,10 @@ async def cmd_start(message: Message, state: FSMContext):
                 )
                 return
         except Exception as e:
-            print(f"Error checking channel membership: {e}")
+            logger.error(f"Error checking channel membership of {user_id}: {e}", exc_info=True)
     
     # Generate and send the referral link - this creates a link to the BOT with start parameter
-    referral_link = create_referral_link(user_id)
+    referral_link = await create_referral_link(user_id)
     
     await message.answer(
         f"Вітаємо в нашому розіграші!\n\n"
@@ -122,18 +104,32 @@ async def cmd_start(message: Message, state: FSMContext):
 async def cmd_me(message: Message):
     """Handle /me command - show user's statistics"""
     user_id = message.from_user.id
-    stats = get_referral_stats(user_id)
+    stats = await get_referral_stats(user_id)
     
     if not stats:
         await message.answer("Ви ще не зареєстровані у системі. Використайте команду /start")
         return
     
+    rank = leaderboard.rank(user_id)
+    rank_text = f"\n📍 Ваше місце в рейтингу: <b>{rank}</b>" if rank else ""
+    
+    draw = stats["draw"]
+    if draw:
+        draw_text = (
+            f"\n\n🎁 <b>Розіграш «{draw['name']}»:</b>\n"
+            f"🎟 Ваші квитки в розіграші: <b>{draw['tickets']}</b>\n"
+            f"🏆 Загальна кількість квитків у розіграші: <b>{draw['total_tickets']}</b>\n"
+            f"🎯 Ваш шанс на перемогу: <b>{draw['win_chance']}%</b>"
+        )
+    else:
+        draw_text = "\n\nЗараз немає активного розіграшу."
+    
     await message.answer(
         f"📊 <b>Ваша статистика:</b>\n\n"
-        f"🎟 Кількість квитків: <b>{stats['tickets']}</b>\n"
-        f"👥 Запрошено друзів: <b>{stats['referrals_count']}</b>\n"
-        f"🎯 Ваш шанс на перемогу: <b>{stats['win_chance']}%</b>\n"
-        f"🏆 Загальна кількість квитків у розіграші: <b>{stats['total_tickets']}</b>"
+        f"🎟 Квитків за весь час: <b>{stats['tickets']}</b>\n"
+        f"👥 Запрошено друзів: <b>{stats['referrals_count']}</b>"
+        f"{rank_text}"
+        f"{draw_text}"
     )
 
 @router.message(Command("help"))
@@ -155,7 +151,7 @@ async def cmd_help(message: Message):
     
     await message.answer(help_text)
 
-from services.draw_manager import get_active_draws
+from services.draw_manager import get_active_draws, check_channel_membership
 
 @router.message(Command("draws"))
 async def cmd_user_draws(message: Message):
@@ -188,6 +184,8 @@ async def cmd_user_draws(message: Message):
 from aiogram.types import CallbackQuery
 @router.callback_query(lambda c: c.data == "check_join")
 async def check_join_callback(callback: CallbackQuery):
+    # The user just claims to have subscribed, so don't trust a cached "left" status
+    membership.invalidate(callback.from_user.id)
     is_member = await check_channel_membership(callback.from_user.id)
     if is_member:
         await callback.message.edit_text("✅ Подписка подтверждена! Теперь вы можете пользоваться ботом.")
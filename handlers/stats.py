@@ -2,30 +2,46 @@ from aiogram import Router
 from aiogram.types import Message
 from aiogram.filters import Command
 
-from db.database import get_session
-from db.models import User
+from services.leaderboard import leaderboard
 
 # Initialize router
 router = Router()
 
+# (leaderboard version, rendered /top text)
+_top_cache = (None, None)
+
+def render_top():
+    """Build the /top message, re-rendered only when the leaderboard changed"""
+    global _top_cache
+    version, text = _top_cache
+    if version == leaderboard.version:
+        return text
+
+    top_users = leaderboard.top()
+    if not top_users:
+        text = None
+    else:
+        lines = [f"<b>🏆 ТОП {leaderboard.size} учасників за кількістю квитків:</b>\n"]
+        for i, (user_id, username, tickets) in enumerate(top_users, 1):
+            name_display = f"@{username}" if username else f"ID: {user_id}"
+            lines.append(f"{i}. {name_display} — <b>{tickets}</b> квитків")
+        text = "\n".join(lines) + "\n"
+
+    _top_cache = (leaderboard.version, text)
+    return text
+
 @router.message(Command("top"))
 async def cmd_top(message: Message):
     """Handle /top command - show top referrers"""
-    session = get_session()
-    
-    # Get top 10 users by ticket count
-    top_users = session.query(User).order_by(User.ticket_count.desc()).limit(10).all()
-    
-    if not top_users:
+    top_text = render_top()
+
+    if not top_text:
         await message.answer("Поки що немає учасників з квитками.")
         return
-    
-    top_text = f"<b>🏆 ТОП 10 учасників за кількістю квитків:</b>\n\n"
-    
-    for i, user in enumerate(top_users, 1):
-        username = user.username or f"ID: {user.id}"
-        name_display = f"@{username}" if user.username else username
-        
-        top_text += f"{i}. {name_display} — <b>{user.ticket_count}</b> квитків\n"
-    
-    await message.answer(top_text)
\ No newline at end of file
+
+    # Add the place of the user who asked
+    rank = leaderboard.rank(message.from_user.id)
+    if rank:
+        top_text += f"\n📍 Ваше місце: <b>{rank}</b> з {len(leaderboard)}"
+
+    await message.answer(top_text)
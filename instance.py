@@ -1,10 +1,20 @@
 from aiogram import Bot
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
-from config import BOT_TOKEN
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from config import BOT_TOKEN, TELEGRAM_API_URL
+from middlewares.metrics import TelegramRequestMetrics
+
+# Requests go to api.telegram.org unless another Bot API server is configured
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
 
 # Initialize bot with proper default properties for aiogram 3.7.0+
 bot = Bot(
     token=BOT_TOKEN, 
+    session=session,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
-)
\ No newline at end of file
+)
+
+# Every API request is timed per method
+bot.session.middleware(TelegramRequestMetrics())
@@ -0,0 +1,161 @@
+"""Run the bot in several worker processes
+
+    python launcher.py                # WORKER_PROCESSES workers
+    python launcher.py --workers 4
+
+The launcher receives the updates (webhook or long polling, as BOT_MODE says)
+and forwards each one to a worker process picked by user id, so all updates
+of a user are handled by one process, in order. Workers share the database,
+FSM state (FSM_STORAGE must be "sql" or "redis") and reload the leaderboard
+when other workers changed tickets. Only worker 0 runs the draw scheduler,
+sends queued messages and resumes interrupted broadcasts.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import signal
+
+from aiogram.types import Update
+
+from config import (
+    BOT_MODE, FSM_STORAGE, LOG_LEVEL, METRICS_PORT, WORKER_PROCESSES, STATE_SYNC_INTERVAL, WEBHOOK_QUEUE_SIZE
+)
+from db.database import init_db
+from instance import bot
+from services.update_queue import UpdateQueue, shard_key
+from services.webhook import WebhookServer
+
+logger = logging.getLogger("launcher")
+
+
+class ProcessForwarder:
+    """Passes updates on to the worker process of their shard"""
+
+    def __init__(self, queues):
+        self.queues = queues
+
+    async def feed_update(self, bot, update):
+        queue = self.queues[shard_key(update) % len(self.queues)]
+        payload = update.model_dump(mode="json", by_alias=True, exclude_none=True)
+        # Blocks while the worker's queue is full, which holds back this shard
+        await asyncio.get_running_loop().run_in_executor(None, queue.put, payload)
+
+
+async def worker_main(index, queue):
+    from bot import create_dispatcher, scheduled_tasks, shutdown, shutdown_event, start_metrics_server
+    from services.broadcast import resume_broadcasts
+    from services.leaderboard import load_leaderboard, sync_leaderboard
+    from services.outbox import outbox
+    from services.referral_codes import load_referral_code_secret
+    from services.scheduler import draw_scheduler
+
+    dp = create_dispatcher()
+    load_referral_code_secret()
+    await load_leaderboard()
+
+    updates = UpdateQueue(dp, bot)
+    updates.start()
+    # One endpoint per worker, each process has its own counters
+    metrics_server = await start_metrics_server(METRICS_PORT + index if METRICS_PORT else 0)
+
+    tasks = [asyncio.create_task(sync_leaderboard(STATE_SYNC_INTERVAL, shutdown_event))]
+    if index == 0:
+        # Draws created by other workers are picked up when the schedule is reloaded
+        draw_scheduler.max_sleep = min(draw_scheduler.max_sleep, STATE_SYNC_INTERVAL)
+        tasks.append(asyncio.create_task(scheduled_tasks()))
+        # Messages queued by any worker are sent from here
+        tasks.append(asyncio.create_task(outbox.run(shutdown_event)))
+        await resume_broadcasts()
+
+    logger.info(f"Worker {index} started")
+    loop = asyncio.get_running_loop()
+    while True:
+        payload = await loop.run_in_executor(None, queue.get)
+        if payload is None:
+            break
+        await updates.put(Update.model_validate(payload, context={"bot": bot}))
+
+    await updates.stop()
+    logger.info(f"Worker {index} stopped: {updates.stats()}")
+    for task in tasks:
+        task.cancel()
+    if metrics_server:
+        await metrics_server.stop()
+    await shutdown(dp)
+
+def run_worker(index, queue):
+    logging.basicConfig(level=LOG_LEVEL, format=f"%(asctime)s [worker {index}] %(name)s %(levelname)s: %(message)s")
+    # The launcher stops the workers once it has forwarded everything it received
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(worker_main(index, queue))
+
+
+async def poll_updates(updates, allowed_updates, stop_event):
+    """Long polling that queues updates instead of handling them"""
+    await bot.delete_webhook()
+    offset = None
+    while not stop_event.is_set():
+        try:
+            batch = await bot.get_updates(offset=offset, timeout=10, allowed_updates=allowed_updates)
+        except Exception as e:
+            logger.error(f"Error getting updates: {e}")
+            await asyncio.sleep(1)
+            continue
+
+        for update in batch:
+            # Waiting for room here is the backpressure, Telegram keeps the rest
+            await updates.put(update)
+            offset = update.update_id + 1
+
+async def main(count):
+    from bot import create_dispatcher
+
+    init_db()  # Migrations run once, before the workers start
+
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue(maxsize=WEBHOOK_QUEUE_SIZE) for _ in range(count)]
+    workers = [ctx.Process(target=run_worker, args=(index, queue), name=f"worker-{index}")
+               for index, queue in enumerate(queues)]
+    for worker in workers:
+        worker.start()
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    # One front shard per worker process, shard i always goes to worker i
+    forwarder = ProcessForwarder(queues)
+    allowed_updates = create_dispatcher().resolve_used_update_types()
+    try:
+        if BOT_MODE == "webhook":
+            server = WebhookServer(forwarder, bot, workers=count)
+            await server.start(allowed_updates=allowed_updates)
+            await stop_event.wait()
+            await server.stop()
+            logger.info(f"Webhook stats: {server.stats()}")
+        else:
+            updates = UpdateQueue(forwarder, bot, workers=count)
+            updates.start()
+            await poll_updates(updates, allowed_updates, stop_event)
+            await updates.stop()
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            await loop.run_in_executor(None, worker.join)
+        await bot.session.close()
+        logger.info("All workers stopped")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the bot in several worker processes")
+    parser.add_argument("--workers", type=int, default=WORKER_PROCESSES)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s [launcher] %(name)s %(levelname)s: %(message)s")
+    if FSM_STORAGE == "memory":
+        raise SystemExit("FSM_STORAGE=memory can't be shared between worker processes, use sql or redis")
+    asyncio.run(main(args.workers))
@@ -1,11 +1,16 @@
+import logging
 from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import Message, TelegramObject
 from aiogram.exceptions import TelegramAPIError
 from config import CHANNEL_ID
 from instance import bot
+from services.invite_links import invite_links
+from services.membership import membership
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
+logger = logging.getLogger(__name__)
+
 class ChannelJoinMiddleware(BaseMiddleware):
     """Middleware to verify if a user has joined the channel"""
     
@@ -22,19 +27,11 @@ class ChannelJoinMiddleware(BaseMiddleware):
         # Check if user is subscribed to the channel
         try:
             user_id = event.from_user.id
-            member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-            
-            # Check member status - handle both string and enum cases
-            status = member.status
-            if isinstance(status, str):
-                member_status = status
-            else:
-                # For older versions of aiogram where status might be an enum
-                member_status = status.value
+            member_status = await membership.get_status(user_id)
                 
             # If user is not a member or left the channel
             if member_status in ['left', 'kicked', 'restricted']:
-                invite_link = await bot.export_chat_invite_link(CHANNEL_ID)
+                invite_link = await invite_links.get_link()
                 markup = InlineKeyboardMarkup(inline_keyboard=[
                     [InlineKeyboardButton(text="🔗 Перейти в канал", url=invite_link)],
                     [InlineKeyboardButton(text="✅ Я подписался", callback_data="check_join")]
@@ -47,7 +44,6 @@ class ChannelJoinMiddleware(BaseMiddleware):
                 
         except TelegramAPIError as e:
             # Log the error but continue processing
-            print(f"Error checking channel membership: {e}")
-            pass
+            logger.error(f"Error checking channel membership of {user_id}: {e}", exc_info=True)
             
         return await handler(event, data)
\ No newline at end of file
@@ -0,0 +1,34 @@
+import logging
+from typing import Callable, Dict, Any, Awaitable
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+from services.metrics import handler_errors
+
+logger = logging.getLogger(__name__)
+
+
+class ErrorHandlerMiddleware(BaseMiddleware):
+    """Log errors raised by handlers and tell the user something went wrong"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            handler_errors.inc(type(e).__name__)
+            user = getattr(event, "from_user", None)
+            logger.error(f"Error handling update from {user.id if user else 'unknown'}: {e}", exc_info=True)
+            try:
+                if isinstance(event, CallbackQuery):
+                    await event.answer("Сталася помилка. Спробуйте пізніше.", show_alert=True)
+                elif isinstance(event, Message):
+                    await event.answer("Сталася помилка. Спробуйте пізніше.")
+            except Exception as e:
+                logger.debug(f"Could not report the error to the user: {e}")
+            return None
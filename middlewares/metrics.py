@@ -0,0 +1,48 @@
+import time
+from typing import Callable, Dict, Any, Awaitable
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject
+
+from services.metrics import handler_duration, telegram_request_duration
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Time every handler call, labelled with the handler's module and name"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get("handler")
+        callback = getattr(handler_object, "callback", None)
+        name = f"{callback.__module__}.{callback.__name__}" if callback else "unknown"
+
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            return await handler(event, data)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            handler_duration.observe(time.perf_counter() - start, name, status)
+
+
+class TelegramRequestMetrics(BaseRequestMiddleware):
+    """Time every Bot API request made through the bot session"""
+
+    async def __call__(self, make_request, bot, method):
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            # e.g. TelegramRetryAfter, TelegramForbiddenError, TelegramNetworkError
+            status = type(e).__name__
+            raise
+        finally:
+            telegram_request_duration.observe(time.perf_counter() - start, method.__api_method__, status)
@@ -0,0 +1,114 @@
+import logging
+import time
+from collections import Counter
+from typing import Callable, Dict, Any, Awaitable
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+from config import ADMIN_IDS, RATE_LIMIT, THROTTLE_COMMAND_LIMITS
+from services.ratelimit import KeyedRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Seconds between sweeps of idle users
+SWEEP_INTERVAL = 60
+
+
+def _command(event):
+    """Command of a message without the slash and bot username, None for other updates"""
+    if isinstance(event, Message) and event.text and event.text.startswith("/"):
+        return event.text.split(maxsplit=1)[0][1:].split("@")[0].lower()
+    return None
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Drops updates of users who are over their rate limit
+
+    Every user may send `rate` updates per minute, commands in
+    `command_limits` have their own stricter limit on top. Registered before
+    ChannelJoinMiddleware, so a user hammering /me or /top is stopped before
+    any database or Telegram API work. The first dropped update of a burst
+    gets a short reply, the rest are dropped silently (callback queries get
+    an empty answer, which stops the spinner on the button).
+    """
+
+    def __init__(self, rate=RATE_LIMIT, command_limits=None, exempt=ADMIN_IDS, clock=time.monotonic):
+        self.clock = clock
+        self.exempt = set(exempt)
+        self.limiter = KeyedRateLimiter(rate, clock=clock)
+        command_limits = THROTTLE_COMMAND_LIMITS if command_limits is None else command_limits
+        self.command_limiters = {
+            command: KeyedRateLimiter(limit, clock=clock) for command, limit in command_limits.items()
+        }
+
+        self._warned = set()  # Users told they are over the limit since their last allowed update
+        self._swept_at = clock()
+
+        self.passed = 0
+        self.shed = Counter()  # command (or "callback"/"message") -> dropped updates
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = getattr(event, "from_user", None)
+        if user is None or user.id in self.exempt:
+            return await handler(event, data)
+
+        now = self.clock()
+        if now - self._swept_at >= SWEEP_INTERVAL:
+            self._sweep(now)
+
+        command = _command(event)
+        command_limiter = self.command_limiters.get(command)
+        limiters = [self.limiter] if command_limiter is None else [command_limiter, self.limiter]
+        # Both limits are checked before a token is taken, so a refused update uses up neither of them
+        if any(limiter.retry_after(user.id, now) > 0 for limiter in limiters):
+            self.shed[command or ("callback" if isinstance(event, CallbackQuery) else "message")] += 1
+            await self._reject(event, user.id, command_limiter, now)
+            return None
+
+        for limiter in limiters:
+            limiter.allow(user.id, now)
+        self._warned.discard(user.id)
+        self.passed += 1
+        return await handler(event, data)
+
+    async def _reject(self, event, user_id, command_limiter, now):
+        text = None
+        if user_id not in self._warned:
+            self._warned.add(user_id)
+            wait = self.limiter.retry_after(user_id, now)
+            if command_limiter is not None:
+                wait = max(wait, command_limiter.retry_after(user_id, now))
+            text = f"⏳ Забагато запитів. Спробуйте через {int(wait) + 1} с."
+
+        try:
+            if isinstance(event, CallbackQuery):
+                # Answered even when already warned, the button keeps spinning otherwise
+                await event.answer(text, show_alert=text is not None)
+            elif isinstance(event, Message) and text:
+                await event.answer(text)
+        except Exception as e:
+            logger.debug(f"Could not answer the rate limited update of user {user_id}: {e}")
+
+    def _sweep(self, now):
+        self._swept_at = now
+        dropped = self.limiter.sweep(now)
+        for limiter in self.command_limiters.values():
+            limiter.sweep(now)
+        # Users whose limits were forgotten are not over them anymore
+        self._warned = {user_id for user_id in self._warned if user_id in self.limiter}
+        if dropped:
+            logger.debug(f"Forgot {dropped} idle users, tracking {len(self.limiter)}")
+
+    def stats(self):
+        return {
+            "passed": self.passed,
+            "shed": sum(self.shed.values()),
+            "shed_by_command": dict(self.shed),
+            "tracked_users": len(self.limiter)
+        }
@@ -0,0 +1,54 @@
+from sqlalchemy import func
+
+from db.database import run_db
+from db.models import User, Referral, Counter
+
+# Sum of ticket_count over all users
+TICKET_TOTAL = "ticket_total"
+# Bumped by every change of anybody's tickets, a credit and a revocation can leave the total as it was
+TICKET_VERSION = "ticket_version"
+
+def get_counter(session, name):
+    row = session.query(Counter.value).filter(Counter.name == name).first()
+    return row[0] if row else 0
+
+def add_to_counter(session, name, delta):
+    """Increment a counter in SQL, so concurrent transactions don't lose updates"""
+    updated = session.query(Counter).filter(Counter.name == name).update(
+        {Counter.value: Counter.value + delta}, synchronize_session=False
+    )
+    if not updated:
+        session.add(Counter(name=name, value=delta))
+
+def record_referral(session, referrer_id, tickets, count=1):
+    """Update the aggregates for a new referral (negative values for a revoked one), in the caller's transaction"""
+    session.query(User).filter(User.id == referrer_id).update(
+        {User.referral_count: User.referral_count + count}, synchronize_session=False
+    )
+    add_to_counter(session, TICKET_TOTAL, tickets)
+    add_to_counter(session, TICKET_VERSION, 1)
+
+def _rebuild_aggregates(session):
+    total = session.query(func.coalesce(func.sum(User.ticket_count), 0)).filter(User.ticket_count > 0).scalar()
+    session.merge(Counter(name=TICKET_TOTAL, value=total))
+    add_to_counter(session, TICKET_VERSION, 1)
+
+    referral_counts = session.query(func.count(Referral.id)).filter(
+        Referral.referrer_id == User.id,
+        Referral.revoked_at.is_(None)
+    ).scalar_subquery()
+    session.query(User).update({User.referral_count: referral_counts}, synchronize_session=False)
+
+    return {"ticket_total": total}
+
+async def rebuild_aggregates():
+    """Recompute all aggregates from the users and referrals tables"""
+    return await run_db(_rebuild_aggregates)
+
+if __name__ == "__main__":
+    import asyncio
+    from db.database import init_db, close_db
+
+    init_db()
+    print(asyncio.run(rebuild_aggregates()))
+    close_db()
@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from sqlalchemy import func
+
+from config import BROADCAST_RATE, BROADCAST_WORKERS, BROADCAST_CHUNK, BROADCAST_PROGRESS_INTERVAL
+from db.database import run_db
+from db.models import User, Broadcast, BroadcastDelivery
+from instance import bot
+from services.outbox import outbox
+from services.ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+MAX_RETRIES = 3
+
+# Broadcasts running in this process, broadcast_id -> task
+_running = {}
+
+
+def _create_broadcast(session, text, progress_chat_id, progress_message_id):
+    total = session.query(func.count(User.id)).filter(User.is_blocked.is_(False)).scalar()
+    broadcast = Broadcast(
+        text=text,
+        total=total,
+        progress_chat_id=progress_chat_id,
+        progress_message_id=progress_message_id
+    )
+    session.add(broadcast)
+    session.flush()
+    return broadcast.id
+
+def _get_broadcast(session, broadcast_id):
+    broadcast = session.query(Broadcast).filter(Broadcast.id == broadcast_id).first()
+    if not broadcast:
+        return None
+    return {
+        "id": broadcast.id,
+        "text": broadcast.text,
+        "status": broadcast.status,
+        "last_user_id": broadcast.last_user_id,
+        "total": broadcast.total,
+        "progress_chat_id": broadcast.progress_chat_id,
+        "progress_message_id": broadcast.progress_message_id
+    }
+
+def _get_running_ids(session):
+    return [row[0] for row in session.query(Broadcast.id).filter(Broadcast.status == "running")]
+
+def _count_deliveries(session, broadcast_id):
+    rows = session.query(BroadcastDelivery.status, func.count()).filter(
+        BroadcastDelivery.broadcast_id == broadcast_id
+    ).group_by(BroadcastDelivery.status).all()
+    return dict(rows)
+
+def _next_recipients(session, after_user_id, limit):
+    # Keyset pagination on the primary key, no OFFSET scans
+    return [row[0] for row in session.query(User.id).filter(
+        User.id > after_user_id,
+        User.is_blocked.is_(False)
+    ).order_by(User.id).limit(limit)]
+
+def _save_chunk(session, broadcast_id, results, last_user_id):
+    # Deliveries and the cursor are saved together, a crash resends at most one chunk
+    session.bulk_insert_mappings(BroadcastDelivery, [
+        {"broadcast_id": broadcast_id, "user_id": user_id, "status": status}
+        for user_id, status in results.items()
+    ])
+    session.query(Broadcast).filter(Broadcast.id == broadcast_id).update({Broadcast.last_user_id: last_user_id})
+
+    blocked = [user_id for user_id, status in results.items() if status == "blocked"]
+    if blocked:
+        session.query(User).filter(User.id.in_(blocked)).update({User.is_blocked: True}, synchronize_session=False)
+
+def _finish_broadcast(session, broadcast_id):
+    session.query(Broadcast).filter(Broadcast.id == broadcast_id).update({
+        Broadcast.status: "completed",
+        Broadcast.finished_at: datetime.utcnow()
+    })
+
+
+class BroadcastProgress:
+    """Counts of a broadcast run and the throughput since it (re)started"""
+
+    def __init__(self, broadcast_id, total, counts):
+        self.broadcast_id = broadcast_id
+        self.total = total
+        self.sent = counts.get("sent", 0)
+        self.blocked = counts.get("blocked", 0)
+        self.failed = counts.get("failed", 0)
+        self.started_at = time.monotonic()
+        self._done_at_start = self.done
+
+    @property
+    def done(self):
+        return self.sent + self.blocked + self.failed
+
+    def add(self, status):
+        setattr(self, status, getattr(self, status) + 1)
+
+    def rate(self):
+        elapsed = time.monotonic() - self.started_at
+        return (self.done - self._done_at_start) / elapsed if elapsed > 0 else 0.0
+
+    def render(self, finished=False):
+        # Users who joined during the broadcast receive it too
+        total = max(self.total, self.done)
+        percent = self.done / total * 100 if total else 100
+        rate = self.rate()
+        if finished:
+            header = f"🏁 <b>Розсилку #{self.broadcast_id} завершено</b>"
+            eta = ""
+        else:
+            header = f"📣 <b>Розсилка #{self.broadcast_id}</b>"
+            remaining = (total - self.done) / rate if rate else None
+            eta = f"\n⏳ Залишилось: ~{_format_duration(remaining)}" if remaining is not None else ""
+        return (
+            f"{header}\n\n"
+            f"✅ Надіслано: <b>{self.sent}</b>\n"
+            f"🚫 Заблокували бота: <b>{self.blocked}</b>\n"
+            f"⚠️ Помилки: <b>{self.failed}</b>\n"
+            f"📊 Прогрес: <b>{self.done}</b> з {total} ({percent:.0f}%)\n"
+            f"⚡ Швидкість: <b>{rate:.1f}</b> повідомлень/с"
+            f"{eta}"
+        )
+
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours} год {minutes} хв"
+    if minutes:
+        return f"{minutes} хв {seconds} с"
+    return f"{seconds} с"
+
+
+async def _deliver(user_id, text, bucket):
+    """Send the broadcast to one user, returns the delivery status"""
+    attempt = 0
+    while True:
+        await bucket.acquire()
+        # Queued announcements and replies go first
+        await outbox.acquire_bulk()
+        try:
+            await bot.send_message(user_id, text)
+            return "sent"
+        except TelegramRetryAfter as e:
+            # Slow the whole broadcast down, not just this recipient. A private chat's flood control
+            # applies to the whole bot, the outbox has to wait as well
+            logger.warning(f"Flood control during broadcast, waiting {e.retry_after}s")
+            bucket.pause(e.retry_after)
+            outbox.global_bucket.pause(e.retry_after)
+        except TelegramForbiddenError:
+            return "blocked"
+        except TelegramBadRequest as e:
+            logger.warning(f"Broadcast to {user_id} rejected: {e}")
+            return "failed"
+        except Exception as e:
+            attempt += 1
+            if attempt >= MAX_RETRIES:
+                logger.error(f"Broadcast to {user_id} failed: {e}")
+                return "failed"
+            await asyncio.sleep(2 ** attempt)
+
+async def _send_chunk(user_ids, text, bucket, progress, workers):
+    queue = asyncio.Queue()
+    for user_id in user_ids:
+        queue.put_nowait(user_id)
+    results = {}
+
+    async def worker():
+        while not queue.empty():
+            user_id = queue.get_nowait()
+            results[user_id] = await _deliver(user_id, text, bucket)
+            progress.add(results[user_id])
+
+    await asyncio.gather(*(worker() for _ in range(min(workers, len(user_ids)))))
+    return results
+
+async def _report(broadcast, progress, finished=False):
+    if not broadcast["progress_chat_id"]:
+        return
+    try:
+        await bot.edit_message_text(
+            progress.render(finished),
+            chat_id=broadcast["progress_chat_id"],
+            message_id=broadcast["progress_message_id"]
+        )
+    except Exception as e:
+        # "message is not modified" and the like must not stop the broadcast
+        logger.debug(f"Could not update broadcast progress: {e}")
+
+async def run_broadcast(broadcast_id, rate=BROADCAST_RATE, workers=BROADCAST_WORKERS, chunk_size=BROADCAST_CHUNK):
+    """Send a broadcast to everybody who hasn't received it yet, resuming from its cursor"""
+    broadcast = await run_db(_get_broadcast, broadcast_id)
+    if not broadcast or broadcast["status"] != "running":
+        return None
+
+    progress = BroadcastProgress(broadcast_id, broadcast["total"], await run_db(_count_deliveries, broadcast_id))
+    bucket = TokenBucket(rate)
+    cursor = broadcast["last_user_id"]
+    reported_at = time.monotonic()
+
+    while True:
+        user_ids = await run_db(_next_recipients, cursor, chunk_size)
+        if not user_ids:
+            break
+
+        results = await _send_chunk(user_ids, broadcast["text"], bucket, progress, workers)
+        cursor = user_ids[-1]
+        await run_db(_save_chunk, broadcast_id, results, cursor)
+
+        if time.monotonic() - reported_at >= BROADCAST_PROGRESS_INTERVAL:
+            await _report(broadcast, progress)
+            reported_at = time.monotonic()
+
+    await run_db(_finish_broadcast, broadcast_id)
+    await _report(broadcast, progress, finished=True)
+    logger.info(f"Broadcast #{broadcast_id} completed: {progress.sent} sent, "
+                f"{progress.blocked} blocked, {progress.failed} failed")
+    return progress
+
+def _spawn(broadcast_id):
+    if broadcast_id in _running:
+        return _running[broadcast_id]
+    task = asyncio.create_task(run_broadcast(broadcast_id))
+    _running[broadcast_id] = task
+    task.add_done_callback(lambda task: _broadcast_done(broadcast_id, task))
+    return task
+
+def _broadcast_done(broadcast_id, task):
+    _running.pop(broadcast_id, None)
+    if not task.cancelled() and task.exception():
+        # Left "running", it is resumed on the next start
+        logger.error(f"Broadcast #{broadcast_id} stopped: {task.exception()}", exc_info=task.exception())
+
+async def start_broadcast(text, progress_chat_id=None, progress_message_id=None):
+    """Create a broadcast and send it in the background, returns its ID"""
+    broadcast_id = await run_db(_create_broadcast, text, progress_chat_id, progress_message_id)
+    _spawn(broadcast_id)
+    return broadcast_id
+
+async def resume_broadcasts():
+    """Continue broadcasts interrupted by a restart"""
+    for broadcast_id in await run_db(_get_running_ids):
+        logger.info(f"Resuming broadcast #{broadcast_id}")
+        _spawn(broadcast_id)
@@ -0,0 +1,206 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+from config import (
+    BULK_VERIFY_RATE,
+    BULK_VERIFY_WORKERS,
+    BULK_VERIFY_MAX_RETRIES,
+    BULK_VERIFY_CHECKPOINT_BATCH,
+)
+from db.database import run_db
+from db.models import MembershipCheck, User
+from services.membership import membership, MEMBER_STATUSES
+from services.ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class VerificationResult:
+    """Outcome of a bulk membership check"""
+
+    def __init__(self):
+        self.members = set()
+        self.non_members = set()
+        # Lookups that kept failing - these users are neither confirmed nor rejected
+        self.failed = set()
+
+    @property
+    def complete(self):
+        return not self.failed
+
+    def __repr__(self):
+        return (
+            f"<VerificationResult members={len(self.members)} "
+            f"non_members={len(self.non_members)} failed={len(self.failed)}>"
+        )
+
+
+def _load_checkpoint(session, job):
+    rows = session.query(MembershipCheck.user_id, MembershipCheck.is_member).filter(
+        MembershipCheck.job == job
+    ).all()
+    return dict(rows)
+
+
+async def load_checkpoint(job):
+    """Load results already saved for a verification job"""
+    return await run_db(_load_checkpoint, job)
+
+
+def _save_checkpoint(session, job, results):
+    now = datetime.utcnow()
+    session.bulk_insert_mappings(MembershipCheck, [
+        {"job": job, "user_id": user_id, "is_member": is_member, "checked_at": now}
+        for user_id, is_member in results.items()
+    ])
+
+
+async def save_checkpoint(job, results):
+    """Save a batch of {user_id: is_member} results for a verification job"""
+    if results:
+        await run_db(_save_checkpoint, job, results)
+
+
+def _clear_checkpoint(session, job):
+    session.query(MembershipCheck).filter(MembershipCheck.job == job).delete()
+
+
+async def clear_checkpoint(job):
+    """Forget saved results once the job they belong to is finished"""
+    await run_db(_clear_checkpoint, job)
+
+
+def _load_member_status(session, user_ids, since):
+    rows = session.query(User.id, User.is_member).filter(
+        User.id.in_(user_ids),
+        User.member_checked_at >= since,
+        User.is_member.isnot(None)
+    ).all()
+    return dict(rows)
+
+
+async def load_member_status(user_ids, since):
+    """Membership results stored on the users since the given time, {user_id: is_member}"""
+    result = {}
+    user_ids = list(user_ids)
+    # Chunked to stay under the bound parameter limit
+    for start in range(0, len(user_ids), 500):
+        result.update(await run_db(_load_member_status, user_ids[start:start + 500], since))
+    return result
+
+
+def _save_member_status(session, results, checked_at):
+    for is_member in (True, False):
+        user_ids = [user_id for user_id, value in results.items() if value is is_member]
+        for start in range(0, len(user_ids), 500):
+            session.query(User).filter(User.id.in_(user_ids[start:start + 500])).update(
+                {User.is_member: is_member, User.member_checked_at: checked_at}, synchronize_session=False
+            )
+
+
+async def save_member_status(results):
+    """Store {user_id: is_member} results on the users"""
+    if results:
+        await run_db(_save_member_status, results, datetime.utcnow())
+
+
+async def _check(user_id, bucket, max_retries):
+    """Check one user, returns True/False or raises after max_retries failed attempts"""
+    attempt = 0
+    while True:
+        await bucket.acquire()
+        try:
+            status = await membership.get_status(user_id)
+            return status in MEMBER_STATUSES
+        except TelegramRetryAfter as e:
+            # Flood control applies to the whole bot, so every worker has to wait
+            logger.warning(f"Flood control while verifying members, waiting {e.retry_after}s")
+            bucket.pause(e.retry_after)
+        except TelegramBadRequest:
+            # Telegram doesn't know this user as a participant of the channel
+            return False
+        except (TelegramNetworkError, TelegramServerError):
+            attempt += 1
+            if attempt >= max_retries:
+                raise
+            await asyncio.sleep(min(2 ** attempt, 30))
+
+
+async def verify_members(user_ids, job=None, rate=BULK_VERIFY_RATE,
+                         workers=BULK_VERIFY_WORKERS, max_retries=BULK_VERIFY_MAX_RETRIES,
+                         max_age=None, bucket=None, result=None):
+    """Check channel membership of many users without flooding the Telegram API
+
+    When a job name is given, results are checkpointed to the database and a
+    repeated call with the same job only checks the users that are left.
+    Results are also stored on the users; with max_age, results stored less
+    than max_age seconds ago are reused instead of asking Telegram again.
+    Pass a bucket to share the rate limit between calls and a result to
+    collect several calls into it (and watch it fill up).
+    """
+    result = result if result is not None else VerificationResult()
+    user_ids = list(dict.fromkeys(user_ids))
+
+    # Resume from the saved checkpoint
+    done = await load_checkpoint(job) if job else {}
+    if max_age is not None:
+        fresh = await load_member_status(user_ids, datetime.utcnow() - timedelta(seconds=max_age))
+        done = {**fresh, **done}
+    for user_id, is_member in done.items():
+        (result.members if is_member else result.non_members).add(user_id)
+
+    queue = asyncio.Queue()
+    for user_id in user_ids:
+        if user_id not in done:
+            queue.put_nowait(user_id)
+
+    if queue.empty():
+        return result
+
+    logger.info(f"Verifying {queue.qsize()} users ({len(done)} restored from checkpoint or earlier checks)")
+
+    bucket = bucket or TokenBucket(rate)
+    unsaved = {}
+
+    async def save(batch):
+        if job:
+            await save_checkpoint(job, batch)
+        await save_member_status(batch)
+
+    async def worker():
+        while True:
+            try:
+                user_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+            try:
+                is_member = await _check(user_id, bucket, max_retries)
+            except Exception as e:
+                logger.error(f"Failed to verify user {user_id}: {e}")
+                result.failed.add(user_id)
+                continue
+
+            (result.members if is_member else result.non_members).add(user_id)
+            unsaved[user_id] = is_member
+            if len(unsaved) >= BULK_VERIFY_CHECKPOINT_BATCH:
+                batch = dict(unsaved)
+                unsaved.clear()
+                await save(batch)
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, workers))))
+    finally:
+        # Keep whatever was checked even if the run is interrupted or cancelled
+        await asyncio.shield(save(unsaved))
+
+    logger.info(f"Verification finished: {result}")
+    return result
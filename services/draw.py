@@ -1,49 +1,65 @@
-import random
-from db.database import get_session
+from datetime import datetime
+from db.database import run_db
 from db.models import User, Draw
 from sqlalchemy import func
+from services.sampling import WeightedSampler, new_seed
 
-async def conduct_draw(prize_description=None):
-    """Conduct a weighted random draw"""
-    session = get_session()
-    
+def _conduct_draw(session, prize_description, winners):
     # Get all users with tickets
-    users_with_tickets = session.query(User).filter(User.ticket_count > 0).all()
-    
+    users_with_tickets = session.query(User.id, User.ticket_count).filter(User.ticket_count > 0).all()
+
     if not users_with_tickets:
         return None  # No eligible participants
-    
-    # Prepare user IDs and weights for random.choices
-    user_ids = [user.id for user in users_with_tickets]
-    weights = [user.ticket_count for user in users_with_tickets]
-    
+
+    # Prepare user IDs and weights for the sampler
+    sampler = WeightedSampler(
+        [user.id for user in users_with_tickets],
+        [user.ticket_count for user in users_with_tickets]
+    )
+
     # Calculate total tickets
-    total_tickets = sum(weights)
-    
-    # Select a winner based on ticket weights
-    winner_id = random.choices(user_ids, weights=weights, k=1)[0]
-    
+    total_tickets = sampler.total
+
+    # Select distinct winners based on ticket weights
+    seed = new_seed()
+    winner_ids = sampler.sample(winners, seed=seed)
+
     # Create draw record
     draw = Draw(
-        winner_id=winner_id,
+        status="completed",
+        ended_at=datetime.utcnow(),
+        winner_id=winner_ids[0],
         total_tickets=total_tickets,
-        prize_description=prize_description
+        prize_description=prize_description,
+        seed=seed
     )
-    
+
     session.add(draw)
-    session.commit()
-    
+    session.flush()
+
     # Get winner details for return
-    winner = session.query(User).filter(User.id == winner_id).first()
-    
-    result = {
-        "winner_id": winner.id,
-        "winner_username": winner.username,
-        "winner_first_name": winner.first_name,
-        "winner_tickets": winner.ticket_count,
+    users = {user.id: user for user in session.query(User).filter(User.id.in_(winner_ids))}
+    placed = [
+        {
+            "winner_id": user.id,
+            "winner_username": user.username,
+            "winner_first_name": user.first_name,
+            "winner_tickets": user.ticket_count,
+            "win_chance": (user.ticket_count / total_tickets) * 100
+        }
+        for user in (users[winner_id] for winner_id in winner_ids)
+    ]
+
+    result = dict(placed[0])
+    result.update({
         "total_tickets": total_tickets,
-        "win_chance": (winner.ticket_count / total_tickets) * 100,
-        "draw_id": draw.id
-    }
-    
-    return result
\ No newline at end of file
+        "draw_id": draw.id,
+        "seed": seed,
+        "winners": placed
+    })
+
+    return result
+
+async def conduct_draw(prize_description=None, winners=1):
+    """Conduct a weighted random draw, winners are distinct users in the order they were drawn"""
+    return await run_db(_conduct_draw, prize_description, winners)
@@ -1,19 +1,29 @@
 from datetime import datetime, timedelta
-import random
 from sqlalchemy import desc
-from db.database import get_session
+from db.database import run_db
 from db.models import User, Draw
-from config import CHANNEL_ID
+from config import CHANNEL_ID, DRAW_FINALIZE_CONCURRENCY, VERIFY_RESULT_MAX_AGE
 from instance import bot
+from services.membership import membership
+from services.bulk_verify import verify_members, clear_checkpoint
+from services.scheduler import draw_scheduler
+from services.sampling import WeightedSampler, new_seed
+from services.ledger import carry_over_tickets, get_draw_participants
+from services.metrics import draw_finalize_duration
 import asyncio
+import logging
+import time
 
-async def create_draw(name, prize_description, days_duration=7):
-    """Create a new draw with scheduled end date"""
-    session = get_session()
-    
+logger = logging.getLogger(__name__)
+
+# Checkpoint of the membership checks for scheduled draws. One name for every run, so a retry of the draws
+# left pending reuses the results whichever draws finished in between
+SCHEDULED_JOB = "draws:scheduled"
+
+def _create_draw(session, name, prize_description, days_duration, carry_over):
     # Calculate end date based on duration
     end_date = datetime.utcnow() + timedelta(days=days_duration)
-    
+
     # Create the draw
     draw = Draw(
         name=name,
@@ -21,10 +31,13 @@ async def create_draw(name, prize_description, days_duration=7):
         scheduled_end=end_date,
         status="active"
     )
-    
+
     session.add(draw)
-    session.commit()
-    
+    session.flush()
+
+    if carry_over:
+        carry_over_tickets(session, draw.id)
+
     return {
         "id": draw.id,
         "name": draw.name,
@@ -32,11 +45,22 @@ async def create_draw(name, prize_description, days_duration=7):
         "end_date": draw.scheduled_end
     }
 
-async def get_active_draws():
-    """Get list of active draws"""
-    session = get_session()
+async def create_draw(name, prize_description, days_duration=7, carry_over=False, schedule=True):
+    """Create a new draw with scheduled end date
+
+    Only referrals made while the draw runs count in it, unless carry_over is
+    set - then it starts with everybody's lifetime tickets. A draw the caller
+    ends right away is created with schedule=False, so the scheduler doesn't
+    end it a second time.
+    """
+    result = await run_db(_create_draw, name, prize_description, days_duration, carry_over)
+    if schedule:
+        draw_scheduler.schedule(result["id"], result["end_date"])
+    return result
+
+def _get_active_draws(session):
     draws = session.query(Draw).filter(Draw.status == "active").all()
-    
+
     result = []
     for draw in draws:
         result.append({
@@ -46,19 +70,19 @@ async def get_active_draws():
             "end_date": draw.scheduled_end,
             "days_left": (draw.scheduled_end - datetime.utcnow()).days if draw.scheduled_end else None
         })
-    
-    session.close()
+
     return result
 
-async def get_draw_details(draw_id):
-    """Get details of a specific draw"""
-    session = get_session()
+async def get_active_draws():
+    """Get list of active draws"""
+    return await run_db(_get_active_draws)
+
+def _get_draw_details(session, draw_id):
     draw = session.query(Draw).filter(Draw.id == draw_id).first()
-    
+
     if not draw:
-        session.close()
         return None
-    
+
     result = {
         "id": draw.id,
         "name": draw.name,
@@ -69,108 +93,175 @@ async def get_draw_details(draw_id):
         "ended_at": draw.ended_at,
         "winner_id": draw.winner_id
     }
-    
+
     # Add winner details if available
     if draw.winner_id:
         winner = session.query(User).filter(User.id == draw.winner_id).first()
         if winner:
             result["winner_username"] = winner.username
             result["winner_first_name"] = winner.first_name
-    
-    session.close()
+
     return result
 
-import asyncio
+async def get_draw_details(draw_id):
+    """Get details of a specific draw"""
+    return await run_db(_get_draw_details, draw_id)
 
 async def check_channel_membership(user_id):
     try:
-        member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-        status = member.status if isinstance(member.status, str) else member.status.value
-        return status in ["member", "administrator", "creator"]
+        return await membership.is_member(user_id)
     except Exception:
         return False
 
-async def end_draw(draw_id):
-    session = get_session()
+def _get_participants(session, draw_id):
     draw = session.query(Draw).filter(Draw.id == draw_id).first()
     if not draw or draw.status != "active":
-        session.close()
         return None
+    # Tickets earned in this draw, not lifetime tickets
+    return get_draw_participants(session, [draw_id])
 
-    users_with_tickets = session.query(User).filter(User.ticket_count > 0).all()
-    if not users_with_tickets:
-        draw.status = "completed"
-        draw.ended_at = datetime.utcnow()
-        session.commit()
-        session.close()
-        return {"status": "completed", "message": "No eligible participants"}
-
-    # Асинхронно проверяем всех
-    checks = await asyncio.gather(
-        *(check_channel_membership(u.id) for u in users_with_tickets)
-    )
-    eligible_users = [u for u, is_member in zip(users_with_tickets, checks) if is_member]
+def _complete_draw(session, draw_id, participants, eligible_ids):
+    # The draw could have been ended or cancelled while members were being checked
+    draw = session.query(Draw).filter(Draw.id == draw_id).first()
+    if not draw or draw.status != "active":
+        return None
+
+    draw.status = "completed"
+    draw.ended_at = datetime.utcnow()
+
+    if not participants:
+        return {"status": "completed", "draw_id": draw_id, "message": "No eligible participants"}
 
+    eligible_users = [p for p in participants if p.user_id in eligible_ids]
     if not eligible_users:
-        draw.status = "completed"
-        draw.ended_at = datetime.utcnow()
-        session.commit()
-        session.close()
-        return {"status": "completed", "message": "No eligible participants who are channel members"}
-
-    user_ids = [u.id for u in eligible_users]
-    weights = [u.ticket_count for u in eligible_users]
-    winner_id = random.choices(user_ids, weights=weights, k=1)[0]
+        return {"status": "completed", "draw_id": draw_id, "message": "No eligible participants who are channel members"}
+
+    sampler = WeightedSampler([u.user_id for u in eligible_users], [u.tickets for u in eligible_users])
+    seed = new_seed()
+    winner_id = sampler.sample(1, seed=seed)[0]
     winner = session.query(User).filter(User.id == winner_id).first()
+    winner_tickets = next(u.tickets for u in eligible_users if u.user_id == winner_id)
 
+    total_tickets = sampler.total
     draw.winner_id = winner_id
-    draw.total_tickets = sum(weights)
-    draw.status = "completed"
-    draw.ended_at = datetime.utcnow()
-    session.commit()
-    session.close()
+    draw.total_tickets = total_tickets
+    draw.seed = seed
     return {
         "draw_id": draw.id,
+        "draw_name": draw.name,
         "winner_id": winner.id,
         "winner_username": winner.username,
         "winner_first_name": winner.first_name,
-        "winner_tickets": winner.ticket_count,
-        "total_tickets": sum(weights),
-        "prize": draw.prize_description
+        "winner_tickets": winner_tickets,
+        "total_tickets": total_tickets,
+        "win_chance": winner_tickets / total_tickets * 100,
+        "eligible_users_count": len(eligible_users),
+        "total_users_count": len(participants),
+        "prize": draw.prize_description,
+        "seed": seed
     }
 
-async def check_scheduled_draws():
-    """Check for draws that should be ended based on schedule"""
-    session = get_session()
-    now = datetime.utcnow()
-    
+async def end_draw(draw_id, snapshot=None):
+    """End a draw and pick a winner among participants who are channel members
+
+    snapshot is a VerificationResult shared by several draws ending at once,
+    without it the participants of this draw are verified here.
+    """
+    participants = await run_db(_get_participants, draw_id)
+    if participants is None:
+        return None
+
+    if not participants:
+        draw_scheduler.unschedule(draw_id)
+        return await run_db(_complete_draw, draw_id, participants, set())
+
+    job = f"draw:{draw_id}"
+    if snapshot is None:
+        # Check membership with a rate limit, resuming from the checkpoint of an interrupted run
+        snapshot = await verify_members([p.user_id for p in participants], job=job, max_age=VERIFY_RESULT_MAX_AGE)
+
+    failed = [p.user_id for p in participants if p.user_id in snapshot.failed]
+    if failed:
+        # Don't count users we couldn't check as non-members, try again later
+        return {
+            "status": "pending",
+            "draw_id": draw_id,
+            "message": f"Could not verify {len(failed)} participants, try again later",
+            "failed_count": len(failed)
+        }
+
+    result = await run_db(_complete_draw, draw_id, participants, snapshot.members)
+    # Also left over when an earlier /draw of it stayed pending
+    await clear_checkpoint(job)
+    draw_scheduler.unschedule(draw_id)
+    return result
+
+def _get_due_draw_ids(session, now, draw_ids=None):
     # Find active draws that have reached their scheduled end time
-    draws_to_end = session.query(Draw).filter(
+    query = session.query(Draw.id).filter(
         Draw.status == "active",
         Draw.scheduled_end <= now
-    ).all()
-    
-    results = []
-    for draw in draws_to_end:
-        # End each draw and collect results
-        draw_result = await end_draw(draw.id)
-        if draw_result:
-            results.append(draw_result)
-    
+    )
+    if draw_ids is not None:
+        query = query.filter(Draw.id.in_(draw_ids))
+    return [row[0] for row in query]
+
+def _get_participant_ids(session, draw_ids):
+    return {row.user_id for row in get_draw_participants(session, draw_ids)}
+
+async def _end_draw_isolated(draw_id, snapshot, semaphore):
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            result = await end_draw(draw_id, snapshot)
+        except Exception as e:
+            # One broken draw must not keep the others from finishing
+            logger.error(f"Error ending draw #{draw_id}: {e}", exc_info=True)
+            result = {"status": "error", "draw_id": draw_id, "message": str(e)}
+        status = result.get("status", "completed") if result else "skipped"
+        draw_finalize_duration.observe(time.perf_counter() - start, status)
+        return result
+
+async def check_scheduled_draws(draw_ids=None):
+    """End the draws whose scheduled end has passed
+
+    With draw_ids only those are ended, e.g. the ones the scheduler found due,
+    so a draw postponed with a retry delay isn't retried early.
+    """
+    draws_to_end = await run_db(_get_due_draw_ids, datetime.utcnow(), draw_ids)
+    if not draws_to_end:
+        return []
+
+    # Verify the participants once for all draws ending now
+    participant_ids = await run_db(_get_participant_ids, draws_to_end)
+    snapshot = await verify_members(participant_ids, job=SCHEDULED_JOB, max_age=VERIFY_RESULT_MAX_AGE)
+
+    # End the draws concurrently, each one on its own
+    semaphore = asyncio.Semaphore(DRAW_FINALIZE_CONCURRENCY)
+    results = await asyncio.gather(
+        *(_end_draw_isolated(draw_id, snapshot, semaphore) for draw_id in draws_to_end)
+    )
+    results = [result for result in results if result]
+
+    # Kept while a draw is left to retry, the next run only checks the users still missing
+    if not any(result.get("status") in ("pending", "error") for result in results):
+        await clear_checkpoint(SCHEDULED_JOB)
+
     return results
 
-async def cancel_draw(draw_id):
-    """Cancel an active draw"""
-    session = get_session()
+def _cancel_draw(session, draw_id):
     draw = session.query(Draw).filter(Draw.id == draw_id).first()
-    
+
     if not draw or draw.status != "active":
-        session.close()
         return False
-    
+
     draw.status = "cancelled"
     draw.ended_at = datetime.utcnow()
-    
-    session.commit()
-    session.close()
-    return True
\ No newline at end of file
+    return True
+
+async def cancel_draw(draw_id):
+    """Cancel an active draw"""
+    cancelled = await run_db(_cancel_draw, draw_id)
+    if cancelled:
+        draw_scheduler.unschedule(draw_id)
+    return cancelled
@@ -0,0 +1,74 @@
+import numpy as np
+
+
+class FenwickTree:
+    """Binary indexed tree: point updates and prefix sums in O(log n)"""
+
+    def __init__(self, size):
+        self.size = size
+        self._tree = [0] * (size + 1)
+
+    @classmethod
+    def from_values(cls, values):
+        """Build a tree over a list of values in O(n)"""
+        tree = cls(len(values))
+        data = tree._tree
+        for i, value in enumerate(values, 1):
+            data[i] += value
+            parent = i + (i & -i)
+            if parent <= tree.size:
+                data[parent] += data[i]
+        return tree
+
+    @classmethod
+    def from_array(cls, values):
+        """Build a tree over an array of integers, vectorized with NumPy
+
+        The tree is kept in an int64 array, for large weight tables where a
+        Python list would cost much more to build and hold.
+        """
+        values = np.asarray(values, dtype=np.int64)
+        tree = cls.__new__(cls)
+        tree.size = len(values)
+        # tree[i] = sum of values[i - lowbit(i) .. i - 1], computed from prefix sums at once
+        prefix = np.zeros(tree.size + 1, dtype=np.int64)
+        np.cumsum(values, out=prefix[1:])
+        index = np.arange(tree.size + 1, dtype=np.int64)
+        tree._tree = prefix - prefix[index - (index & -index)]
+        return tree
+
+    def add(self, index, delta):
+        """Add delta to the value at index (0-based)"""
+        i = index + 1
+        while i <= self.size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, count):
+        """Sum of the first count values"""
+        total = 0
+        i = min(count, self.size)
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def total(self):
+        return self.prefix_sum(self.size)
+
+    def find(self, target):
+        """Smallest index whose prefix sum (inclusive) exceeds target
+
+        With non-negative values this maps a number in [0, total) to the
+        slot it falls into, which is what weighted sampling needs.
+        """
+        position = 0
+        remaining = target
+        step = 1 << self.size.bit_length()
+        while step:
+            nxt = position + step
+            if nxt <= self.size and self._tree[nxt] <= remaining:
+                position = nxt
+                remaining -= self._tree[nxt]
+            step >>= 1
+        return position
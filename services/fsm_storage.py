@@ -0,0 +1,70 @@
+import json
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config import FSM_STORAGE, REDIS_URL
+from db.database import run_db
+from db.models import FsmState
+
+
+def _get_row(session, key):
+    return session.query(FsmState).filter(FsmState.key == key).first()
+
+def _set_state(session, key, state):
+    row = _get_row(session, key)
+    if row is None:
+        session.add(FsmState(key=key, state=state))
+    else:
+        row.state = state
+
+def _set_data(session, key, data):
+    row = _get_row(session, key)
+    if row is None:
+        session.add(FsmState(key=key, data=data))
+    else:
+        row.data = data
+
+def _get_state(session, key):
+    row = _get_row(session, key)
+    return row.state if row else None
+
+def _get_data(session, key):
+    row = _get_row(session, key)
+    return row.data if row else None
+
+
+class SQLStorage(BaseStorage):
+    """FSM storage in the bot's database, survives restarts and is shared by worker processes"""
+
+    def __init__(self, key_builder=None):
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        await run_db(_set_state, self.key_builder.build(key), state)
+
+    async def get_state(self, key):
+        return await run_db(_get_state, self.key_builder.build(key))
+
+    async def set_data(self, key, data):
+        await run_db(_set_data, self.key_builder.build(key), json.dumps(dict(data)) if data else None)
+
+    async def get_data(self, key):
+        data = await run_db(_get_data, self.key_builder.build(key))
+        return json.loads(data) if data else {}
+
+    async def close(self):
+        pass
+
+
+def create_storage(backend=FSM_STORAGE):
+    """FSM storage selected by FSM_STORAGE"""
+    if backend == "sql":
+        return SQLStorage()
+    if backend == "redis":
+        # Optional, needs the redis package
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(REDIS_URL)
+    return MemoryStorage()
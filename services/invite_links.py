@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram.exceptions import TelegramAPIError
+
+from config import CHANNEL_ID, CHANNEL_USERNAME, INVITE_LINK_TTL, REFERRER_INVITE_LINKS
+from db.database import run_db
+from db.models import InviteLink
+from instance import bot
+
+logger = logging.getLogger(__name__)
+
+# Name prefix of referrer links, the rest of the name is the referrer's user ID
+REFERRER_PREFIX = "ref:"
+
+
+def _get_referrer_link(session, user_id):
+    row = session.query(InviteLink.invite_link).filter(InviteLink.user_id == user_id).first()
+    return row[0] if row else None
+
+def _save_referrer_link(session, user_id, invite_link):
+    session.merge(InviteLink(user_id=user_id, invite_link=invite_link))
+
+
+def referrer_from_link(invite_link):
+    """Get the referrer a ChatInviteLink was created for, None for any other link"""
+    name = invite_link.name if invite_link else None
+    if not name or not name.startswith(REFERRER_PREFIX):
+        return None
+    try:
+        return int(name[len(REFERRER_PREFIX):])
+    except ValueError:
+        return None
+
+
+class InviteLinkService:
+    """Channel invite links shown to users who aren't subscribed yet
+
+    export_chat_invite_link creates a new primary link and revokes the old
+    one on every call, so links sent to earlier users stopped working. The
+    primary link is read from the chat instead and cached, if the channel
+    has none it is exported once. Referrers get their own named link, it is
+    created once, stored and tells who invited a user when they join.
+    """
+
+    def __init__(self, chat_id, fallback_url=None, ttl=3600, referrer_links=True, max_size=10000,
+                 clock=time.monotonic):
+        self.chat_id = chat_id
+        # Used while the link can't be fetched, e.g. the bot lost its admin rights
+        self.fallback_url = fallback_url
+        self.ttl = ttl
+        self.referrer_links = referrer_links
+        self.max_size = max_size
+        self.clock = clock
+
+        self._primary = None
+        self._expires_at = 0
+        self._lock = asyncio.Lock()
+
+        # referrer_id -> link, ordered from least to most recently used
+        self._referrers = OrderedDict()
+        # referrer_id -> future of a link that is being created
+        self._pending = {}
+
+        self.fetches = 0
+        self.created = 0
+        self.errors = 0
+
+    async def get_link(self):
+        """Get the primary invite link of the channel"""
+        if self._primary and self._expires_at > self.clock():
+            return self._primary
+
+        # Only one request refreshes the link, the others wait for it
+        async with self._lock:
+            if not self._primary or self._expires_at <= self.clock():
+                await self._refresh()
+        return self._primary or self.fallback_url
+
+    async def _refresh(self):
+        self.fetches += 1
+        try:
+            chat = await bot.get_chat(self.chat_id)
+            link = chat.invite_link
+            if not link:
+                # The channel has no primary link yet
+                link = await bot.export_chat_invite_link(self.chat_id)
+        except TelegramAPIError as e:
+            self.errors += 1
+            logger.error(f"Could not get the channel invite link: {e}")
+            # Keep serving the last known link and try again a bit later
+            self._expires_at = self.clock() + min(self.ttl, 60)
+            return
+        self._primary = link
+        self._expires_at = self.clock() + self.ttl
+
+    def invalidate(self):
+        """Fetch the primary link again on the next request, e.g. after it was revoked"""
+        self._expires_at = 0
+
+    def check_join_link(self, invite_link):
+        """Invalidate the cached primary link when a user joined through a different primary link
+
+        An admin revoking the primary link doesn't send the bot an update, but
+        the next join through the new one shows it. Links created by another
+        admin are shown cut off after "…", only the part before it is compared.
+        """
+        if invite_link is None or not invite_link.is_primary or not self._primary:
+            return
+        shown = invite_link.invite_link.split("…")[0]
+        if invite_link.is_revoked or not self._primary.startswith(shown):
+            logger.info("The channel's primary invite link changed, fetching it again")
+            self.invalidate()
+
+    async def get_referrer_link(self, referrer_id):
+        """Get the named invite link of a referrer, creating it the first time"""
+        if not self.referrer_links:
+            return await self.get_link()
+
+        link = self._referrers.get(referrer_id)
+        if link is not None:
+            self._referrers.move_to_end(referrer_id)
+            return link
+
+        # Concurrent /start of friends of the same referrer must not create several links
+        future = self._pending.get(referrer_id)
+        if future is None:
+            future = asyncio.ensure_future(self._load_referrer_link(referrer_id))
+            self._pending[referrer_id] = future
+            future.add_done_callback(lambda _: self._pending.pop(referrer_id, None))
+        link = await asyncio.shield(future)
+        return link or await self.get_link()
+
+    async def _load_referrer_link(self, referrer_id):
+        link = await run_db(_get_referrer_link, referrer_id)
+        if link is None:
+            try:
+                invite = await bot.create_chat_invite_link(self.chat_id, name=f"{REFERRER_PREFIX}{referrer_id}")
+            except TelegramAPIError as e:
+                self.errors += 1
+                logger.warning(f"Could not create an invite link for referrer {referrer_id}: {e}")
+                return None
+            link = invite.invite_link
+            self.created += 1
+            await run_db(_save_referrer_link, referrer_id, link)
+
+        self._referrers[referrer_id] = link
+        while len(self._referrers) > self.max_size:
+            self._referrers.popitem(last=False)
+        return link
+
+    def stats(self):
+        return {
+            "fetches": self.fetches,
+            "created": self.created,
+            "errors": self.errors,
+            "cached_referrers": len(self._referrers)
+        }
+
+
+invite_links = InviteLinkService(
+    CHANNEL_ID,
+    fallback_url=f"https://t.me/{CHANNEL_USERNAME}",
+    ttl=INVITE_LINK_TTL,
+    referrer_links=REFERRER_INVITE_LINKS
+)
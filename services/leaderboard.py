@@ -0,0 +1,136 @@
+import asyncio
+import heapq
+import logging
+
+from config import LEADERBOARD_SIZE
+from db.database import run_db
+from db.models import User
+from services.aggregates import TICKET_VERSION, get_counter
+from services.fenwick import FenwickTree
+
+logger = logging.getLogger(__name__)
+
+
+class Leaderboard:
+    """In-memory ranking of ticket holders
+
+    Keeps the top entries sorted for /top and a Fenwick tree over ticket counts,
+    so the rank of any user is a prefix sum instead of a COUNT query.
+    """
+
+    def __init__(self, size=10):
+        self.size = size
+        # Bumped every time the top entries change, used to cache rendered messages
+        self.version = 0
+
+        self._tickets = {}  # user_id -> tickets, only users with tickets
+        self._usernames = {}
+        self._top = []  # [(-tickets, user_id)] sorted, at most self.size entries
+        # _counts[t] = number of users with t tickets
+        self._counts = FenwickTree(64)
+
+    def seed(self, rows):
+        """Replace the contents with (user_id, username, tickets) rows"""
+        self._tickets = {user_id: tickets for user_id, _, tickets in rows if tickets > 0}
+        self._usernames = {user_id: username for user_id, username, tickets in rows if tickets > 0}
+        self._rebuild_counts(max(self._tickets.values(), default=0))
+        self._rebuild_top()
+
+    def _rebuild_counts(self, max_tickets):
+        size = 64
+        while size <= max_tickets:
+            size *= 2
+        values = [0] * size
+        for tickets in self._tickets.values():
+            values[tickets] += 1
+        self._counts = FenwickTree.from_values(values)
+
+    def _rebuild_top(self):
+        self._top = heapq.nsmallest(self.size, ((-t, u) for u, t in self._tickets.items()))
+        self.version += 1
+
+    def update(self, user_id, tickets, username=None):
+        """Set the ticket count of a user"""
+        old = self._tickets.get(user_id, 0)
+        if tickets == old:
+            if old > 0 and self._usernames.get(user_id) != username:
+                self._usernames[user_id] = username
+                self.version += 1
+            return
+        self._usernames[user_id] = username
+
+        # Update the ticket count histogram
+        if old > 0:
+            self._counts.add(old, -1)
+        if tickets > 0:
+            self._tickets[user_id] = tickets
+            if tickets >= self._counts.size:
+                self._rebuild_counts(tickets)
+            else:
+                self._counts.add(tickets, 1)
+        else:
+            self._tickets.pop(user_id, None)
+            self._usernames.pop(user_id, None)
+
+        # Update the top entries
+        entry = (-old, user_id)
+        in_top = entry in self._top
+        if in_top and tickets < old:
+            # Someone outside the top may overtake this user now
+            self._rebuild_top()
+        elif in_top:
+            self._top.remove(entry)
+            self._top.append((-tickets, user_id))
+            self._top.sort()
+            self.version += 1
+        elif tickets > 0 and (len(self._top) < self.size or (-tickets, user_id) < self._top[-1]):
+            self._top.append((-tickets, user_id))
+            self._top.sort()
+            del self._top[self.size:]
+            self.version += 1
+
+    def top(self):
+        """Get [(user_id, username, tickets)] of the leaders"""
+        return [(user_id, self._usernames.get(user_id), -neg) for neg, user_id in self._top]
+
+    def rank(self, user_id):
+        """Place of the user in the ranking (1 = most tickets), None without tickets"""
+        tickets = self._tickets.get(user_id)
+        if not tickets:
+            return None
+        # Users with more tickets than this user, ties share the place
+        return len(self._tickets) - self._counts.prefix_sum(tickets + 1) + 1
+
+    def __len__(self):
+        return len(self._tickets)
+
+
+def _get_ticket_holders(session):
+    rows = session.query(User.id, User.username, User.ticket_count).filter(User.ticket_count > 0).all()
+    return get_counter(session, TICKET_VERSION), rows
+
+async def load_leaderboard():
+    """Seed the leaderboard from the database"""
+    global _loaded_version
+    _loaded_version, rows = await run_db(_get_ticket_holders)
+    leaderboard.seed(rows)
+    logger.info(f"Leaderboard loaded with {len(leaderboard)} ticket holders")
+
+async def sync_leaderboard(interval, stop_event):
+    """Reload the leaderboard whenever tickets changed, e.g. by another worker process"""
+    while True:
+        try:
+            await asyncio.wait_for(stop_event.wait(), interval)
+            return
+        except asyncio.TimeoutError:
+            pass
+
+        try:
+            if await run_db(get_counter, TICKET_VERSION) != _loaded_version:
+                await load_leaderboard()
+        except Exception as e:
+            logger.error(f"Error syncing leaderboard: {e}", exc_info=True)
+
+
+leaderboard = Leaderboard(LEADERBOARD_SIZE)
+_loaded_version = None  # Ticket version the leaderboard was loaded at
@@ -0,0 +1,129 @@
+from datetime import datetime
+
+from sqlalchemy import func, or_
+
+from db.database import run_db
+from db.models import User, Draw, TicketLedger, DrawTickets, Counter
+from services.aggregates import add_to_counter, get_counter
+
+def draw_total_counter(draw_id):
+    """Name of the counter holding the sum of draw_tickets of a draw"""
+    return f"draw_tickets:{draw_id}"
+
+def get_open_draw_ids(session, now=None):
+    """Active draws that still accept tickets"""
+    now = now or datetime.utcnow()
+    return [row[0] for row in session.query(Draw.id).filter(
+        Draw.status == "active",
+        or_(Draw.scheduled_end.is_(None), Draw.scheduled_end > now)
+    )]
+
+def _add_draw_tickets(session, draw_id, user_id, delta):
+    updated = session.query(DrawTickets).filter(
+        DrawTickets.draw_id == draw_id,
+        DrawTickets.user_id == user_id
+    ).update({DrawTickets.tickets: DrawTickets.tickets + delta}, synchronize_session=False)
+    if not updated:
+        session.add(DrawTickets(draw_id=draw_id, user_id=user_id, tickets=delta))
+        session.flush()
+    add_to_counter(session, draw_total_counter(draw_id), delta)
+
+def credit_open_draws(session, user_id, delta, referral_id=None):
+    """Record tickets in the ledger of every open draw, in the caller's transaction"""
+    draw_ids = get_open_draw_ids(session)
+    for draw_id in draw_ids:
+        session.add(TicketLedger(draw_id=draw_id, user_id=user_id, delta=delta, referral_id=referral_id))
+        _add_draw_tickets(session, draw_id, user_id, delta)
+    return draw_ids
+
+def debit_open_draws(session, user_id, referral_id, tickets):
+    """Take back the tickets a referral earned in open draws, in the caller's transaction"""
+    draw_ids = get_open_draw_ids(session)
+    if not draw_ids:
+        return []
+    # Draws that started after the referral (or already debited it) are left alone
+    credited = [row[0] for row in session.query(TicketLedger.draw_id).filter(
+        TicketLedger.draw_id.in_(draw_ids),
+        TicketLedger.user_id == user_id,
+        TicketLedger.referral_id == referral_id
+    ).group_by(TicketLedger.draw_id).having(func.sum(TicketLedger.delta) > 0)]
+    for draw_id in credited:
+        session.add(TicketLedger(draw_id=draw_id, user_id=user_id, delta=-tickets, referral_id=referral_id))
+        _add_draw_tickets(session, draw_id, user_id, -tickets)
+    return credited
+
+def carry_over_tickets(session, draw_id):
+    """Start a draw with everybody's lifetime tickets instead of an empty ledger"""
+    holders = session.query(User.id, User.ticket_count).filter(User.ticket_count > 0).all()
+    session.bulk_insert_mappings(TicketLedger, [
+        {"draw_id": draw_id, "user_id": user_id, "delta": tickets, "created_at": datetime.utcnow()}
+        for user_id, tickets in holders
+    ])
+    session.bulk_insert_mappings(DrawTickets, [
+        {"draw_id": draw_id, "user_id": user_id, "tickets": tickets}
+        for user_id, tickets in holders
+    ])
+    add_to_counter(session, draw_total_counter(draw_id), sum(tickets for _, tickets in holders))
+
+def get_draw_participants(session, draw_ids):
+    """(user_id, tickets) of everybody holding tickets in the given draws"""
+    return session.query(DrawTickets.user_id, DrawTickets.tickets).filter(
+        DrawTickets.draw_id.in_(draw_ids),
+        DrawTickets.tickets > 0
+    ).all()
+
+def rebuild_draw_tickets(session, draw_id):
+    """Recompute the per-draw totals of a draw from its ledger"""
+    session.query(DrawTickets).filter(DrawTickets.draw_id == draw_id).delete(synchronize_session=False)
+    totals = session.query(TicketLedger.user_id, func.sum(TicketLedger.delta)).filter(
+        TicketLedger.draw_id == draw_id
+    ).group_by(TicketLedger.user_id).all()
+    session.bulk_insert_mappings(DrawTickets, [
+        {"draw_id": draw_id, "user_id": user_id, "tickets": tickets}
+        for user_id, tickets in totals
+    ])
+    session.merge(Counter(name=draw_total_counter(draw_id), value=sum(tickets for _, tickets in totals)))
+
+def _rebuild_active_draws(session, draw_ids=None):
+    if draw_ids is None:
+        draw_ids = [row[0] for row in session.query(Draw.id).filter(Draw.status == "active")]
+    for draw_id in draw_ids:
+        rebuild_draw_tickets(session, draw_id)
+    session.flush()
+    return {draw_id: get_counter(session, draw_total_counter(draw_id)) for draw_id in draw_ids}
+
+async def rebuild_draws(draw_ids=None):
+    """Recompute draw_tickets and the draw totals from the ledger, of all active draws unless IDs are given
+
+        python -m services.ledger [draw_id ...]
+    """
+    return await run_db(_rebuild_active_draws, draw_ids)
+
+def get_current_draw(session, user_id):
+    """The open draw ending first with the user's tickets and the total in it, None if no draw is open"""
+    draw_ids = get_open_draw_ids(session)
+    if not draw_ids:
+        return None
+    draw = session.query(Draw.id, Draw.name, Draw.scheduled_end).filter(Draw.id.in_(draw_ids)).order_by(
+        Draw.scheduled_end.is_(None), Draw.scheduled_end
+    ).first()
+    tickets = session.query(DrawTickets.tickets).filter(
+        DrawTickets.draw_id == draw.id,
+        DrawTickets.user_id == user_id
+    ).scalar() or 0
+    return {
+        "id": draw.id,
+        "name": draw.name,
+        "end_date": draw.scheduled_end,
+        "tickets": max(tickets, 0),
+        "total_tickets": get_counter(session, draw_total_counter(draw.id))
+    }
+
+if __name__ == "__main__":
+    import asyncio
+    import sys
+    from db.database import init_db, close_db
+
+    init_db()
+    print(asyncio.run(rebuild_draws([int(arg) for arg in sys.argv[1:]] or None)))
+    close_db()
@@ -0,0 +1,119 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from config import CHANNEL_ID, MEMBERSHIP_CACHE_TTL, MEMBERSHIP_NEGATIVE_TTL, MEMBERSHIP_CACHE_SIZE
+from instance import bot
+
+# Statuses that count as being subscribed to the channel
+MEMBER_STATUSES = ("member", "administrator", "creator")
+
+
+def status_value(status):
+    """Normalize member status to a plain string (older aiogram versions return an enum)"""
+    return status if isinstance(status, str) else status.value
+
+
+class MembershipService:
+    """Cached channel membership lookups shared by middleware, handlers and draws"""
+
+    def __init__(self, chat_id, ttl=300, negative_ttl=30, max_size=10000, clock=time.monotonic):
+        self.chat_id = chat_id
+        self.ttl = ttl
+        # Non-members are cached for a shorter time, they are expected to subscribe soon
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.clock = clock
+
+        # user_id -> (status, expires_at), ordered from least to most recently used
+        self._cache = OrderedDict()
+        # user_id -> future of a lookup that is already in flight
+        self._pending = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get_status(self, user_id):
+        """Return the member status string of a user, using the cache when possible"""
+        entry = self._cache.get(user_id)
+        if entry is not None:
+            status, expires_at = entry
+            if expires_at > self.clock():
+                self._cache.move_to_end(user_id)
+                self.hits += 1
+                return status
+            del self._cache[user_id]
+
+        self.misses += 1
+
+        # Merge concurrent lookups for the same user into one API request
+        future = self._pending.get(user_id)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(user_id))
+            self._pending[user_id] = future
+            future.add_done_callback(lambda done: self._forget_pending(user_id, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(future)
+
+    def _forget_pending(self, user_id, future):
+        # A newer lookup may have replaced this one after invalidate()
+        if self._pending.get(user_id) is future:
+            del self._pending[user_id]
+
+    async def is_member(self, user_id):
+        """Check if a user is subscribed to the channel"""
+        return await self.get_status(user_id) in MEMBER_STATUSES
+
+    async def _fetch(self, user_id):
+        member = await bot.get_chat_member(chat_id=self.chat_id, user_id=user_id)
+        status = status_value(member.status)
+        # invalidate() or set() during the request made its answer stale, don't cache it
+        if self._pending.get(user_id) is asyncio.current_task():
+            self._store(user_id, status)
+        return status
+
+    def set(self, user_id, status):
+        """Store a known member status for a user"""
+        # A lookup already in flight may have started before the change
+        self._pending.pop(user_id, None)
+        self._store(user_id, status)
+
+    def _store(self, user_id, status):
+        ttl = self.ttl if status in MEMBER_STATUSES else self.negative_ttl
+        self._cache[user_id] = (status, self.clock() + ttl)
+        self._cache.move_to_end(user_id)
+
+        # Evict least recently used entries
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """Drop the cached status of a user, the next lookup asks Telegram again"""
+        self._cache.pop(user_id, None)
+        self._pending.pop(user_id, None)
+
+    def clear(self):
+        self._cache.clear()
+        self._pending.clear()
+
+    def stats(self):
+        """Get cache hit/miss counters"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": round(self.hits / total * 100, 2) if total else 0,
+            "size": len(self._cache),
+            "in_flight": len(self._pending)
+        }
+
+
+membership = MembershipService(
+    CHANNEL_ID,
+    ttl=MEMBERSHIP_CACHE_TTL,
+    negative_ttl=MEMBERSHIP_NEGATIVE_TTL,
+    max_size=MEMBERSHIP_CACHE_SIZE
+)
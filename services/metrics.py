@@ -0,0 +1,198 @@
+"""In-process metrics in the Prometheus text format
+
+Handlers, Telegram API requests, database queries, scheduler ticks and draw
+finalization are timed into histograms with fixed buckets. Recording is a
+dict lookup and a bisect, cheap enough to leave on in production. Counters
+kept by other services (outbox, caches, throttling) are read when /metrics
+is scraped instead of being mirrored on every change.
+"""
+import bisect
+import logging
+import math
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from a cached SQLite read to a slow draw finalization
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PREFIX = "giveaway_"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Distribution of durations, one series per combination of label values"""
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [count per bucket (+Inf last), sum]
+
+    def observe(self, value, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        # Counts are kept per bucket and made cumulative when rendered
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = _format_labels(self.labels, label_values, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total!r}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class CounterMetric:
+    """Monotonic count, one series per combination of label values"""
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._series = {}
+
+    def inc(self, *label_values, amount=1):
+        self._series[label_values] = self._series.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self._series.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}")
+        return lines
+
+
+class Collected:
+    """Values read from a callback at scrape time
+
+    The callback returns a number, or a dict of {label value: number} when
+    the metric has a label.
+    """
+
+    def __init__(self, name, help, func, type="gauge", label=None):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.type = type
+        self.label = label
+
+    def render(self):
+        try:
+            values = self.func()
+        except Exception as e:
+            logger.warning(f"Could not collect {self.name}: {e}")
+            return []
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        if isinstance(values, dict):
+            for key, value in sorted(values.items()):
+                if value is not None:
+                    lines.append(f"{self.name}{_format_labels((self.label,), (key,))} {_format_value(value)}")
+        elif values is not None:
+            lines.append(f"{self.name} {_format_value(values)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self, prefix=PREFIX):
+        self.prefix = prefix
+        self._metrics = {}
+
+    def _add(self, metric):
+        # Registering the same name again returns the existing metric, modules may be imported twice
+        return self._metrics.setdefault(metric.name, metric)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(self.prefix + name, help, labels, buckets))
+
+    def counter(self, name, help, labels=()):
+        return self._add(CounterMetric(self.prefix + name, help, labels))
+
+    def collect(self, name, help, func, type="gauge", label=None):
+        """Expose a value kept elsewhere, func is called on every scrape"""
+        metric = Collected(self.prefix + name, help, func, type, label)
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+handler_duration = metrics.histogram(
+    "handler_duration_seconds", "Time spent in update handlers", ("handler", "status"))
+handler_errors = metrics.counter(
+    "handler_errors_total", "Exceptions raised by update handlers", ("error",))
+telegram_request_duration = metrics.histogram(
+    "telegram_request_duration_seconds", "Telegram Bot API request latency", ("method", "status"))
+db_query_duration = metrics.histogram(
+    "db_query_duration_seconds", "Database statement execution time", ("operation",))
+db_query_errors = metrics.counter(
+    "db_query_errors_total", "Database statements that raised an error")
+scheduler_tick_duration = metrics.histogram(
+    "scheduler_tick_duration_seconds", "Time to end the draws that were due in one scheduler wakeup")
+draw_finalize_duration = metrics.histogram(
+    "draw_finalize_duration_seconds", "Time to verify participants and pick the winner of a draw", ("status",))
+
+
+class MetricsServer:
+    """Small HTTP server answering GET /metrics, meant to listen on a local address"""
+
+    def __init__(self, registry=metrics, host="127.0.0.1", port=9100):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def handle(self, request):
+        return web.Response(body=self.registry.render().encode(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
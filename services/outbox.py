@@ -0,0 +1,227 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramRetryAfter,
+)
+
+from config import (
+    OUTBOX_GLOBAL_RATE,
+    OUTBOX_CHAT_RATE,
+    OUTBOX_GROUP_RATE,
+    OUTBOX_CONCURRENCY,
+    OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_POLL_INTERVAL,
+)
+from db.database import run_db
+from db.models import OutboxMessage
+from instance import bot
+from services.ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Lower is sent first
+PRIORITY_CHANNEL = 0  # Announcements in the channel
+PRIORITY_USER = 10  # Messages to a single user, broadcasts only send when neither is due
+
+BATCH_SIZE = 50
+MAX_CHAT_BUCKETS = 10000
+
+
+def _enqueue(session, chat_id, text, priority):
+    message = OutboxMessage(chat_id=str(chat_id), text=text, priority=priority)
+    session.add(message)
+    session.flush()
+    return message.id
+
+def _get_due(session, now, limit):
+    rows = session.query(OutboxMessage.id, OutboxMessage.chat_id, OutboxMessage.text, OutboxMessage.attempts).filter(
+        OutboxMessage.status == "pending",
+        OutboxMessage.not_before <= now
+    ).order_by(OutboxMessage.priority, OutboxMessage.id).limit(limit).all()
+    return [dict(row._mapping) for row in rows]
+
+def _mark_sent(session, message_id):
+    session.query(OutboxMessage).filter(OutboxMessage.id == message_id).delete()
+
+def _reschedule(session, message_id, not_before, attempts, error):
+    session.query(OutboxMessage).filter(OutboxMessage.id == message_id).update({
+        OutboxMessage.not_before: not_before,
+        OutboxMessage.attempts: attempts,
+        OutboxMessage.last_error: error
+    })
+
+def _mark_failed(session, message_id, error):
+    session.query(OutboxMessage).filter(OutboxMessage.id == message_id).update({
+        OutboxMessage.status: "failed",
+        OutboxMessage.last_error: error
+    })
+
+def _count_pending(session):
+    return session.query(OutboxMessage).filter(OutboxMessage.status == "pending").count()
+
+
+def _is_group(chat_id):
+    # Channels and groups have negative IDs or are addressed by @username
+    return chat_id.startswith(("-", "@"))
+
+
+class Outbox:
+    """Persistent queue of outgoing messages
+
+    Handlers enqueue messages and return, a single sender task delivers them
+    in priority order. A global token bucket and one bucket per chat keep
+    sends under Telegram's flood limits, a retry-after pauses that chat (and
+    all sending, unless it came from a group's own limit) and the message is
+    retried. Broadcasts take their tokens through acquire_bulk(), which
+    waits while queued messages are due, so announcements and replies go
+    ahead of bulk DMs. Messages are stored in the database until
+    Telegram accepts them, so they survive a crash or restart (and may be
+    sent twice if the bot dies between sending and deleting the row).
+    """
+
+    def __init__(self, global_rate=OUTBOX_GLOBAL_RATE, chat_rate=OUTBOX_CHAT_RATE, group_rate=OUTBOX_GROUP_RATE,
+                 concurrency=OUTBOX_CONCURRENCY, max_attempts=OUTBOX_MAX_ATTEMPTS, poll_interval=OUTBOX_POLL_INTERVAL):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+
+        # Telegram's limit over all chats, broadcasts take their tokens from it too
+        self.global_bucket = TokenBucket(global_rate)
+        self._chats = {}  # chat_id -> TokenBucket
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        # Set while no queued message is due. Only the sender task clears it, in processes
+        # without one broadcasts never wait
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._running = False
+
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    async def enqueue(self, chat_id, text, priority=PRIORITY_USER):
+        """Store a message for sending, returns its ID"""
+        message_id = await run_db(_enqueue, chat_id, text, priority)
+        if self._running:
+            self._idle.clear()
+        self._wakeup.set()
+        return message_id
+
+    async def acquire_bulk(self):
+        """Take a global token for a bulk message, after the queued messages that are due"""
+        while True:
+            await self._idle.wait()
+            await self.global_bucket.acquire()
+            if self._idle.is_set():
+                return
+            # A message was queued while waiting for the token, it gets the token instead
+            self.global_bucket.refund()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_CHAT_BUCKETS:
+                self._chats.clear()
+            rate = self.group_rate if _is_group(chat_id) else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, capacity=1)
+        return bucket
+
+    async def _send(self, message):
+        async with self._semaphore:
+            try:
+                await bot.send_message(message["chat_id"], message["text"])
+            except TelegramRetryAfter as e:
+                # Not counted as an attempt, the message just has to wait
+                self.retried += 1
+                logger.warning(f"Flood control for chat {message['chat_id']}, waiting {e.retry_after}s")
+                self._chat_bucket(message["chat_id"]).pause(e.retry_after)
+                if not _is_group(message["chat_id"]):
+                    # Flood control applies to the whole bot, other chats would get 429s too.
+                    # Groups and channels have their own per-chat limit, only that chat waits
+                    self.global_bucket.pause(e.retry_after)
+                not_before = datetime.utcnow() + timedelta(seconds=e.retry_after)
+                await run_db(_reschedule, message["id"], not_before, message["attempts"], str(e))
+                return
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # Blocked by the user, chat not found etc. - retrying won't help
+                self.failed += 1
+                logger.warning(f"Message {message['id']} to {message['chat_id']} rejected: {e}")
+                await run_db(_mark_failed, message["id"], str(e))
+                return
+            except Exception as e:
+                # Network and server errors, retried with exponential backoff
+                attempts = message["attempts"] + 1
+                if attempts >= self.max_attempts:
+                    self.failed += 1
+                    logger.error(f"Giving up on message {message['id']} to {message['chat_id']}: {e}")
+                    await run_db(_mark_failed, message["id"], str(e))
+                else:
+                    self.retried += 1
+                    not_before = datetime.utcnow() + timedelta(seconds=2 ** attempts)
+                    await run_db(_reschedule, message["id"], not_before, attempts, str(e))
+                return
+
+            self.sent += 1
+            await run_db(_mark_sent, message["id"])
+
+    async def _send_due(self):
+        """Send what is due and allowed by the rate limits, returns the number of messages sent"""
+        messages = await run_db(_get_due, datetime.utcnow(), BATCH_SIZE)
+        if messages:
+            self._idle.clear()
+        else:
+            self._idle.set()
+        tasks = []
+        for message in messages:
+            # A chat that is over its limit must not hold back the others
+            if not self._chat_bucket(message["chat_id"]).try_acquire():
+                continue
+            await self.global_bucket.acquire()
+            tasks.append(asyncio.create_task(self._send(message)))
+        await asyncio.gather(*tasks)
+        return len(tasks)
+
+    async def _wait(self, timeout, stop_event):
+        wakeup = asyncio.ensure_future(self._wakeup.wait())
+        stop = asyncio.ensure_future(stop_event.wait())
+        await asyncio.wait({wakeup, stop}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        wakeup.cancel()
+        stop.cancel()
+
+    async def run(self, stop_event):
+        """Send queued messages until stop_event is set"""
+        pending = await run_db(_count_pending)
+        if pending:
+            logger.info(f"Outbox has {pending} messages left from the last run")
+
+        self._running = True
+        try:
+            while not stop_event.is_set():
+                # Cleared before looking for messages, so an enqueue during the send isn't missed
+                self._wakeup.clear()
+                try:
+                    sent = await self._send_due()
+                except Exception as e:
+                    logger.error(f"Error sending queued messages: {e}", exc_info=True)
+                    # Broadcasts must not wait on a sender that keeps failing
+                    self._idle.set()
+                    sent = 0
+
+                if not sent:
+                    # Nothing due, or every due chat is over its limit
+                    await self._wait(self.poll_interval, stop_event)
+        finally:
+            self._running = False
+            self._idle.set()
+
+    def stats(self):
+        return {"sent": self.sent, "failed": self.failed, "retried": self.retried}
+
+
+outbox = Outbox()
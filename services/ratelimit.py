@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Async token bucket limiting how often an operation may run"""
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate  # Tokens per second
+        self.capacity = capacity or max(1, rate)
+        self.clock = clock
+
+        self._tokens = self.capacity
+        self._updated_at = clock()
+        self._paused_until = 0
+
+    def _refill(self, now):
+        if now > self._updated_at:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+
+    def try_acquire(self):
+        """Take a token if one is available right now"""
+        now = self.clock()
+        if now < self._paused_until:
+            return False
+        self._refill(now)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        while True:
+            now = self.clock()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def refund(self):
+        """Give back a token that was taken but not used"""
+        self._tokens = min(self.capacity, self._tokens + 1)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for a while (e.g. after Telegram asked to retry later)"""
+        now = self.clock()
+        self._paused_until = max(self._paused_until, now + seconds)
+        # Start from an empty bucket so waiters don't burst right after the pause
+        self._tokens = 0
+        self._updated_at = max(now, self._paused_until)
+
+
+class KeyedRateLimiter:
+    """Token buckets for many keys (e.g. users) kept as plain tuples
+
+    A bucket is (tokens, updated_at). Buckets that have filled up again are
+    no different from missing ones, sweep() drops them so idle users don't
+    take memory.
+    """
+
+    def __init__(self, limit, period=60, clock=time.monotonic):
+        self.capacity = limit  # Burst size, the whole limit may be used at once
+        self.rate = limit / period  # Tokens per second
+        self.clock = clock
+
+        self._buckets = {}  # key -> (tokens, updated_at)
+
+    def allow(self, key, now=None):
+        """Take a token for key, False if it is over the limit"""
+        now = self.clock() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            tokens = self.capacity
+        else:
+            tokens = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return False
+        self._buckets[key] = (tokens - 1, now)
+        return True
+
+    def retry_after(self, key, now=None):
+        """Seconds until key gets a token again"""
+        now = self.clock() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return 0
+        tokens = bucket[0] + (now - bucket[1]) * self.rate
+        return max(0, (1 - tokens) / self.rate)
+
+    def sweep(self, now=None):
+        """Forget keys whose bucket is full again, returns how many were dropped"""
+        now = self.clock() if now is None else now
+        full = [key for key, (tokens, updated_at) in self._buckets.items()
+                if tokens + (now - updated_at) * self.rate >= self.capacity]
+        for key in full:
+            del self._buckets[key]
+        return len(full)
+
+    def __contains__(self, key):
+        return key in self._buckets
+
+    def __len__(self):
+        return len(self._buckets)
@@ -1,72 +1,235 @@
-import uuid
-import base64
-from db.database import get_session
-from db.models import User, Referral
-from config import CHANNEL_USERNAME
+import asyncio
+from datetime import datetime, timedelta
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from db.database import run_db
+from db.models import User, Referral, PendingReferral
+from services.aggregates import record_referral
+from services.leaderboard import leaderboard
+from services.ledger import credit_open_draws, debit_open_draws, get_current_draw
+from services.referral_codes import referral_codes
+from services.write_buffer import write_buffer
+from config import CHANNEL_USERNAME, PENDING_REFERRAL_TTL, REFERRAL_TICKETS
 
-def generate_referral_code():
-    """Generate a unique referral code"""
-    return base64.urlsafe_b64encode(uuid.uuid4().bytes).decode('utf-8')[:8]
+def generate_referral_code(user_id):
+    """Generate the referral code of a user, unique because user IDs are"""
+    return referral_codes.encode(user_id)
 
-def create_referral_link(user_id):
-    """Create a referral link for a user"""
-    session = get_session()
+def _register_user(session, user_id, username, first_name, last_name):
     user = session.query(User).filter(User.id == user_id).first()
-    
-    if not user:
-        return None
-    
-    # Create a deep link to the bot (not channel) with the referral code as start parameter
-    # This is the correct way to track referrals in Telegram
-    bot_username = "AirChainMiniAppBot"  # Replace with your bot's username
-    link = f"https://t.me/{bot_username}?start={user.referral_code}"
-    
+    if user:
+        # Writing /start means the bot isn't blocked (anymore)
+        if user.is_blocked:
+            user.is_blocked = False
+        return False
+
+    user = User(
+        id=user_id,
+        username=username,
+        first_name=first_name,
+        last_name=last_name,
+        referral_code=generate_referral_code(user_id)
+    )
+    session.add(user)
+    return True
+
+async def register_user(user_id, username, first_name, last_name):
+    """Create the user if they don't exist yet, committed with the next batch of buffered writes"""
+    write_buffer.submit(_register_user, user_id, username, first_name, last_name,
+                        key=("user", user_id), users=(user_id,))
+
+async def find_referrer(referral_code):
+    """Get the ID of the user who owns a referral code"""
+    return await referral_codes.resolve(referral_code)
+
+def _set_referred_by(session, user_id, referrer_id):
+    session.query(User).filter(User.id == user_id).update({User.referred_by_id: referrer_id})
+
+async def set_referred_by(user_id, referrer_id):
+    """Remember who invited the user"""
+    await run_db(_set_referred_by, user_id, referrer_id)
+
+async def create_referral_link(user_id):
+    """Create a referral link for a user"""
+    link = await referral_codes.get_link(user_id)
+    if link is None:
+        # The user may still wait in the write buffer
+        await write_buffer.sync(user_id)
+        link = await referral_codes.get_link(user_id)
     return link
 
-async def process_referral(referrer_id, referred_id):
-    """Process a successful referral, update tickets"""
-    session = get_session()
-    
-    # Check if this is a new referral
-    existing = session.query(Referral).filter(
-        Referral.referrer_id == referrer_id, 
+def _insert_referral(session, referrer_id, referred_id):
+    """Insert the referral unless it exists, returns its ID or None
+
+    The unique index on (referrer_id, referred_id) decides, so two concurrent
+    /start updates can't both insert it. On SQLite this is also the first
+    write, so the transaction holds the write lock from here to the commit.
+    """
+    values = {"referrer_id": referrer_id, "referred_id": referred_id, "timestamp": datetime.utcnow()}
+    dialect = session.bind.dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        insert = sqlite_insert if dialect == "sqlite" else postgresql_insert
+        result = session.execute(
+            insert(Referral).values(**values).on_conflict_do_nothing(index_elements=["referrer_id", "referred_id"])
+        )
+        return result.inserted_primary_key[0] if result.rowcount else None
+
+    try:
+        with session.begin_nested():
+            referral = Referral(**values)
+            session.add(referral)
+        return referral.id
+    except IntegrityError:
+        return None
+
+def _reinstate_referral(session, referrer_id, referred_id):
+    """Undo the revocation of a referral, returns its ID or None if it wasn't revoked"""
+    reinstated = session.query(Referral).filter(
+        Referral.referrer_id == referrer_id,
+        Referral.referred_id == referred_id,
+        Referral.revoked_at.isnot(None)
+    ).update({Referral.revoked_at: None}, synchronize_session=False)
+    if not reinstated:
+        return None
+    return session.query(Referral.id).filter(
+        Referral.referrer_id == referrer_id,
         Referral.referred_id == referred_id
-    ).first()
-    
-    if existing:
-        return False  # Already processed
-    
-    # Create the referral record
-    referral = Referral(referrer_id=referrer_id, referred_id=referred_id)
-    session.add(referral)
-    
-    # Update the referrer's ticket count
-    referrer = session.query(User).filter(User.id == referrer_id).first()
-    referrer.ticket_count += 1
-    
-    session.commit()
-    return True
+    ).scalar()
 
-def get_referral_stats(user_id):
-    """Get referral statistics for a user"""
-    session = get_session()
-    user = session.query(User).filter(User.id == user_id).first()
-    
+def _process_referral(session, referrer_id, referred_id, tickets=REFERRAL_TICKETS):
+    # A new referral, or one taken back when the invited user left the channel
+    referral_id = _insert_referral(session, referrer_id, referred_id)
+    if referral_id is None:
+        referral_id = _reinstate_referral(session, referrer_id, referred_id)
+    if referral_id is None:
+        return None  # Already processed
+
+    # Counters are incremented in SQL, a Python-side += loses concurrent updates
+    session.query(User).filter(User.id == referrer_id).update(
+        {User.ticket_count: User.ticket_count + tickets}, synchronize_session=False
+    )
+    _set_referred_by(session, referred_id, referrer_id)
+
+    # Keep the aggregates and the ledgers of running draws in the same transaction
+    record_referral(session, referrer_id, tickets)
+    credit_open_draws(session, referrer_id, tickets, referral_id=referral_id)
+
+    referrer = session.query(User.id, User.username, User.ticket_count).filter(User.id == referrer_id).one()
+    return {"id": referrer.id, "username": referrer.username, "tickets": referrer.ticket_count}
+
+def _referral_committed(future):
+    if future.cancelled() or future.exception() or not future.result():
+        return
+    referrer = future.result()
+    leaderboard.update(referrer["id"], referrer["tickets"], referrer["username"])
+
+async def process_referral(referrer_id, referred_id, wait=True):
+    """Record a referral and credit the referrer in one transaction, False if it was already counted
+
+    The write goes through the write buffer, with wait=False it returns
+    right away and the referrer is credited when the batch is committed.
+    """
+    future = write_buffer.submit(_process_referral, referrer_id, referred_id, users=(referrer_id, referred_id))
+    future.add_done_callback(_referral_committed)
+    if not wait:
+        return None
+    return bool(await asyncio.shield(future))
+
+def _add_pending_referral(session, referrer_id, referred_id, ttl):
+    now = datetime.utcnow()
+    # Expired invitations are dropped here, the index keeps this cheap
+    session.query(PendingReferral).filter(PendingReferral.expires_at <= now).delete(synchronize_session=False)
+    # The last link the user followed wins
+    session.merge(PendingReferral(
+        referred_id=referred_id,
+        referrer_id=referrer_id,
+        created_at=now,
+        expires_at=now + timedelta(seconds=ttl)
+    ))
+
+async def add_pending_referral(referrer_id, referred_id, ttl=PENDING_REFERRAL_TTL):
+    """Remember an invited user who isn't subscribed yet, the referral is credited when they join"""
+    await write_buffer.sync(referred_id)
+    await run_db(_add_pending_referral, referrer_id, referred_id, ttl)
+
+def _credit_joined_user(session, user_id, link_referrer_id):
+    user = session.query(User.id, User.referred_by_id).filter(User.id == user_id).first()
     if not user:
+        return None  # Joined without ever starting the bot
+
+    pending = session.query(PendingReferral).filter(PendingReferral.referred_id == user_id).first()
+    if pending:
+        session.delete(pending)
+        if pending.expires_at <= datetime.utcnow():
+            pending = None
+
+    # The referrer's named invite link is the surest sign, then the /start link,
+    # then whoever invited a user who comes back
+    referrer_id = link_referrer_id or (pending.referrer_id if pending else None) or user.referred_by_id
+    if not referrer_id or referrer_id == user_id:
+        return None
+
+    return _process_referral(session, referrer_id, user_id)
+
+async def credit_joined_user(user_id, link_referrer_id=None):
+    """Credit the referrer of a user who just joined the channel, returns the referrer ID or None"""
+    await write_buffer.sync(user_id)
+    referrer = await run_db(_credit_joined_user, user_id, link_referrer_id)
+    if not referrer:
         return None
-    
-    # Calculate total tickets in the system for chance calculation
-    total_tickets = session.query(User).with_entities(
-        User.ticket_count).filter(User.ticket_count > 0).all()
-    
-    total_tickets_sum = sum(t[0] for t in total_tickets)
-    win_chance = (user.ticket_count / max(total_tickets_sum, 1)) * 100 if total_tickets_sum > 0 else 0
-    
-    result = {
+
+    leaderboard.update(referrer["id"], referrer["tickets"], referrer["username"])
+    return referrer["id"]
+
+def _revoke_referrals(session, referred_id):
+    referrals = session.query(Referral).filter(
+        Referral.referred_id == referred_id,
+        Referral.revoked_at.is_(None)
+    ).all()
+
+    referrers = []
+    for referral in referrals:
+        referral.revoked_at = datetime.utcnow()
+        session.query(User).filter(User.id == referral.referrer_id).update(
+            {User.ticket_count: User.ticket_count - REFERRAL_TICKETS}, synchronize_session=False
+        )
+        record_referral(session, referral.referrer_id, -REFERRAL_TICKETS, count=-1)
+        debit_open_draws(session, referral.referrer_id, referral.id, REFERRAL_TICKETS)
+
+        referrer = session.query(User.id, User.username, User.ticket_count).filter(
+            User.id == referral.referrer_id
+        ).first()
+        referrers.append({"id": referrer.id, "username": referrer.username, "tickets": referrer.ticket_count})
+    return referrers
+
+async def revoke_referrals(referred_id):
+    """Take back the tickets earned by inviting a user who left the channel, returns the number taken back"""
+    await write_buffer.sync(referred_id)
+    referrers = await run_db(_revoke_referrals, referred_id)
+    for referrer in referrers:
+        leaderboard.update(referrer["id"], referrer["tickets"], referrer["username"])
+    return len(referrers)
+
+def _get_referral_stats(session, user_id):
+    user = session.query(User.ticket_count, User.referral_count).filter(User.id == user_id).first()
+
+    if not user:
+        return None
+
+    # Winners are drawn from the tickets earned in the draw, not from lifetime tickets
+    draw = get_current_draw(session, user_id)
+    if draw:
+        total = draw["total_tickets"]
+        draw["win_chance"] = round(draw["tickets"] / total * 100, 2) if total > 0 else 0
+
+    return {
         "tickets": user.ticket_count,
-        "total_tickets": total_tickets_sum,
-        "win_chance": round(win_chance, 2),
-        "referrals_count": len(user.referrals)
+        "referrals_count": user.referral_count,
+        "draw": draw
     }
-    
-    return result
\ No newline at end of file
+
+async def get_referral_stats(user_id):
+    """Get referral statistics for a user"""
+    await write_buffer.sync(user_id)
+    return await run_db(_get_referral_stats, user_id)
@@ -0,0 +1,224 @@
+import asyncio
+import base64
+import hashlib
+import re
+import time
+from collections import OrderedDict
+
+from config import BOT_USERNAME, REFERRAL_CODE_SECRET, REFERRAL_CODE_CACHE_SIZE, REFERRAL_CODE_NEGATIVE_TTL, \
+    REFERRAL_LINK_CACHE_SIZE
+from db.database import run_db, session_scope
+from db.models import User, Setting
+from services.write_buffer import write_buffer
+
+# Characters Telegram allows in a /start parameter
+CODE_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+# Codes are 64-bit blocks: the user ID in the low bits, the high bits must be zero
+ID_BITS = 53
+CODE_LENGTH = 11  # Base64 of 8 bytes without padding
+LEGACY_CODE_LENGTH = 8  # Random codes handed out before, still resolved through the database
+ROUNDS = 4
+SECRET_SETTING = "referral_code_secret"
+
+
+def _find_user_id(session, referral_code):
+    row = session.query(User.id).filter(User.referral_code == referral_code).first()
+    return row[0] if row else None
+
+def _get_referral_code(session, user_id):
+    row = session.query(User.referral_code).filter(User.id == user_id).first()
+    return row[0] if row else None
+
+def _get_secret(session):
+    row = session.query(Setting.value).filter(Setting.name == SECRET_SETTING).first()
+    return row[0] if row else None
+
+
+class ReferralCodeService:
+    """Referral codes of users and the links that carry them
+
+    A code is the user ID run through a keyed permutation, so two users
+    can't get the same code and nothing has to be checked on registration.
+    Codes are resolved to user IDs through a bounded cache. Codes that don't
+    exist are cached for negative_ttl seconds. Codes of any other length than
+    a current or a legacy code, and current codes whose high bits don't
+    decode to zero, are rejected without a query, so garbage and guessed
+    codes rarely reach the database.
+    """
+
+    def __init__(self, secret, bot_username, max_size=100000, negative_ttl=300, link_cache_size=10000,
+                 clock=time.monotonic):
+        self._keys = None
+        if secret:
+            self.set_secret(secret)
+        self.bot_username = bot_username
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self.link_cache_size = link_cache_size
+        self.clock = clock
+
+        # code -> user_id, ordered from least to most recently used
+        self._codes = OrderedDict()
+        # code -> expires_at of codes that belong to nobody
+        self._unknown = OrderedDict()
+        # user_id -> referral link
+        self._links = OrderedDict()
+        # code -> future of a lookup that is already in flight
+        self._pending = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self.coalesced = 0
+
+    def set_secret(self, secret):
+        """Key the permutation, codes made with another secret no longer decode"""
+        self._keys = [hashlib.sha256(f"{secret}:{i}".encode()).digest() for i in range(ROUNDS)]
+
+    def _round(self, i, half):
+        digest = hashlib.blake2b(half.to_bytes(4, "big"), digest_size=4, key=self._keys[i]).digest()
+        return int.from_bytes(digest, "big")
+
+    def _permute(self, block, inverse=False):
+        if self._keys is None:
+            raise RuntimeError("Referral code secret is not loaded, call load_referral_code_secret() first")
+        left, right = block >> 32, block & 0xFFFFFFFF
+        if not inverse:
+            for i in range(ROUNDS):
+                left, right = right, left ^ self._round(i, right)
+        else:
+            for i in reversed(range(ROUNDS)):
+                left, right = right ^ self._round(i, left), left
+        return left << 32 | right
+
+    def encode(self, user_id):
+        """Referral code of a user, the same user always gets the same code"""
+        if not 0 < user_id < 1 << ID_BITS:
+            raise ValueError(f"User ID out of range: {user_id}")
+        block = self._permute(user_id)
+        return base64.urlsafe_b64encode(block.to_bytes(8, "big")).decode().rstrip("=")
+
+    def decode(self, code):
+        """User ID a code was made for, None if it isn't a code made by encode()"""
+        if len(code) != CODE_LENGTH or not CODE_PATTERN.match(code):
+            return None
+        raw = base64.urlsafe_b64decode(code + "=")
+        # The last character carries 2 unused bits, only one spelling of a code is valid
+        if base64.urlsafe_b64encode(raw).decode().rstrip("=") != code:
+            return None
+        user_id = self._permute(int.from_bytes(raw, "big"), inverse=True)
+        return user_id if 0 < user_id < 1 << ID_BITS else None
+
+    async def resolve(self, code):
+        """ID of the user who owns a referral code, or None"""
+        # Nothing else was ever handed out, don't let junk fill the negative cache either
+        if len(code or "") not in (CODE_LENGTH, LEGACY_CODE_LENGTH) or not CODE_PATTERN.match(code):
+            self.rejected += 1
+            return None
+
+        user_id = self._codes.get(code)
+        if user_id is not None:
+            self._codes.move_to_end(code)
+            self.hits += 1
+            return user_id
+
+        expires_at = self._unknown.get(code)
+        if expires_at is not None:
+            if expires_at > self.clock():
+                self.hits += 1
+                return None
+            del self._unknown[code]
+
+        owner_id = self.decode(code)
+        if owner_id is None and len(code) == CODE_LENGTH:
+            self.rejected += 1
+            self._remember_unknown(code)
+            return None
+
+        self.misses += 1
+        # Merge concurrent lookups of the same code, a shared link brings many at once
+        future = self._pending.get(code)
+        if future is None:
+            future = asyncio.ensure_future(self._lookup(code, owner_id))
+            self._pending[code] = future
+            future.add_done_callback(lambda _: self._pending.pop(code, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(future)
+
+    async def _lookup(self, code, owner_id):
+        if owner_id:
+            # The owner may have registered a moment ago, their row can still wait in the write buffer
+            await write_buffer.sync(owner_id)
+        user_id = await run_db(_find_user_id, code)
+        if user_id is None:
+            self._remember_unknown(code)
+        else:
+            self._remember(code, user_id)
+        return user_id
+
+    def _remember(self, code, user_id):
+        self._unknown.pop(code, None)
+        self._codes[code] = user_id
+        self._codes.move_to_end(code)
+        while len(self._codes) > self.max_size:
+            self._codes.popitem(last=False)
+
+    def _remember_unknown(self, code):
+        # Not needed for long, the code may belong to a user who is registering right now
+        self._unknown[code] = self.clock() + self.negative_ttl
+        self._unknown.move_to_end(code)
+        while len(self._unknown) > self.max_size:
+            self._unknown.popitem(last=False)
+
+    async def get_link(self, user_id):
+        """Deep link to the bot with the user's referral code, None for unknown users"""
+        link = self._links.get(user_id)
+        if link is not None:
+            self._links.move_to_end(user_id)
+            return link
+
+        code = await run_db(_get_referral_code, user_id)
+        if code is None:
+            return None
+        self._remember(code, user_id)
+
+        # A link to the bot (not the channel) with the code as start parameter
+        link = f"https://t.me/{self.bot_username}?start={code}"
+        self._links[user_id] = link
+        while len(self._links) > self.link_cache_size:
+            self._links.popitem(last=False)
+        return link
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "rejected": self.rejected,
+            "coalesced": self.coalesced,
+            "hit_rate": round(self.hits / total * 100, 2) if total else 0,
+            "codes": len(self._codes),
+            "unknown": len(self._unknown),
+            "links": len(self._links)
+        }
+
+
+referral_codes = ReferralCodeService(
+    REFERRAL_CODE_SECRET,
+    BOT_USERNAME,
+    max_size=REFERRAL_CODE_CACHE_SIZE,
+    negative_ttl=REFERRAL_CODE_NEGATIVE_TTL,
+    link_cache_size=REFERRAL_LINK_CACHE_SIZE
+)
+
+def load_referral_code_secret():
+    """Key the codes with the secret stored in the database unless REFERRAL_CODE_SECRET is set, call after init_db()"""
+    if REFERRAL_CODE_SECRET:
+        return
+    with session_scope() as session:
+        secret = _get_secret(session)
+    if secret is None:
+        raise RuntimeError("No referral code secret in the database, run the migrations first")
+    referral_codes.set_secret(secret)
@@ -0,0 +1,59 @@
+import secrets
+
+import numpy as np
+
+from services.fenwick import FenwickTree
+
+
+def new_seed():
+    """Random seed for a draw, stored with it so the draw can be replayed for audit"""
+    return secrets.randbits(63)
+
+
+class WeightedSampler:
+    """Weighted random selection of distinct winners
+
+    Weights live in a FenwickTree stored in a NumPy array. Building it is
+    vectorized (O(n)), every pick is a tree descent and every removal a tree
+    update, both O(log n). Participants are ordered by ID, so the same seed
+    and the same tickets always give the same winners.
+    """
+
+    def __init__(self, ids, weights):
+        ids = np.asarray(ids, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.int64)
+        if ids.shape != weights.shape:
+            raise ValueError("ids and weights must have the same length")
+        if weights.size and weights.min() < 0:
+            raise ValueError("weights must not be negative")
+
+        order = np.argsort(ids, kind="stable")
+        self.ids = ids[order]
+        self.weights = weights[order]
+        self.size = len(self.ids)
+        self.total = int(self.weights.sum())
+        # Participants that can win at all
+        self.eligible = int(np.count_nonzero(self.weights))
+
+        self._tree = FenwickTree.from_array(self.weights)
+
+    def sample(self, k=1, seed=None):
+        """Pick k distinct participants, each with a chance proportional to their weight"""
+        rng = np.random.default_rng(seed)
+        k = min(k, self.eligible)
+
+        picked = []
+        remaining = self.total
+        try:
+            for _ in range(k):
+                index = self._tree.find(int(rng.integers(remaining)))
+                picked.append(index)
+                # Take the winner out so they can't be picked twice
+                self._tree.add(index, -int(self.weights[index]))
+                remaining -= int(self.weights[index])
+        finally:
+            # Put the winners back, the sampler can be used again
+            for index in picked:
+                self._tree.add(index, int(self.weights[index]))
+
+        return [int(self.ids[index]) for index in picked]
@@ -0,0 +1,132 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+
+from config import SCHEDULER_CHECK_INTERVAL
+from db.database import run_db
+from db.models import Draw
+from services.metrics import scheduler_tick_duration
+
+logger = logging.getLogger(__name__)
+
+
+class DrawScheduler:
+    """Sleeps until the next draw deadline instead of polling the draws table
+
+    Deadlines are kept in a heap. Scheduling or cancelling a draw wakes the
+    loop up, so it can recompute how long to sleep. The clock and the sleep
+    are injectable so the loop can be driven by fake time
+    (benchmarks/scheduler_check.py).
+    """
+
+    def __init__(self, clock=datetime.utcnow, max_sleep=SCHEDULER_CHECK_INTERVAL, sleep=asyncio.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        # Upper bound for a single sleep, the schedule is reloaded from the DB after it
+        self.max_sleep = max_sleep
+
+        self._heap = []  # [(deadline, draw_id)], may contain outdated entries
+        self._deadlines = {}  # draw_id -> current deadline
+        self._wakeup = asyncio.Event()
+
+    def schedule(self, draw_id, deadline):
+        """Add a draw or move its deadline"""
+        if deadline is None:
+            self.unschedule(draw_id)
+            return
+        self._deadlines[draw_id] = deadline
+        heapq.heappush(self._heap, (deadline, draw_id))
+        self._wakeup.set()
+
+    def unschedule(self, draw_id):
+        """Forget a draw, e.g. after it was cancelled or ended manually"""
+        if self._deadlines.pop(draw_id, None) is not None:
+            self._wakeup.set()
+
+    def _drop_outdated(self):
+        # Entries whose draw was unscheduled or rescheduled are removed lazily
+        while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def next_deadline(self):
+        self._drop_outdated()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now=None):
+        """Remove and return the IDs of draws whose deadline has passed"""
+        now = now or self.clock()
+        due = []
+        while self.next_deadline() is not None and self._heap[0][0] <= now:
+            _, draw_id = heapq.heappop(self._heap)
+            del self._deadlines[draw_id]
+            due.append(draw_id)
+        return due
+
+    def seconds_until_next(self, now=None):
+        """How long the loop may sleep before something is due"""
+        deadline = self.next_deadline()
+        if deadline is None:
+            return self.max_sleep
+        now = now or self.clock()
+        return max(0, min((deadline - now).total_seconds(), self.max_sleep))
+
+    async def load(self):
+        """Replace the schedule with the active draws from the database"""
+        rows = await run_db(_get_active_deadlines)
+        # A draw postponed with retry_later() keeps its later deadline, not the passed one from the database
+        deadlines = {draw_id: max(deadline, self._deadlines.get(draw_id, deadline)) for draw_id, deadline in rows}
+        self._heap = [(deadline, draw_id) for draw_id, deadline in deadlines.items()]
+        heapq.heapify(self._heap)
+        self._deadlines = deadlines
+        self._wakeup.set()
+        logger.info(f"Scheduler loaded {len(rows)} active draws")
+
+    async def _wait(self, timeout, stop_event):
+        """Sleep until the timeout, a schedule change or shutdown"""
+        stop_task = asyncio.ensure_future(stop_event.wait())
+        wakeup_task = asyncio.ensure_future(self._wakeup.wait())
+        sleep_task = asyncio.ensure_future(self.sleep(timeout))
+        try:
+            done, _ = await asyncio.wait({stop_task, wakeup_task, sleep_task}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stop_task.cancel()
+            wakeup_task.cancel()
+            sleep_task.cancel()
+        return stop_task in done or wakeup_task in done
+
+    async def run(self, on_due, stop_event):
+        """Call on_due(draw_ids) whenever draws reach their deadline, until stop_event is set"""
+        while not stop_event.is_set():
+            due = self.pop_due()
+            if due:
+                try:
+                    with scheduler_tick_duration.time():
+                        await on_due(due)
+                except Exception as e:
+                    logger.error(f"Error ending draws {due}: {e}", exc_info=True)
+                continue
+
+            self._wakeup.clear()
+            timeout = self.seconds_until_next()
+            woken = await self._wait(timeout, stop_event)
+            if not woken and timeout >= self.max_sleep:
+                # Nothing happened for a whole interval, resync in case draws were changed elsewhere
+                try:
+                    await self.load()
+                except Exception as e:
+                    logger.error(f"Error reloading draw schedule: {e}", exc_info=True)
+
+    def retry_later(self, draw_id, delay):
+        """Schedule another attempt for a draw that couldn't be finished"""
+        self.schedule(draw_id, self.clock() + timedelta(seconds=delay))
+
+
+def _get_active_deadlines(session):
+    return session.query(Draw.id, Draw.scheduled_end).filter(
+        Draw.status == "active",
+        Draw.scheduled_end.isnot(None)
+    ).all()
+
+
+draw_scheduler = DrawScheduler()
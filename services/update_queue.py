@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import time
+
+from config import WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+def shard_key(update):
+    """User the update belongs to, all updates of one user go to the same shard"""
+    try:
+        event = update.event
+    except Exception:
+        return update.update_id
+    # For chat_member updates that is the member, not the admin who changed them
+    member = getattr(event, "new_chat_member", None)
+    user = member.user if member else getattr(event, "from_user", None)
+    return user.id if user else update.update_id
+
+
+class UpdateStats:
+    """Counters of an update queue, read by stats()"""
+
+    def __init__(self):
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.delayed = 0  # Had to wait for room in the queue
+        self.rejected = 0  # Queue still full after waiting
+        self.max_depth = 0
+        self.busy_time = 0.0  # Seconds from enqueue to handled, summed over processed updates
+
+
+class UpdateQueue:
+    """Bounded queues of updates, one per shard, each drained by its own task
+
+    Updates are sharded by user, so updates of the same user are handled in
+    order while different users are handled concurrently.
+    """
+
+    def __init__(self, dispatcher, bot, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE):
+        self.dispatcher = dispatcher  # Anything with an async feed_update(bot, update)
+        self.bot = bot
+        self.queues = [asyncio.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.counters = UpdateStats()
+
+        self._workers = []
+
+    async def put(self, update, timeout=None):
+        """Queue an update, waiting up to timeout seconds for room; False if it was refused"""
+        stats = self.counters
+        stats.received += 1
+        queue = self.queues[shard_key(update) % len(self.queues)]
+        try:
+            queue.put_nowait((update, time.monotonic()))
+        except asyncio.QueueFull:
+            stats.delayed += 1
+            try:
+                await asyncio.wait_for(queue.put((update, time.monotonic())), timeout)
+            except asyncio.TimeoutError:
+                stats.rejected += 1
+                if stats.rejected % 100 == 1:
+                    logger.warning(f"Update queue full, {stats.rejected} updates refused so far")
+                return False
+
+        stats.max_depth = max(stats.max_depth, queue.qsize())
+        return True
+
+    async def _work(self, queue):
+        stats = self.counters
+        while True:
+            update, queued_at = await queue.get()
+            try:
+                await self.dispatcher.feed_update(self.bot, update)
+                stats.processed += 1
+            except Exception as e:
+                stats.failed += 1
+                logger.error(f"Error handling update {update.update_id}: {e}", exc_info=True)
+            finally:
+                stats.busy_time += time.monotonic() - queued_at
+                queue.task_done()
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._work(queue)) for queue in self.queues]
+
+    async def stop(self, timeout=10):
+        """Finish the queued updates and stop the workers"""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{self.depth()} queued updates not handled before shutdown")
+
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def depth(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    def stats(self):
+        stats = self.counters
+        done = stats.processed + stats.failed
+        return {
+            "received": stats.received,
+            "processed": stats.processed,
+            "failed": stats.failed,
+            "delayed": stats.delayed,
+            "rejected": stats.rejected,
+            "queued": self.depth(),
+            "max_depth": stats.max_depth,
+            "capacity": sum(queue.maxsize for queue in self.queues),
+            "avg_latency_ms": stats.busy_time / done * 1000 if done else 0.0
+        }
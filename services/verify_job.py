@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import time
+
+from sqlalchemy import func
+
+from config import BULK_VERIFY_RATE, VERIFY_PAGE_SIZE
+from db.database import run_db
+from db.models import User
+from services.bulk_verify import VerificationResult, verify_members
+from services.ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+def _count_ticket_holders(session):
+    return session.query(func.count(User.id)).filter(User.ticket_count > 0).scalar()
+
+def _next_ticket_holders(session, after_user_id, limit):
+    # Keyset pagination, only one page of IDs is held in memory
+    return [row[0] for row in session.query(User.id).filter(
+        User.ticket_count > 0,
+        User.id > after_user_id
+    ).order_by(User.id).limit(limit)]
+
+
+class VerifyJob:
+    """Membership check of all ticket holders, run in the background by /verify
+
+    Users are streamed in pages and checked concurrently under one rate limit
+    for the whole job. The result fills up while the job runs, so progress
+    can be read at any time. Results are stored on the users as they come.
+    """
+
+    def __init__(self, page_size=VERIFY_PAGE_SIZE, rate=BULK_VERIFY_RATE):
+        self.page_size = page_size
+        self.rate = rate
+        self.result = VerificationResult()
+        self.total = 0
+        self.started_at = None
+        self.finished = False
+        self.cancelled = False
+
+        self._task = None
+        self.reporter = None  # Task reporting the progress, kept here so it isn't garbage collected
+
+    @property
+    def checked(self):
+        return len(self.result.members) + len(self.result.non_members) + len(self.result.failed)
+
+    def rate_per_second(self):
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0
+        return self.checked / elapsed if elapsed > 0 else 0.0
+
+    async def _run(self):
+        self.started_at = time.monotonic()
+        self.total = await run_db(_count_ticket_holders)
+        bucket = TokenBucket(self.rate)
+        cursor = 0
+        try:
+            while True:
+                user_ids = await run_db(_next_ticket_holders, cursor, self.page_size)
+                if not user_ids:
+                    break
+                cursor = user_ids[-1]
+                await verify_members(user_ids, bucket=bucket, result=self.result)
+        except asyncio.CancelledError:
+            self.cancelled = True
+        finally:
+            self.finished = True
+            logger.info(f"Verification job {'cancelled' if self.cancelled else 'finished'}: {self.result}")
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        return self._task
+
+    def cancel(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            return True
+        return False
+
+    async def wait(self, timeout=None):
+        """Wait for the job to finish, returns False if it is still running after timeout"""
+        done, _ = await asyncio.wait({self._task}, timeout=timeout)
+        return bool(done)
+
+
+# The running /verify job of this process, only one at a time
+current_job = None
+
+def start_job():
+    """Start a verification job, returns None if one is already running"""
+    global current_job
+    if current_job and not current_job.finished:
+        return None
+    current_job = VerifyJob()
+    current_job.start()
+    return current_job
+
+def cancel_job():
+    """Cancel the running verification job, returns False if there is none"""
+    return bool(current_job and current_job.cancel())
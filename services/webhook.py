@@ -0,0 +1,87 @@
+import hmac
+import logging
+
+from aiohttp import web
+from aiogram.types import Update
+
+from config import (
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+    WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE
+)
+from services.update_queue import UpdateQueue
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """Receives updates over a webhook and hands them to a pool of workers
+
+    Every update is acknowledged as soon as it is queued. Updates are sharded
+    by user, one queue and one worker per shard, so updates of the same user
+    are still handled in order. When a shard's queue is full the response is
+    held back until there is room, which slows Telegram down since it only
+    keeps max_connections requests open. If there is still no room after
+    enqueue_timeout the update is refused with 503 and Telegram retries it.
+    """
+
+    def __init__(self, dispatcher, bot, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET,
+                 workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE, enqueue_timeout=1.0):
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.enqueue_timeout = enqueue_timeout
+        self.updates = UpdateQueue(dispatcher, bot, workers, queue_size)
+        self.unauthorized = 0
+
+        self._runner = None
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def handle(self, request):
+        if self.secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            self.unauthorized += 1
+            return web.Response(status=401)
+
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception:
+            return web.Response(status=400)
+
+        if not await self.updates.put(update, self.enqueue_timeout):
+            return web.Response(status=503)
+        return web.Response()
+
+    def start_workers(self):
+        self.updates.start()
+
+    async def start(self, host=WEBHOOK_HOST, port=WEBHOOK_PORT, url=WEBHOOK_URL, allowed_updates=None):
+        """Start the workers and the HTTP server, then point Telegram at it"""
+        self.start_workers()
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Webhook server listening on {host}:{port}{self.path}")
+
+        if url:
+            # Updates received while the bot was down stay queued on Telegram's side
+            await self.bot.set_webhook(
+                url.rstrip("/") + self.path,
+                secret_token=self.secret,
+                allowed_updates=allowed_updates,
+                max_connections=len(self.updates.queues)
+            )
+
+    async def stop(self, timeout=10):
+        """Stop accepting updates and finish the queued ones"""
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+        await self.updates.stop(timeout)
+
+    def stats(self):
+        return {**self.updates.stats(), "unauthorized": self.unauthorized}
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+
+from config import WRITE_BUFFER_INTERVAL, WRITE_BUFFER_MAX_BATCH
+from db.database import run_db
+
+logger = logging.getLogger(__name__)
+
+
+def _apply_batch(session, writes):
+    results = []
+    for func, args in writes:
+        results.append(func(session, *args))
+        # Later writes in the batch may depend on rows added by earlier ones
+        session.flush()
+    return results
+
+
+def _resolve(future, result=None, exception=None):
+    # The future is cancelled if a caller awaiting it was, the write is committed anyway
+    if future.done():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+
+class _Write:
+    __slots__ = ("func", "args", "key", "users", "future")
+
+    def __init__(self, func, args, key, users, future):
+        self.func = func
+        self.args = args
+        self.key = key
+        self.users = users
+        self.future = future
+
+
+class WriteBuffer:
+    """Write-behind buffer that commits small writes in batches
+
+    Writes are queued in memory and applied by one background task in a
+    single transaction, after `interval` seconds or as soon as `max_batch`
+    writes are waiting. During a spike hundreds of /start updates share one
+    SQLite write lock and one commit instead of taking turns. Reading a user
+    with queued writes flushes them first, so a handler always sees its own
+    writes. Writes not committed yet (at most `interval` seconds of them)
+    are lost if the process is killed, close() commits them on shutdown.
+    """
+
+    def __init__(self, interval=0.05, max_batch=500):
+        self.interval = interval
+        self.max_batch = max_batch
+
+        self._queue = []
+        self._by_key = {}  # key -> queued write, repeated writes with the same key are merged
+        self._last = {}  # user_id -> future of the last queued write touching that user
+        self._wakeup = asyncio.Event()  # Something was queued
+        self._urgent = asyncio.Event()  # Flush without waiting for the interval
+        self._task = None
+        self._closing = False
+
+        self.batches = 0
+        self.writes = 0
+        self.merged = 0
+        self.failed = 0
+
+    def submit(self, func, *args, key=None, users=()):
+        """Queue func(session, *args), returns a future of its result once committed"""
+        if key is not None and key in self._by_key:
+            self.merged += 1
+            return self._by_key[key].future
+
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(self._log_failure)
+        write = _Write(func, args, key, users, future)
+        self._queue.append(write)
+        if key is not None:
+            self._by_key[key] = write
+        for user_id in users:
+            self._last[user_id] = future
+        future.add_done_callback(lambda _: self._forget(users, future))
+
+        if self._task is None or self._task.done():
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+        if len(self._queue) >= self.max_batch:
+            self._urgent.set()
+        return future
+
+    def _forget(self, users, future):
+        for user_id in users:
+            if self._last.get(user_id) is future:
+                del self._last[user_id]
+
+    def _log_failure(self, future):
+        if not future.cancelled() and future.exception():
+            self.failed += 1
+            logger.error(f"Buffered write failed: {future.exception()}", exc_info=future.exception())
+
+    async def sync(self, *user_ids):
+        """Wait until queued writes of these users are committed (read-your-writes)"""
+        futures = [self._last[user_id] for user_id in user_ids if user_id in self._last]
+        if not futures:
+            return
+        # Somebody is waiting, don't hold the batch back
+        self._urgent.set()
+        await asyncio.wait(futures)
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                if self._closing:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            if not self._urgent.is_set() and not self._closing:
+                # Give more writes the chance to join this batch
+                try:
+                    await asyncio.wait_for(self._urgent.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._urgent.clear()
+
+            batch, self._queue = self._queue[:self.max_batch], self._queue[self.max_batch:]
+            for write in batch:
+                if write.key is not None:
+                    self._by_key.pop(write.key, None)
+            await self._commit(batch)
+
+    async def _commit(self, batch):
+        try:
+            results = await run_db(_apply_batch, [(write.func, write.args) for write in batch])
+        except Exception as e:
+            # One bad write must not take the others down, apply them one by one
+            logger.warning(f"Batch of {len(batch)} writes failed, retrying them one by one: {e}")
+            results = None
+
+        self.batches += 1
+        self.writes += len(batch)
+        if results is not None:
+            for write, result in zip(batch, results):
+                _resolve(write.future, result)
+            return
+
+        for write in batch:
+            try:
+                _resolve(write.future, await run_db(write.func, *write.args))
+            except Exception as e:
+                _resolve(write.future, exception=e)
+
+    async def close(self):
+        """Commit everything still queued, called on shutdown"""
+        if self._task is None:
+            return
+        self._closing = True
+        self._urgent.set()
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    def stats(self):
+        return {
+            "queued": len(self._queue),
+            "batches": self.batches,
+            "writes": self.writes,
+            "merged": self.merged,
+            "failed": self.failed,
+            "avg_batch": round(self.writes / self.batches, 1) if self.batches else 0
+        }
+
+
+write_buffer = WriteBuffer(interval=WRITE_BUFFER_INTERVAL, max_batch=WRITE_BUFFER_MAX_BATCH)
@@ -0,0 +1,18 @@
+import logging
+import sys
+
+LOG_FORMAT = "%(asctime)s %(name)s %(levelname)s: %(message)s"
+
+
+def setup_logger(name, level=logging.INFO):
+    """Configure logging to stderr once and return the logger of the given name"""
+    root = logging.getLogger()
+    if not root.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        root.addHandler(handler)
+    root.setLevel(level)
+
+    # Every API request is logged at INFO by aiogram, too noisy under load
+    logging.getLogger("aiogram.event").setLevel(max(level, logging.WARNING))
+    return logging.getLogger(name)